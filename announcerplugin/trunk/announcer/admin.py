@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, Steffen Hoffmann
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+from trac.admin.api import IAdminPanelProvider
+from trac.core import implements
+from trac.web.chrome import Chrome, add_notice
+
+from announcer.api import _, AnnouncementSystem
+from announcer.model import SubscriptionCache
+from announcer.pref import AnnouncerTemplateProvider
+
+
+class AnnouncerAdminPanel(AnnouncerTemplateProvider):
+    """Shows statistics of the subscription cache and of the announcement
+    pipeline.
+    """
+
+    implements(IAdminPanelProvider)
+
+    # IAdminPanelProvider methods
+
+    def get_admin_panels(self, req):
+        if 'TRAC_ADMIN' in req.perm:
+            yield ('announcer', _("Announcer"), 'statistics',
+                   _("Statistics"))
+
+    def render_admin_panel(self, req, cat, page, path_info):
+        req.perm.require('TRAC_ADMIN')
+        cache = SubscriptionCache(self.env)
+        if req.method == 'POST':
+            if 'clear' in req.args:
+                cache.invalidate()
+                add_notice(req, _("The subscription cache has been cleared."))
+            req.redirect(req.href.admin(cat, page))
+
+        announcer = AnnouncementSystem(self.env)
+        timings = []
+        for stage in announcer.stages:
+            count, seconds = announcer.timings.get(stage, (0, 0.0))
+            timings.append((stage, count, seconds,
+                            seconds / count if count else 0.0))
+        data = {
+            'stats': cache.stats(),
+            'timings': timings,
+            'delivery_mode': announcer.delivery_mode,
+            'spooled': len(announcer._spool),
+        }
+        if hasattr(Chrome(self.env), 'jenv'):
+            return 'admin_announcer_stats.html', data, None
+        else:
+            return 'admin_announcer_stats.html', data
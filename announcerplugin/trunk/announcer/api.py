@@ -8,11 +8,15 @@
 # you should have received as part of this distribution.
 #
 
+import atexit
+import threading
 import time
 
 from announcer import db_default
+from announcer.model import SubscriptionCache
+from announcer.util import get_target_id
 from pkg_resources import resource_filename
-from trac.config import ExtensionOption
+from trac.config import ChoiceOption, ExtensionOption, IntOption
 from trac.core import Component, ExtensionPoint, Interface, TracError, \
                       implements
 from trac.db import DatabaseManager
@@ -189,6 +193,21 @@ class IAnnouncementDistributor(Interface):
         """
 
 
+class IAnnouncementAddressBatchResolver(Interface):
+    """Optional extension for `IEmailAddressResolver` implementations
+    that can resolve the addresses of many sessions at once.
+
+    Distributors use it in place of calling `get_address_for_session`
+    for every single recipient.
+    """
+
+    def get_addresses_for_sessions(sessions):
+        """Return a dict mapping `(sid, authenticated)` tuples from the
+        `sessions` set to addresses. Sessions without an address are left
+        out of the dict.
+        """
+
+
 class IAnnouncementPreferenceProvider(Interface):
     """Represents a single 'box' in the Announcements preference panel.
 
@@ -249,6 +268,23 @@ class AnnouncementEvent(object):
     def get_session_terms(self, session_id):
         return tuple()
 
+    def coalesce(self, other):
+        """Return a single event combining this event with `other`, a
+        later event for the same target, or `None` if they can't be
+        combined.
+        """
+        return None
+
+
+class AnnouncementDigestEvent(AnnouncementEvent):
+    """Bundles several events for the same recipients into one
+    announcement in the 'digest' realm.
+    """
+
+    def __init__(self, events):
+        AnnouncementEvent.__init__(self, 'digest', 'digest', events)
+        self.events = events
+
 
 class IAnnouncementSubscriptionResolver(Interface):
     """Supports new and old style of subscription resolution until new code
@@ -370,10 +406,32 @@ class AnnouncementSystem(Component):
                                order they will be called.
                                """)
 
+    delivery_mode = ChoiceOption('announcer', 'delivery_mode',
+        ['immediate', 'coalesce', 'digest'],
+        """How events are announced:
+         immediate:: every event is announced during the request causing it.
+         coalesce:: events are collected for `coalesce_window` seconds, and
+           the events for the same resource are announced as one.
+         digest:: like coalesce, but all events for a recipient are then
+           sent as one digest.
+        """)
+
+    coalesce_window = IntOption('announcer', 'coalesce_window', 60,
+        """Number of seconds events are collected before they are
+        announced, if `delivery_mode` is not 'immediate'.
+        """)
+
+    stages = ('resolve', 'filter', 'format', 'distribute')
+
     def __init__(self):
         # Bind the 'announcer' catalog to the specified locale directory.
         locale_dir = resource_filename(__name__, 'locale')
         add_domain(self.env.path, locale_dir)
+        self.timings = dict((stage, [0, 0.0]) for stage in self.stages)
+        self._spool = []
+        self._spool_lock = threading.Lock()
+        self._spool_timer = None
+        self._flush_at_exit = False
 
     # IEnvironmentSetupParticipant methods
 
@@ -503,15 +561,126 @@ class AnnouncementSystem(Component):
                 """, (db_default.schema_version,))
             self.log.info("Upgraded TracAnnouncer db schema from version "
                           "%d to %d", schema_ver, db_default.schema_version)
+            SubscriptionCache(self.env).invalidate()
 
     # AnnouncementSystem core methods
 
     def send(self, evt):
+        if self.delivery_mode == 'immediate':
+            start = time.time()
+            self._real_send(evt)
+            stop = time.time()
+            self.log.debug("AnnouncementSystem sent event in %s seconds.",
+                           round(stop - start, 2))
+            return
+        with self._spool_lock:
+            self._spool.append(evt)
+            if self._spool_timer is None:
+                self._spool_timer = threading.Timer(self.coalesce_window,
+                                                    self.flush)
+                self._spool_timer.daemon = True
+                self._spool_timer.start()
+            if not self._flush_at_exit:
+                # Don't lose spooled events on a regular shutdown.
+                atexit.register(self.flush)
+                self._flush_at_exit = True
+        self.log.debug("AnnouncementSystem spooled event for %s seconds.",
+                       self.coalesce_window)
+
+    def flush(self):
+        """Announce all spooled events, combining the events for the same
+        resource and, in 'digest' mode, the events for the same recipients.
+        """
+        with self._spool_lock:
+            events, self._spool = self._spool, []
+            if self._spool_timer is not None:
+                self._spool_timer.cancel()
+                self._spool_timer = None
+        if not events:
+            return
+        start = time.time()
+        events = self.coalesce(events)
+        if self.delivery_mode == 'digest':
+            self._send_digest(events)
+        else:
+            for evt in events:
+                self._real_send(evt)
+        self.log.debug("AnnouncementSystem sent %d spooled events in %s "
+                       "seconds.", len(events), round(time.time() - start, 2))
+
+    def coalesce(self, events):
+        """Combine consecutive events for the same resource, keeping the
+        order in which the resources were changed first.
+        """
+        by_target = {}
+        order = []
+        for evt in events:
+            key = (evt.realm, get_target_id(evt.target))
+            if key not in by_target:
+                by_target[key] = []
+                order.append(key)
+            pending = by_target[key]
+            combined = pending and pending[-1].coalesce(evt)
+            if combined:
+                pending[-1] = combined
+            else:
+                pending.append(evt)
+        return [evt for key in order for evt in by_target[key]]
+
+    def record_timing(self, stage, seconds):
+        """Add the time spent in a stage of the announcement pipeline to
+        the `timings` statistics.
+        """
+        timing = self.timings.setdefault(stage, [0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+
+    def _resolve(self, evt):
         start = time.time()
-        self._real_send(evt)
-        stop = time.time()
-        self.log.debug("AnnouncementSystem sent event in %s seconds.",
-                       round(stop - start, 2))
+        subscriptions = self.resolver.subscriptions(evt)
+        self.record_timing('resolve', time.time() - start)
+        start = time.time()
+        for sf in self.subscription_filters:
+            subscriptions = \
+                set(sf.filter_subscriptions(evt, subscriptions))
+        self.record_timing('filter', time.time() - start)
+        return subscriptions
+
+    def _distribute(self, evt, packages):
+        start = time.time()
+        for distributor in self.distributors:
+            for transport in distributor.transports():
+                if transport in packages:
+                    distributor.distribute(transport, packages[transport],
+                                           evt)
+        self.record_timing('distribute', time.time() - start)
+
+    def _send_digest(self, events):
+        """Send one announcement to every group of recipients subscribed
+        to the same events, bundling several events as a digest.
+        """
+        try:
+            interests = {}
+            for idx, evt in enumerate(events):
+                for transport, sid, authenticated, address, subs_format \
+                        in self._resolve(evt):
+                    recipient = (transport, sid, authenticated, address)
+                    interests.setdefault(recipient, []).append(idx)
+            groups = {}
+            for (transport, sid, authenticated, address), indexes \
+                    in interests.iteritems():
+                groups.setdefault(tuple(indexes), {}) \
+                      .setdefault(transport, set()) \
+                      .add((sid, authenticated, address))
+            for indexes, packages in groups.iteritems():
+                if len(indexes) == 1:
+                    evt = events[indexes[0]]
+                else:
+                    evt = AnnouncementDigestEvent([events[idx]
+                                                   for idx in indexes])
+                self._distribute(evt, packages)
+        except Exception:
+            self.log.error("AnnouncementSystem failed.", exc_info=True)
 
     def _real_send(self, evt):
         """Accepts a single AnnouncementEvent instance (or subclass), and
@@ -522,10 +691,7 @@ class AnnouncementSystem(Component):
         the debug logs.
         """
         try:
-            subscriptions = self.resolver.subscriptions(evt)
-            for sf in self.subscription_filters:
-                subscriptions = \
-                    set(sf.filter_subscriptions(evt, subscriptions))
+            subscriptions = self._resolve(evt)
 
             self.log.debug("AnnouncementSystem has found the following "
                            "subscriptions: %s",
@@ -541,10 +707,6 @@ class AnnouncementSystem(Component):
                 if transport not in packages:
                     packages[transport] = set()
                 packages[transport].add((sid, authenticated, address))
-            for distributor in self.distributors:
-                for transport in distributor.transports():
-                    if transport in packages:
-                        distributor.distribute(transport, packages[transport],
-                                               evt)
+            self._distribute(evt, packages)
         except Exception:
             self.log.error("AnnouncementSystem failed.", exc_info=True)
@@ -7,9 +7,9 @@
 # you should have received as part of this distribution.
 #
 
-from trac.db import Table, Column
+from trac.db import Table, Column, Index
 
-schema_version = 6
+schema_version = 7
 
 # The 'subscriptions' db table has been dropped in favor of the new
 # subscriber interface, that uses two other tables.
@@ -37,6 +37,18 @@ schema = [
         Column('class'),
         Column('realm'),
         Column('target')
+    ],
+    # Outgoing email messages waiting for delivery, see `EmailDistributor`.
+    Table('announcement_queue', key='id')[
+        Column('id', auto_increment=True),
+        Column('time', type='int64'),
+        Column('next_attempt', type='int64'),
+        Column('attempts', type='int'),
+        Column('from_addr'),
+        Column('recipients'),
+        Column('message'),
+        Column('last_error'),
+        Index(['next_attempt'])
     ]
 ]
 
@@ -12,10 +12,11 @@
 #       format for all announcements, but in the future we can make this more
 #       flexible, since it's in the subscription table.
 
-import Queue
 import hashlib
 import random
 import re
+import smtplib
+import socket
 import threading
 import time
 from email.charset import Charset, QP, BASE64
@@ -23,16 +24,22 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import formatdate, formataddr
 
+from trac.admin.api import IAdminCommandProvider
 from trac.config import (
-    BoolOption, ExtensionOption, Option, OrderedExtensionsOption)
+    BoolOption, ExtensionOption, IntOption, Option, OrderedExtensionsOption)
 from trac.core import (
     Component, ExtensionPoint, Interface, TracError, implements)
 from trac.notification.api import IEmailAddressResolver, IEmailSender
-from trac.util.text import CRLF
+from trac.notification.mail import SmtpEmailSender
+from trac.util.datefmt import datetime_now, to_utimestamp, utc
+from trac.util.text import (
+    CRLF, exception_to_unicode, print_table, printout, to_unicode)
+from trac.web.api import IRequestFilter
 
 from announcer.api import (
-    _, IAnnouncementDistributor, IAnnouncementFormatter)
-from announcer.model import Subscription
+    _, AnnouncementSystem, IAnnouncementAddressBatchResolver,
+    IAnnouncementDistributor, IAnnouncementFormatter)
+from announcer.util import chunks
 from announcer.util.mail import set_header
 from announcer.util.mail_crypto import CryptoTxt
 
@@ -48,10 +55,12 @@ class IAnnouncementEmailDecorator(Interface):
 
 class EmailDistributor(Component):
 
-    implements(IAnnouncementDistributor)
+    implements(IAdminCommandProvider, IAnnouncementDistributor,
+               IRequestFilter)
 
     formatters = ExtensionPoint(IAnnouncementFormatter)
     decorators = ExtensionPoint(IAnnouncementEmailDecorator)
+    batch_resolvers = ExtensionPoint(IAnnouncementAddressBatchResolver)
 
     resolvers = OrderedExtensionsOption('announcer',
         'email_address_resolvers', IEmailAddressResolver,
@@ -112,15 +121,42 @@ class EmailDistributor(Component):
 
     use_threaded_delivery = BoolOption('announcer', 'use_threaded_delivery',
         False,
-        """Do message delivery in a separate thread.
+        """Do message delivery in separate threads.
 
         Enabling this will improve responsiveness for requests that end up
-        with an announcement being sent over email. It requires building
+        with an announcement being sent over email. Messages are stored in
+        the `announcement_queue` db table, so they survive a restart, and
+        are delivered by a pool of worker threads, started by the first
+        announcement of a web server process. Announcements made outside
+        of a web server, e.g. by `trac-admin`, are sent right away.
+        It requires building
         Python with threading support enabled-- which is usually the case.
         To test, start Python and type 'import threading' to see
         if it raises an error.
         """)
 
+    delivery_workers = IntOption('announcer', 'delivery_workers', 2,
+        """Number of threads delivering queued messages, if
+        `use_threaded_delivery` is enabled.
+        """)
+
+    delivery_batch_size = IntOption('announcer', 'delivery_batch_size', 10,
+        """Maximum number of queued messages a worker thread sends over
+        one SMTP connection.
+        """)
+
+    delivery_max_attempts = IntOption('announcer', 'delivery_max_attempts',
+        5,
+        """Number of times the delivery of a queued message is attempted
+        before it is given up. Failed messages are kept in the queue and
+        can be requeued with `trac-admin $ENV announcer queue retry`.
+        """)
+
+    delivery_retry_delay = IntOption('announcer', 'delivery_retry_delay', 60,
+        """Seconds to wait before retrying a failed delivery. The delay
+        is doubled with every further attempt.
+        """)
+
     default_email_format = Option('announcer', 'default_email_format',
         'text/plain',
         """The default mime type of the email notifications.
@@ -181,15 +217,53 @@ class EmailDistributor(Component):
     def __init__(self):
         self.enigma = None
         self.delivery_queue = None
+        self._delivery_lock = threading.Lock()
+        self._serving_requests = False
         self._init_pref_encoding()
 
     def get_delivery_queue(self):
-        if not self.delivery_queue:
-            self.delivery_queue = Queue.Queue()
-            thread = DeliveryThread(self.delivery_queue, self.send)
-            thread.start()
+        with self._delivery_lock:
+            if not self.delivery_queue:
+                self.delivery_queue = DeliveryQueue(
+                    self.env, self.send_many, self.delivery_batch_size,
+                    self.delivery_max_attempts, self.delivery_retry_delay)
+                self.delivery_queue.start(self.delivery_workers)
         return self.delivery_queue
 
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        # Only a web server process lives long enough to deliver the
+        # queued messages, see `_do_send`.
+        self._serving_requests = True
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('announcer queue status', '',
+               'Show the number of queued email messages',
+               None, self._do_queue_status)
+        yield ('announcer queue retry', '',
+               'Requeue email messages whose delivery failed',
+               None, self._do_queue_retry)
+
+    def _do_queue_status(self):
+        queue = DeliveryQueue(self.env)
+        pending, retrying, failed = queue.depth()
+        print_table([(pending, retrying, failed)],
+                    ['Pending', 'Retrying', 'Failed'])
+        if failed:
+            print_table(queue.failed_messages(),
+                        ['Id', 'Recipients', 'Attempts', 'Last error'])
+
+    def _do_queue_retry(self):
+        count = DeliveryQueue(self.env).retry_failed()
+        printout('%d message(s) requeued.' % count)
+
     # IAnnouncementDistributor methods
 
     def transports(self):
@@ -233,9 +307,20 @@ class EmailDistributor(Component):
             self.log.debug("EmailDistributor attempts crypto operation.")
             self.enigma = CryptoTxt(self.gpg_binary, self.gpg_home)
 
+        # Look up formats and addresses for all recipients at once.
+        sessions = set((name, int(authed or 0))
+                       for name, authed, address in recipients if name)
+        preferred = self._get_preferred_formats(sessions)
+        resolved = self._get_addresses(
+            set((name, int(authed or 0))
+                for name, authed, address in recipients
+                if name and not address))
+        # Formatted bodies by style, shared by all messages of this event.
+        outputs = {}
+
         for name, authed, address in recipients:
-            fmt = name and \
-                  self._get_preferred_format(event.realm, name, authed) or \
+            session = (name, int(authed or 0))
+            fmt = name and preferred.get(session) or \
                   self._get_default_format()
             old_fmt = fmt
             if fmt not in formats:
@@ -257,10 +342,7 @@ class EmailDistributor(Component):
             resolver = None
             if name and not address:
                 # figure out what the addr should be if it's not defined
-                for resolver in self.resolvers:
-                    address = resolver.get_address_for_session(name, authed)
-                    if address:
-                        break
+                address, resolver = resolved.get(session, (None, None))
             if address:
                 self.log.debug("EmailDistributor found the address '%s' "
                                "for '%s (%s)' via: %s", address, name,
@@ -309,7 +391,7 @@ class EmailDistributor(Component):
             fmt = formats[k]
             self.log.debug("EmailDistributor is sending event as '%s' to: "
                            "%s", fmt, ', '.join(x[2] for x in v))
-            self._do_send(transport, event, k, v, fmt)
+            self._do_send(transport, event, k, v, fmt, outputs=outputs)
         for k, v in msgdict_encrypt.items():
             if not v or not formats.get(k):
                 continue
@@ -317,25 +399,56 @@ class EmailDistributor(Component):
             self.log.debug("EmailDistributor is sending encrypted info on "
                            "event as '%s' to: %s", fmt,
                            ', '.join(x[2] for x in v))
-            self._do_send(transport, event, k, v, formats[k], msg_pubkey_ids)
+            self._do_send(transport, event, k, v, formats[k], msg_pubkey_ids,
+                          outputs)
 
     def _get_default_format(self):
         return self.default_email_format
 
-    def _get_preferred_format(self, realm, sid, authenticated):
-        if authenticated is None:
-            authenticated = 0
+    def _get_preferred_formats(self, sessions):
+        """Return a dict mapping `(sid, authenticated)` tuples to the format
+        of their top priority email subscription.
+        """
         # Format is unified for all subscriptions of a user.
-        result = Subscription.find_by_sid_and_distributor(
-            self.env, sid, authenticated, 'email')
-        if result:
-            chosen = result[0]['format']
-            self.log.debug("EmailDistributor determined the preferred format"
-                           " for '%s (%s)' is: %s", sid, authenticated and
-                           'authenticated' or 'not authenticated', chosen)
-            return chosen
-        else:
-            return self._get_default_format()
+        formats = {}
+        for sids in chunks(set(sid for sid, authenticated in sessions)):
+            for sid, authenticated, format in self.env.db_query("""
+                    SELECT sid,authenticated,format
+                      FROM subscription
+                     WHERE distributor='email' AND sid IN (%s)
+                     ORDER BY priority
+                    """ % ','.join(['%s'] * len(sids)), sids):
+                session = (sid, int(authenticated or 0))
+                if session in sessions and session not in formats:
+                    formats[session] = format
+        self.log.debug("EmailDistributor determined the preferred formats: "
+                       "%s", formats)
+        return formats
+
+    def _get_addresses(self, sessions):
+        """Return a dict mapping `(sid, authenticated)` tuples to an
+        `(address, resolver)` pair, asking the resolvers in order for the
+        sessions that are still unresolved.
+        """
+        addresses = {}
+        batch_resolvers = self.batch_resolvers
+        for resolver in self.resolvers:
+            if not sessions:
+                break
+            if resolver in batch_resolvers:
+                found = resolver.get_addresses_for_sessions(sessions)
+            else:
+                found = {}
+                for sid, authenticated in sessions:
+                    address = resolver.get_address_for_session(
+                        sid, authenticated)
+                    if address:
+                        found[(sid, authenticated)] = address
+            for session, address in found.iteritems():
+                if address:
+                    addresses[session] = (address, resolver)
+            sessions = sessions - set(addresses)
+        return addresses
 
     def _init_pref_encoding(self):
         self._charset = Charset()
@@ -377,9 +490,22 @@ class EmailDistributor(Component):
     def _filter_recipients(self, rcpt):
         return rcpt
 
+    def _format(self, outputs, formatter, transport, event, style):
+        """Format the event in `style`, reusing a body from `outputs`."""
+        key = (formatter.__class__.__name__, style)
+        if key not in outputs:
+            start = time.time()
+            outputs[key] = formatter.format(transport, event.realm, style,
+                                            event)
+            AnnouncementSystem(self.env).record_timing(
+                'format', time.time() - start)
+        return outputs[key]
+
     def _do_send(self, transport, event, format, recipients, formatter,
-                 pubkey_ids=None):
+                 pubkey_ids=None, outputs=None):
         pubkey_ids = pubkey_ids or []
+        if outputs is None:
+            outputs = {}
         # Prepare sender for use in IEmailSender component and message header.
         from_header = formataddr(
             (self.from_name and self.from_name or self.env.project_name,
@@ -414,7 +540,7 @@ class EmailDistributor(Component):
         for k, v in headers.iteritems():
             set_header(root_message, k, v)
 
-        output = formatter.format(transport, event.realm, format, event)
+        output = self._format(outputs, formatter, transport, event, format)
 
         # DEVEL: Currently crypto operations work with format text/plain only.
         alternate_output = None
@@ -436,12 +562,9 @@ class EmailDistributor(Component):
                 format
             )
             if alternate_style:
-                alternate_output = formatter.format(
-                    transport,
-                    event.realm,
-                    alternate_style,
-                    event
-                )
+                alternate_output = self._format(outputs, formatter,
+                                                transport, event,
+                                                alternate_style)
 
         # Sanity check for suitable encoding setting.
         if not self._charset.body_encoding:
@@ -483,8 +606,10 @@ class EmailDistributor(Component):
 
         package = (from_header, recip_adds, root_message.as_string())
         start = time.time()
-        if self.use_threaded_delivery:
-            self.get_delivery_queue().put(package)
+        if self.use_threaded_delivery and self._serving_requests:
+            # Worker threads are started lazily, which also resumes the
+            # delivery of messages queued before a restart.
+            self.get_delivery_queue().put(*package)
         else:
             self.send(*package)
         stop = time.time()
@@ -497,18 +622,257 @@ class EmailDistributor(Component):
         message = CRLF.join(re.split('\r?\n', message))
         self.email_sender.send(from_addr, recipients, message)
 
+    def send_many(self, messages):
+        """Send a list of `(from_addr, recipients, message)` tuples and
+        return a list with `None` or the error for each of them.
+
+        With `SmtpEmailSender` all messages are sent over one connection,
+        which is opened again if the server drops it, otherwise they are
+        passed to the email sender one by one.
+        """
+        sender = self.email_sender
+        if not isinstance(sender, SmtpEmailSender):
+            errors = []
+            for package in messages:
+                try:
+                    self.send(*package)
+                except Exception, e:
+                    errors.append(e)
+                else:
+                    errors.append(None)
+            return errors
+
+        errors = []
+        server = None
+        try:
+            for from_addr, recipients, message in messages:
+                message = CRLF.join(re.split('\r?\n', message))
+                retried = False
+                while True:
+                    if server is None:
+                        server = self._smtp_connect(sender)
+                    try:
+                        server.sendmail(from_addr, recipients, message)
+                    except (smtplib.SMTPServerDisconnected, socket.error), e:
+                        server = None
+                        if retried:
+                            errors.append(e)
+                            break
+                        # reconnect and send the message again, once
+                        self.log.info("EmailDistributor reconnecting to "
+                                      "%s:%d: %s", sender.smtp_server,
+                                      sender.smtp_port,
+                                      exception_to_unicode(e))
+                        retried = True
+                    except Exception, e:
+                        errors.append(e)
+                        try:
+                            server.rset()
+                        except (smtplib.SMTPException, socket.error):
+                            server = None
+                        break
+                    else:
+                        errors.append(None)
+                        break
+        except Exception, e:
+            # the server can't be reached, the rest of the batch fails
+            errors.extend([e] * (len(messages) - len(errors)))
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                pass
+        return errors
+
+    def _smtp_connect(self, sender):
+        """Open a connection like `SmtpEmailSender.send` does, with the
+        `[notification]` settings of `sender`."""
+        server = smtplib.SMTP(sender.smtp_server, sender.smtp_port)
+        if sender.use_tls:
+            server.ehlo()
+            if 'starttls' not in server.esmtp_features:
+                raise TracError(_("TLS enabled but server does not support "
+                                  "TLS"))
+            server.starttls()
+            server.ehlo()
+        if sender.smtp_user:
+            server.login(sender.smtp_user.encode('utf-8'),
+                         sender.smtp_password.encode('utf-8'))
+        return server
+
     def _get_decorators(self):
         return self.decorators[:]
 
 
+class DeliveryQueue(object):
+    """Persistent queue of email messages in the `announcement_queue` db
+    table, delivered in batches by a pool of worker threads.
+
+    A message is claimed by setting its `next_attempt` time into the future,
+    so that it's picked up again if the process dies while delivering it.
+    Messages that failed `max_attempts` times get a `next_attempt` of NULL.
+    """
+
+    lease = 600  # seconds a claimed message is reserved for a worker
+    poll_interval = 30  # seconds between checks for messages to retry
+
+    def __init__(self, env, sender=None, batch_size=10, max_attempts=5,
+                 retry_delay=60):
+        self.env = env
+        self.log = env.log
+        self.sender = sender
+        self.batch_size = max(1, batch_size)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._cond = threading.Condition()
+        self._workers = []
+
+    def start(self, workers):
+        for i in range(max(1, workers)):
+            thread = DeliveryThread(self, i)
+            thread.start()
+            self._workers.append(thread)
+
+    def put(self, from_addr, recipients, message):
+        now = to_utimestamp(datetime_now(utc))
+        self.env.db_transaction("""
+            INSERT INTO announcement_queue
+                   (time,next_attempt,attempts,
+                    from_addr,recipients,message,last_error)
+            VALUES (%s,%s,0,%s,%s,%s,'')
+            """, (now, now, from_addr, '\n'.join(recipients),
+                  to_unicode(message)))
+        with self._cond:
+            self._cond.notify()
+
+    def depth(self):
+        """Return the number of pending, retrying and failed messages."""
+        for row in self.env.db_query("""
+                SELECT SUM(CASE WHEN next_attempt IS NOT NULL
+                                 AND attempts=0 THEN 1 ELSE 0 END),
+                       SUM(CASE WHEN next_attempt IS NOT NULL
+                                 AND attempts>0 THEN 1 ELSE 0 END),
+                       SUM(CASE WHEN next_attempt IS NULL THEN 1 ELSE 0 END)
+                  FROM announcement_queue
+                """):
+            return tuple(int(value or 0) for value in row)
+
+    def failed_messages(self):
+        return [(id, ', '.join(recipients.split('\n')), attempts, error)
+                for id, recipients, attempts, error in self.env.db_query("""
+                    SELECT id,recipients,attempts,last_error
+                      FROM announcement_queue
+                     WHERE next_attempt IS NULL
+                     ORDER BY id
+                    """)]
+
+    def retry_failed(self):
+        now = to_utimestamp(datetime_now(utc))
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("""
+                UPDATE announcement_queue
+                   SET next_attempt=%s,attempts=0
+                 WHERE next_attempt IS NULL
+                """, (now,))
+            count = cursor.rowcount
+        with self._cond:
+            self._cond.notify_all()
+        return count
+
+    def claim(self, limit):
+        """Reserve up to `limit` due messages for delivery and return them
+        as `(id, attempts, from_addr, recipients, message)` tuples.
+        """
+        now = to_utimestamp(datetime_now(utc))
+        until = now + self.lease * 1000000
+        claimed = []
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("""
+                SELECT id,next_attempt
+                  FROM announcement_queue
+                 WHERE next_attempt<=%%s
+                 ORDER BY next_attempt,id
+                 LIMIT %d
+                """ % limit, (now,))
+            for id, next_attempt in cursor.fetchall():
+                cursor.execute("""
+                    UPDATE announcement_queue
+                       SET next_attempt=%s
+                     WHERE id=%s AND next_attempt=%s
+                    """, (until, id, next_attempt))
+                if cursor.rowcount == 1:
+                    claimed.append(id)
+            if not claimed:
+                return []
+            cursor.execute("""
+                SELECT id,attempts,from_addr,recipients,message
+                  FROM announcement_queue
+                 WHERE id IN (%s)
+                 ORDER BY next_attempt,id
+                """ % ','.join(['%s'] * len(claimed)), claimed)
+            return [(id, attempts, from_addr, recipients.split('\n'),
+                     message)
+                    for id, attempts, from_addr, recipients, message
+                    in cursor.fetchall()]
+
+    def process(self):
+        """Deliver due messages until none are left and return the number
+        of messages sent.
+        """
+        sent = 0
+        while True:
+            batch = self.claim(self.batch_size)
+            if not batch:
+                return sent
+            errors = self.sender([row[2:] for row in batch])
+            now = to_utimestamp(datetime_now(utc))
+            with self.env.db_transaction as db:
+                for (id, attempts, from_addr, recipients, message), error \
+                        in zip(batch, errors):
+                    if error is None:
+                        db("DELETE FROM announcement_queue WHERE id=%s",
+                           (id,))
+                        sent += 1
+                        continue
+                    attempts += 1
+                    if attempts >= self.max_attempts:
+                        next_attempt = None
+                        self.log.error("EmailDistributor gave up delivering "
+                                       "to %s after %d attempts: %s",
+                                       ', '.join(recipients), attempts,
+                                       exception_to_unicode(error))
+                    else:
+                        delay = self.retry_delay * 2 ** (attempts - 1)
+                        next_attempt = now + delay * 1000000
+                        self.log.warning("EmailDistributor failed delivering "
+                                         "to %s, retrying in %d seconds: %s",
+                                         ', '.join(recipients), delay,
+                                         exception_to_unicode(error))
+                    db("""
+                        UPDATE announcement_queue
+                           SET next_attempt=%s,attempts=%s,last_error=%s
+                         WHERE id=%s
+                        """, (next_attempt, attempts,
+                              exception_to_unicode(error), id))
+
+    def wait(self):
+        with self._cond:
+            self._cond.wait(self.poll_interval)
+
+
 class DeliveryThread(threading.Thread):
-    def __init__(self, queue, sender):
-        threading.Thread.__init__(self)
-        self._sender = sender
+    def __init__(self, queue, index):
+        threading.Thread.__init__(self, name='AnnouncerDelivery-%d' % index)
         self._queue = queue
         self.setDaemon(True)
 
     def run(self):
         while 1:
-            send_from, recipients, message = self._queue.get()
-            self._sender(send_from, recipients, message)
+            try:
+                self._queue.process()
+            except Exception, e:
+                self._queue.log.error("EmailDistributor delivery failed: %s",
+                                      exception_to_unicode(e, traceback=True))
+            self._queue.wait()
@@ -12,6 +12,7 @@ from trac.core import Component, implements
 from trac.util.text import to_unicode
 
 from announcer import __version__ as announcer_version
+from announcer.api import _
 from announcer.distributors.mail import IAnnouncementEmailDecorator
 from announcer.util.mail import msgid, next_decorator, set_header, uid_encode
 
@@ -225,3 +226,23 @@ class WikiSubjectEmailDecorator(Component):
             set_header(message, 'Subject', subject)
 
         return next_decorator(event, message, decorates)
+
+
+class DigestSubjectEmailDecorator(Component):
+    """Sets the subject header of digests, see the 'digest' option
+    `[announcer] delivery_mode`.
+    """
+
+    implements(IAnnouncementEmailDecorator)
+
+    def decorate_message(self, event, message, decorates=None):
+        if event.realm == 'digest':
+            subject = _("Digest of %(count)s changes", count=len(event.events))
+            prefix = self.config.get('announcer', 'email_subject_prefix')
+            if prefix == '__default__':
+                prefix = '[%s] ' % self.env.project_name
+            if prefix:
+                subject = "%s%s" % (prefix, subject)
+            set_header(message, 'Subject', subject)
+
+        return next_decorator(event, message, decorates)
@@ -14,7 +14,7 @@ import difflib
 from genshi import HTML
 from genshi.template import NewTextTemplate, MarkupTemplate, TemplateLoader
 from trac.config import BoolOption, ListOption
-from trac.core import implements
+from trac.core import Component, ExtensionPoint, implements
 from trac.resource import Resource
 from trac.test import Mock, MockPerm
 from trac.ticket.api import TicketSystem
@@ -28,6 +28,7 @@ from trac.wiki.model import WikiPage
 
 from announcer.api import _, IAnnouncementFormatter
 from announcer.pref import AnnouncerTemplateProvider
+from announcer.util import get_target_id
 
 
 def diff_cleanup(gen):
@@ -278,12 +279,17 @@ class WikiFormatter(AnnouncerTemplateProvider):
             project_desc=self.env.project_description,
             project_link=self.env.project_url or self.env.abs_href(),
         )
-        old_page = WikiPage(self.env, page.name, page.version - 1)
+        # Coalesced events cover the changes since an older version.
+        since_version = getattr(event, 'old_version', None)
+        old_version = page.version - 1 if since_version is None \
+                      else since_version
+        old_page = WikiPage(self.env, page.name, old_version)
         if page.version:
             data['changed'] = True
             data['diff_link'] = self.env.abs_href('wiki', page.name,
                                                   action='diff',
-                                                  version=page.version)
+                                                  version=page.version,
+                                                  old_version=since_version)
             if self.wiki_email_diff:
                 # DEVEL: Formatter needs req object to get preferred language.
                 diff_header = _("""
@@ -297,7 +303,7 @@ Index: %(name)s
                 diff += diff_header % {
                     'name': page.name,
                     'version': page.version,
-                    'oldversion': page.version - 1
+                    'oldversion': old_version
                 }
                 for line in unified_diff(old_page.text.splitlines(),
                                          page.text.splitlines(), context=3):
@@ -313,3 +319,42 @@ Index: %(name)s
         if template:
             stream = template.generate(**data)
             return stream.render('text')
+
+
+class DigestFormatter(Component):
+    """Formats digests of several events as plain text, using the
+    formatters of the bundled events' realms.
+    """
+
+    implements(IAnnouncementFormatter)
+
+    formatters = ExtensionPoint(IAnnouncementFormatter)
+
+    def styles(self, transport, realm):
+        if realm == 'digest':
+            yield 'text/plain'
+
+    def alternative_style_for(self, transport, realm, style):
+        if realm == 'digest' and style != 'text/plain':
+            return 'text/plain'
+
+    def format(self, transport, realm, style, event):
+        if realm != 'digest' or style != 'text/plain':
+            return
+        sections = []
+        for evt in event.events:
+            for formatter in self.formatters:
+                if formatter is self or 'text/plain' not in \
+                        formatter.styles(transport, evt.realm):
+                    continue
+                output = formatter.format(transport, evt.realm,
+                                          'text/plain', evt)
+                if output:
+                    title = '%s %s %s' % (evt.realm.capitalize(),
+                                          get_target_id(evt.target),
+                                          evt.category)
+                    sections.append('%s\n%s\n\n%s'
+                                    % (title, '=' * len(title),
+                                       to_unicode(output)))
+                    break
+        return ('\n\n%s\n\n' % ('-' * 78)).join(sections)
@@ -14,9 +14,90 @@
 # checking for unauthenticated users should be done against the 'anonymous'
 # user.
 
+from trac.cache import cached
+from trac.core import Component
 from trac.util.datefmt import datetime_now, to_utimestamp, utc
 
-__all__ = ['Subscription', 'SubscriptionAttribute']
+__all__ = ['Subscription', 'SubscriptionAttribute', 'SubscriptionCache']
+
+
+class SubscriptionCache(Component):
+    """In-process cache of the `subscription` and `subscription_attribute`
+    tables, indexed for the lookups done by the subscribers.
+
+    The `find_*` methods of `Subscription` and `SubscriptionAttribute` are
+    answered from the cache, unless they get an explicit `db` argument.
+    All changes done through these classes invalidate the cache, in other
+    processes using the same environment too.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._loads = 0
+
+    @cached
+    def _index(self):
+        self._loads += 1
+        index = dict((name, {}) for name in (
+            'sub_class', 'sub_sid_class', 'sub_sid_distributor',
+            'attr_sid_class', 'attr_class_realm', 'attr_class_realm_target'))
+        for row in self.env.db_query("""
+                SELECT id,sid,authenticated,distributor,
+                       format,priority,adverb,class
+                  FROM subscription
+                 ORDER BY priority,id
+                """):
+            id, sid, authenticated, distributor, format, priority, adverb, \
+                klass = row
+            row = (id, sid, int(authenticated or 0), distributor, format,
+                   int(priority), adverb, klass)
+            index['sub_class'].setdefault(klass, []).append(row)
+            index['sub_sid_class'].setdefault(
+                (sid, row[2], klass), []).append(row)
+            index['sub_sid_distributor'].setdefault(
+                (sid, row[2], distributor), []).append(row)
+        for row in self.env.db_query("""
+                SELECT id,sid,authenticated,class,realm,target
+                  FROM subscription_attribute
+                 ORDER BY target,id
+                """):
+            id, sid, authenticated, klass, realm, target = row
+            row = (id, sid, int(authenticated or 0), klass, realm, target)
+            index['attr_sid_class'].setdefault(
+                (sid, row[2], klass), []).append(row)
+            index['attr_class_realm'].setdefault(
+                (klass, realm), []).append(row)
+            index['attr_class_realm_target'].setdefault(
+                (klass, realm, target), []).append(row)
+        return index
+
+    def lookup(self, name, key):
+        """Return the cached rows for `key` in the index `name`."""
+        loads = self._loads
+        index = self._index
+        if self._loads == loads:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return index[name].get(key, [])
+
+    def invalidate(self):
+        del self._index
+
+    def stats(self):
+        """Return a dict with the number of cache hits and misses and of
+        the cached rows.
+        """
+        index = self._index
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'subscriptions': sum(len(rows) for rows
+                                 in index['sub_class'].itervalues()),
+            'attributes': sum(len(rows) for rows
+                              in index['attr_sid_class'].itervalues()),
+        }
 
 
 class Subscription(object):
@@ -38,6 +119,14 @@ class Subscription(object):
             raise KeyError(name)
         self.values[name] = value
 
+    @classmethod
+    def _from_row(cls, env, row):
+        sub = Subscription(env)
+        for field, value in zip(cls.fields, row):
+            sub[field] = value
+        sub['priority'] = int(sub['priority'])
+        return sub
+
     @classmethod
     def add(cls, env, subscription, db=None):
         """ID and priority get overwritten."""
@@ -57,6 +146,7 @@ class Subscription(object):
                   subscription['authenticated'], subscription['distributor'],
                   subscription['format'], int(priority),
                   subscription['adverb'], subscription['class']))
+            SubscriptionCache(env).invalidate()
 
     @classmethod
     def delete(cls, env, rule_id, db=None):
@@ -79,6 +169,7 @@ class Subscription(object):
                 s['priority'] = i
                 s.update_priority(db)
                 i += 1
+            SubscriptionCache(env).invalidate()
 
     @classmethod
     def move(cls, env, rule_id, priority, db=None):
@@ -109,6 +200,7 @@ class Subscription(object):
                     s['priority'] = i
                     s.update_priority(db)
                 i += 1
+            SubscriptionCache(env).invalidate()
 
     @classmethod
     def update_format_by_distributor_and_sid(cls, env, distributor, sid,
@@ -123,10 +215,16 @@ class Subscription(object):
                    AND sid=%s
                    AND authenticated=%s
             """, (format, distributor, sid, int(authenticated)))
+            SubscriptionCache(env).invalidate()
 
     @classmethod
     def find_by_sid_and_distributor(cls, env, sid, authenticated, distributor,
                                     db=None):
+        if db is None:
+            return [cls._from_row(env, row) for row in
+                    SubscriptionCache(env).lookup(
+                        'sub_sid_distributor',
+                        (sid, int(authenticated), distributor))]
         subs = []
 
         with env.db_query as db:
@@ -157,6 +255,11 @@ class Subscription(object):
     @classmethod
     def find_by_sids_and_class(cls, env, uids, klass, db=None):
         """uids should be a collection to tuples (sid, auth)"""
+        if db is None:
+            cache = SubscriptionCache(env)
+            return [cls._from_row(env, row) for sid, authenticated in uids
+                    for row in cache.lookup(
+                        'sub_sid_class', (sid, int(authenticated), klass))]
         if not uids:
             return []
 
@@ -189,6 +292,9 @@ class Subscription(object):
 
     @classmethod
     def find_by_class(cls, env, klass, db=None):
+        if db is None:
+            return [cls._from_row(env, row) for row in
+                    SubscriptionCache(env).lookup('sub_class', klass)]
         subs = []
 
         with env.db_query as db:
@@ -236,6 +342,7 @@ class Subscription(object):
                        priority=%s
                  WHERE id=%s
             """, (now, int(self.values['priority']), self.values['id']))
+            SubscriptionCache(self.env).invalidate()
 
 
 class SubscriptionAttribute(object):
@@ -256,6 +363,13 @@ class SubscriptionAttribute(object):
             raise KeyError(name)
         self.values[name] = value
 
+    @classmethod
+    def _from_row(cls, env, row):
+        attr = SubscriptionAttribute(env)
+        for field, value in zip(cls.fields, row):
+            attr[field] = value
+        return attr
+
     @classmethod
     def add(cls, env, sid, authenticated, klass, realm, attributes, db=None):
         """id and priority overwritten."""
@@ -268,6 +382,7 @@ class SubscriptionAttribute(object):
                            (sid,authenticated,class,realm,target)
                     VALUES (%s,%s,%s,%s,%s)
                 """, (sid, int(authenticated), klass, realm, a))
+            SubscriptionCache(env).invalidate()
 
     @classmethod
     def delete(cls, env, attribute_id, db=None):
@@ -278,6 +393,7 @@ class SubscriptionAttribute(object):
                 DELETE FROM subscription_attribute
                  WHERE id=%s
              """, (attribute_id,))
+            SubscriptionCache(env).invalidate()
 
     @classmethod
     def delete_by_sid_and_class(cls, env, sid, authenticated, klass, db=None):
@@ -290,6 +406,7 @@ class SubscriptionAttribute(object):
                    AND authenticated=%s
                    AND class=%s
             """, (sid, int(authenticated), klass))
+            SubscriptionCache(env).invalidate()
 
     @classmethod
     def delete_by_sid_class_and_target(cls, env, sid, authenticated, klass,
@@ -304,6 +421,7 @@ class SubscriptionAttribute(object):
                    AND class=%s
                    AND target=%s
             """, (sid, int(authenticated), klass, target))
+            SubscriptionCache(env).invalidate()
 
     @classmethod
     def delete_by_class_realm_and_target(cls, env, klass, realm, target,
@@ -317,9 +435,14 @@ class SubscriptionAttribute(object):
                    AND class=%s
                    AND target=%s
             """, (realm, klass, target))
+            SubscriptionCache(env).invalidate()
 
     @classmethod
     def find_by_sid_and_class(cls, env, sid, authenticated, klass, db=None):
+        if db is None:
+            return [cls._from_row(env, row) for row in
+                    SubscriptionCache(env).lookup(
+                        'attr_sid_class', (sid, int(authenticated), klass))]
         attrs = []
 
         with env.db_query as db:
@@ -347,6 +470,11 @@ class SubscriptionAttribute(object):
     @classmethod
     def find_by_sid_class_and_target(cls, env, sid, authenticated, klass,
                                      target, db=None):
+        if db is None:
+            return [cls._from_row(env, row) for row in
+                    SubscriptionCache(env).lookup(
+                        'attr_sid_class', (sid, int(authenticated), klass))
+                    if row[5] == target]
         attrs = []
 
         with env.db_query as db:
@@ -375,6 +503,11 @@ class SubscriptionAttribute(object):
     @classmethod
     def find_by_sid_class_realm_and_target(cls, env, sid, authenticated,
                                            klass, realm, target, db=None):
+        if db is None:
+            return [cls._from_row(env, row) for row in
+                    SubscriptionCache(env).lookup(
+                        'attr_sid_class', (sid, int(authenticated), klass))
+                    if row[4] == realm and row[5] == target]
         attrs = []
 
         with env.db_query as db:
@@ -404,6 +537,10 @@ class SubscriptionAttribute(object):
     @classmethod
     def find_by_class_realm_and_target(cls, env, klass, realm, target,
                                        db=None):
+        if db is None:
+            return [cls._from_row(env, row) for row in
+                    SubscriptionCache(env).lookup(
+                        'attr_class_realm_target', (klass, realm, target))]
         attrs = []
 
         with env.db_query as db:
@@ -429,6 +566,10 @@ class SubscriptionAttribute(object):
 
     @classmethod
     def find_by_class_and_realm(cls, env, klass, realm, db=None):
+        if db is None:
+            return [cls._from_row(env, row) for row in
+                    SubscriptionCache(env).lookup(
+                        'attr_class_realm', (klass, realm))]
         attrs = []
 
         with env.db_query as db:
@@ -453,7 +594,9 @@ class SubscriptionAttribute(object):
 
     @classmethod
     def change_target(cls, env, klass, realm, target, new_target):
-        env.db_transaction("""
-            UPDATE subscription_attribute SET target=%s
-            WHERE class=%s AND realm=%s AND target=%s
-            """, (new_target, klass, realm, target))
+        with env.db_transaction as db:
+            db("""
+                UPDATE subscription_attribute SET target=%s
+                WHERE class=%s AND realm=%s AND target=%s
+                """, (new_target, klass, realm, target))
+            SubscriptionCache(env).invalidate()
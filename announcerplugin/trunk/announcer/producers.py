@@ -76,6 +76,24 @@ class TicketChangeEvent(AnnouncementEvent):
         if session_id == ticket['reporter']:
             yield 'reporter'
 
+    def coalesce(self, other):
+        if not isinstance(other, TicketChangeEvent) or \
+                self.category not in ('created', 'changed') or \
+                other.category != 'changed' or \
+                self.attachment or other.attachment:
+            return None
+        # Keep the oldest value of each field, and drop fields that were
+        # changed back in the meantime.
+        changes = dict(other.changes)
+        changes.update(self.changes)
+        ticket = other.target
+        changes = dict((field, old_value)
+                       for field, old_value in changes.iteritems()
+                       if (old_value or '') != (ticket[field] or ''))
+        comment = '\n\n'.join(c for c in (self.comment, other.comment) if c)
+        return TicketChangeEvent(self.realm, self.category, ticket,
+                                 comment or None, other.author, changes)
+
 
 class TicketChangeProducer(Component):
 
@@ -114,13 +132,30 @@ class TicketChangeProducer(Component):
 class WikiChangeEvent(AnnouncementEvent):
 
     def __init__(self, realm, category, target, comment=None, author=None,
-                 version=None, timestamp=None, attachment=None):
+                 version=None, timestamp=None, attachment=None,
+                 old_version=None):
         AnnouncementEvent.__init__(self, realm, category, target)
         self.author = author
         self.comment = comment
         self.version = version
         self.timestamp = timestamp
         self.attachment = attachment
+        self.old_version = old_version
+
+    def coalesce(self, other):
+        if not isinstance(other, WikiChangeEvent) or \
+                self.category not in ('created', 'changed') or \
+                other.category != 'changed' or \
+                self.attachment or other.attachment:
+            return None
+        old_version = self.old_version
+        if old_version is None and self.category == 'changed' and \
+                self.version:
+            old_version = self.version - 1
+        comment = '\n\n'.join(c for c in (self.comment, other.comment) if c)
+        return WikiChangeEvent(self.realm, self.category, other.target,
+                               comment or None, other.author, other.version,
+                               other.timestamp, old_version=old_version)
 
 
 class WikiChangeProducer(Component):
@@ -12,13 +12,15 @@ from trac.config import Option
 from trac.core import Component, implements
 from trac.notification.api import IEmailAddressResolver
 
-from announcer.api import _, IAnnouncementPreferenceProvider
+from announcer.api import (
+    _, IAnnouncementAddressBatchResolver, IAnnouncementPreferenceProvider)
+from announcer.util import chunks
 from announcer.util.settings import SubscriptionSetting
 
 
 class DefaultDomainEmailResolver(Component):
 
-    implements(IEmailAddressResolver)
+    implements(IAnnouncementAddressBatchResolver, IEmailAddressResolver)
 
     default_domain = Option('announcer', 'email_default_domain', '',
         """Default host/domain to append to address that do not specify one.
@@ -29,10 +31,16 @@ class DefaultDomainEmailResolver(Component):
             return '%s@%s' % (sid, self.default_domain)
         return None
 
+    def get_addresses_for_sessions(self, sessions):
+        if not self.default_domain:
+            return {}
+        return dict((session, '%s@%s' % (session[0], self.default_domain))
+                    for session in sessions)
+
 
 class SessionEmailResolver(Component):
 
-    implements(IEmailAddressResolver)
+    implements(IAnnouncementAddressBatchResolver, IEmailAddressResolver)
 
     def get_address_for_session(self, sid, authenticated):
         with self.env.db_query as db:
@@ -49,10 +57,25 @@ class SessionEmailResolver(Component):
                 return result[0]
             return None
 
+    def get_addresses_for_sessions(self, sessions):
+        sessions = set((sid, int(authenticated))
+                       for sid, authenticated in sessions)
+        addresses = {}
+        for sids in chunks(set(sid for sid, authenticated in sessions)):
+            for sid, authenticated, value in self.env.db_query("""
+                    SELECT sid,authenticated,value
+                      FROM session_attribute
+                     WHERE name='email' AND value!='' AND sid IN (%s)
+                    """ % ','.join(['%s'] * len(sids)), sids):
+                if (sid, authenticated) in sessions:
+                    addresses[(sid, authenticated)] = value
+        return addresses
+
 
 class SpecifiedEmailResolver(Component):
 
-    implements(IEmailAddressResolver, IAnnouncementPreferenceProvider)
+    implements(IAnnouncementAddressBatchResolver, IEmailAddressResolver,
+               IAnnouncementPreferenceProvider)
 
     def get_address_for_session(self, sid, authenticated):
         with self.env.db_query as db:
@@ -69,6 +92,20 @@ class SpecifiedEmailResolver(Component):
                 return result[0]
             return None
 
+    def get_addresses_for_sessions(self, sessions):
+        # The address is only stored for authenticated sessions.
+        specified = {}
+        for sids in chunks(set(sid for sid, authenticated in sessions)):
+            for sid, value in self.env.db_query("""
+                    SELECT sid,value
+                      FROM session_attribute
+                     WHERE name='announcer_specified_email'
+                       AND authenticated=1 AND value!='' AND sid IN (%s)
+                    """ % ','.join(['%s'] * len(sids)), sids):
+                specified[sid] = value
+        return dict((session, specified[session[0]])
+                    for session in sessions if session[0] in specified)
+
     # IAnnouncementDistributor methods
 
     def get_announcement_preference_boxes(self, req):
@@ -11,12 +11,14 @@
 import unittest
 
 from announcer.opt.tests import test_suite as opt_test_suite
-from announcer.tests import api, filters, formatters, model, pref, subscribers
+from announcer.tests import (
+    api, distributors, filters, formatters, model, pref, subscribers)
 
 
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(api.test_suite())
+    suite.addTest(distributors.test_suite())
     suite.addTest(filters.test_suite())
     suite.addTest(formatters.test_suite())
     suite.addTest(model.test_suite())
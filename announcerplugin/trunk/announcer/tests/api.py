@@ -10,15 +10,28 @@ import shutil
 import tempfile
 import unittest
 
-from trac.core import Component, implements
+from trac.core import Component, ComponentMeta, implements
 from trac.db.api import DatabaseManager
 from trac.db.schema import Table, Column, Index
 from trac.test import EnvironmentStub
 
 from announcer import db_default
 from announcer.api import AnnouncementSystem, AnnouncementEvent
+from announcer.api import IAnnouncementDistributor, IAnnouncementSubscriber
 from announcer.api import IAnnouncementSubscriptionFilter
 from announcer.api import SubscriptionResolver
+from announcer.filters import DefaultPermissionFilter
+
+
+class CountEvent(AnnouncementEvent):
+    """Test event with a counter, combined by adding up the counts."""
+
+    def __init__(self, target, count=1):
+        AnnouncementEvent.__init__(self, 'test', 'changed', target)
+        self.count = count
+
+    def coalesce(self, other):
+        return CountEvent(self.target, self.count + other.count)
 
 
 class AnnouncementEventTestCase(unittest.TestCase):
@@ -64,6 +77,7 @@ class AnnouncementSystemSetupTestCase(unittest.TestCase):
             db("DROP TABLE IF EXISTS subscriptions")
             db("DROP TABLE IF EXISTS subscription")
             db("DROP TABLE IF EXISTS subscription_attribute")
+            db("DROP TABLE IF EXISTS announcement_queue")
             db("DELETE FROM system WHERE name='announcer_version'")
 
             if schema:
@@ -488,14 +502,57 @@ class SubscriptionResolverTestCase(unittest.TestCase):
 
 class AnnouncementSystemSendTestCase(unittest.TestCase):
     def setUp(self):
+        # Defined here and deregistered in tearDown() so they take no
+        # part in the other environments enabling 'announcer.*'.
+        class TestSubscriber(Component):
+            """Subscribes 'user' to all test events, and 'other' to
+            target 'b'."""
+
+            implements(IAnnouncementSubscriber)
+
+            def matches(self, event):
+                if event.realm == 'test':
+                    yield ('TestSubscriber', 'test', 'user', 1, None,
+                           'text/plain', 1, 'always')
+                    if event.target == 'b':
+                        yield ('TestSubscriber', 'test', 'other', 1, None,
+                               'text/plain', 1, 'always')
+
+            def description(self):
+                return 'test subscriber'
+
+            def requires_authentication(self):
+                return False
+
+        class TestDistributor(Component):
+            """Records the distributed events."""
+
+            implements(IAnnouncementDistributor)
+
+            def __init__(self):
+                self.sent = []
+
+            def transports(self):
+                yield 'test'
+
+            def distribute(self, transport, recipients, event):
+                self.sent.append((event, sorted(r[0] for r in recipients)))
+
+        self.components = (TestSubscriber, TestDistributor)
         self.env = EnvironmentStub(enable=['trac.*', 'announcer.*'])
         self.env.path = tempfile.mkdtemp()
         self.db_mgr = DatabaseManager(self.env)
         self.an_sys = AnnouncementSystem(self.env)
+        self.an_sys.upgrade_environment()
+        # Test events have no resource permissions to check.
+        self.env.disable_component(DefaultPermissionFilter)
+        self.sent = TestDistributor(self.env).sent
 
     def tearDown(self):
         self.env.shutdown()
         shutil.rmtree(self.env.path)
+        for component in self.components:
+            ComponentMeta.deregister(component)
 
     def test_filter_added(self):
 
@@ -510,6 +567,49 @@ class AnnouncementSystemSendTestCase(unittest.TestCase):
         dummy = DummySubscriptionFilter(self.env)
         self.assertTrue(dummy in self.an_sys.subscription_filters)
 
+    def test_send_immediate(self):
+        sent = self.sent
+        self.an_sys.send(CountEvent('a'))
+        self.assertEqual(1, len(sent))
+        self.assertEqual(['user'], sent[0][1])
+        self.assertEqual(1, self.an_sys.timings['resolve'][0])
+        self.assertEqual(1, self.an_sys.timings['distribute'][0])
+
+    def test_coalesce(self):
+        self.env.config.set('announcer', 'delivery_mode', 'coalesce')
+        sent = self.sent
+        for target in ('a', 'b', 'a', 'a'):
+            self.an_sys.send(CountEvent(target))
+        self.assertEqual([], sent)
+        self.assertEqual(4, len(self.an_sys._spool))
+        self.an_sys.flush()
+        self.assertEqual([('a', 3, ['user']), ('b', 1, ['other', 'user'])],
+                         [(evt.target, evt.count, recipients)
+                          for evt, recipients in sent])
+        self.assertEqual([], self.an_sys._spool)
+
+    def test_coalesce_keeps_uncombined_events(self):
+        events = [AnnouncementEvent('test', 'changed', 'a'),
+                  AnnouncementEvent('test', 'deleted', 'a')]
+        self.assertEqual(events, self.an_sys.coalesce(events))
+
+    def test_digest(self):
+        self.env.config.set('announcer', 'delivery_mode', 'digest')
+        for target in ('a', 'b', 'a'):
+            self.an_sys.send(CountEvent(target))
+        self.an_sys.flush()
+        sent = sorted(self.sent, key=lambda s: s[1])
+        # 'other' only gets 'b', 'user' a digest of the events for 'a' and
+        # 'b'.
+        self.assertEqual(2, len(sent))
+        self.assertEqual('b', sent[0][0].target)
+        self.assertEqual(['other'], sent[0][1])
+        self.assertEqual('digest', sent[1][0].realm)
+        self.assertEqual([('a', 2), ('b', 1)],
+                         [(evt.target, evt.count)
+                          for evt in sent[1][0].events])
+        self.assertEqual(['user'], sent[1][1])
+
 
 def test_suite():
     suite = unittest.TestSuite()
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, Steffen Hoffmann
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import asyncore
+import shutil
+import smtpd
+import smtplib
+import tempfile
+import threading
+import unittest
+
+from trac.db.api import DatabaseManager
+from trac.test import EnvironmentStub
+from trac.util.datefmt import datetime_now, to_utimestamp, utc
+
+from announcer.api import AnnouncementEvent, AnnouncementSystem
+from announcer.distributors.mail import DeliveryQueue, EmailDistributor
+from announcer.model import Subscription
+from announcer.resolvers import SpecifiedEmailResolver
+from announcer.upgrades import db7
+
+
+class SMTPServerStub(smtpd.SMTPServer):
+    """Local SMTP server recording connections and received messages."""
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+
+class DeliveryQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'announcer.*'])
+        self.env.path = tempfile.mkdtemp()
+        with self.env.db_transaction as db:
+            connector = DatabaseManager(self.env).get_connector()[0]
+            for table in db7.schema:
+                for stmt in connector.to_sql(table):
+                    db(stmt)
+        self.server = SMTPServerStub()
+        self.thread = threading.Thread(target=asyncore.loop,
+                                       kwargs={'timeout': 0.1})
+        self.thread.daemon = True
+        self.thread.start()
+        self.env.config.set('notification', 'smtp_server', '127.0.0.1')
+        self.env.config.set('notification', 'smtp_port', self.server.port)
+        self.distributor = EmailDistributor(self.env)
+        self.queue = DeliveryQueue(self.env, self.distributor.send_many,
+                                   batch_size=10, max_attempts=2,
+                                   retry_delay=60)
+
+    def tearDown(self):
+        self.server.close()
+        self.thread.join()
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    def _put(self, count):
+        for idx in range(count):
+            self.queue.put('trac@example.org', ['user%d@example.org' % idx],
+                           'Subject: Test %d\n\nBody %d\n' % (idx, idx))
+
+    def _make_due(self):
+        now = to_utimestamp(datetime_now(utc))
+        self.env.db_transaction("""
+            UPDATE announcement_queue SET next_attempt=%s
+             WHERE next_attempt IS NOT NULL
+            """, (now,))
+
+    def test_put(self):
+        self._put(3)
+        self.assertEqual((3, 0, 0), self.queue.depth())
+
+    def test_batched_delivery(self):
+        self._put(15)
+        self.assertEqual(15, self.queue.process())
+        self.assertEqual((0, 0, 0), self.queue.depth())
+        self.assertEqual(15, len(self.server.messages))
+        # One connection per batch of ten messages.
+        self.assertEqual(2, self.server.connections)
+        self.assertEqual(['user0@example.org'], self.server.messages[0][1])
+        self.assertIn('Body 0', self.server.messages[0][2])
+
+    def test_reconnect(self):
+        sendmail = smtplib.SMTP.sendmail
+        calls = []
+
+        def drop_third(server, *args):
+            calls.append(args)
+            if len(calls) == 3:
+                server.close()
+                raise smtplib.SMTPServerDisconnected('dropped')
+            return sendmail(server, *args)
+
+        self._put(5)
+        smtplib.SMTP.sendmail = drop_third
+        try:
+            self.assertEqual(5, self.queue.process())
+        finally:
+            smtplib.SMTP.sendmail = sendmail
+        self.assertEqual((0, 0, 0), self.queue.depth())
+        self.assertEqual(5, len(self.server.messages))
+        self.assertEqual(2, self.server.connections)
+
+    def test_claim(self):
+        self._put(3)
+        self.assertEqual(2, len(self.queue.claim(2)))
+        self.assertEqual(1, len(self.queue.claim(2)))
+        self.assertEqual([], self.queue.claim(2))
+
+    def test_retry_and_fail(self):
+        self._put(1)
+        self.server.close()
+        self.assertEqual(0, self.queue.process())
+        self.assertEqual((0, 1, 0), self.queue.depth())
+        # Not due again before the retry delay passed.
+        self.assertEqual([], self.queue.claim(10))
+        self._make_due()
+        self.assertEqual(0, self.queue.process())
+        self.assertEqual((0, 0, 1), self.queue.depth())
+        failed = self.queue.failed_messages()
+        self.assertEqual(1, len(failed))
+        self.assertEqual(2, failed[0][2])
+
+        self.assertEqual(1, self.queue.retry_failed())
+        self.assertEqual((1, 0, 0), self.queue.depth())
+
+
+class EmailDistributorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'announcer.*'])
+        self.env.path = tempfile.mkdtemp()
+        AnnouncementSystem(self.env).upgrade_environment()
+        self.env.config.set('announcer', 'email_default_domain',
+                            'example.org')
+        self.distributor = EmailDistributor(self.env)
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO session_attribute (sid,authenticated,name,value)
+                VALUES (%s,%s,%s,%s)
+                """, [('user1', 1, 'email', 'user1@example.com'),
+                      ('user2', 1, 'email', 'user2@example.com'),
+                      ('user2', 1, 'announcer_specified_email',
+                       'specified@example.com'),
+                      ('anon', 0, 'email', 'anon@example.com'),
+                      ('empty', 1, 'email', '')])
+        for sid, format, priority in [('user1', 'text/html', 1),
+                                      ('user1', 'text/plain', 2),
+                                      ('user2', 'text/plain', 1)]:
+            sub = Subscription(self.env)
+            sub['sid'] = sid
+            sub['authenticated'] = 1
+            sub['distributor'] = 'email'
+            sub['format'] = format
+            sub['priority'] = priority
+            sub['adverb'] = 'always'
+            sub['class'] = 'GeneralWikiSubscriber'
+            Subscription.add(self.env, sub)
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    def test_get_addresses(self):
+        addresses = self.distributor._get_addresses(
+            set([('user1', 1), ('user2', 1), ('anon', 0), ('anon', 1),
+                 ('empty', 1)]))
+        self.assertEqual({
+            ('user1', 1): 'user1@example.com',
+            ('user2', 1): 'specified@example.com',
+            ('anon', 0): 'anon@example.com',
+            ('anon', 1): 'anon@example.org',
+            ('empty', 1): 'empty@example.org',
+        }, dict((session, address)
+                for session, (address, resolver) in addresses.items()))
+        self.assertIsInstance(addresses[('user2', 1)][1],
+                              SpecifiedEmailResolver)
+
+    def test_get_preferred_formats(self):
+        formats = self.distributor._get_preferred_formats(
+            set([('user1', 1), ('user2', 1), ('anon', 0)]))
+        self.assertEqual({('user1', 1): 'text/html',
+                          ('user2', 1): 'text/plain'}, formats)
+
+    def test_no_delivery_threads_on_init(self):
+        env = EnvironmentStub(enable=['trac.*', 'announcer.*'])
+        env.config.set('announcer', 'use_threaded_delivery', 'true')
+        distributor = EmailDistributor(env)
+        self.assertIsNone(distributor.delivery_queue)
+
+    def test_format_memo(self):
+        calls = []
+
+        class Formatter(object):
+            def format(self, transport, realm, style, event):
+                calls.append(style)
+                return u'body'
+
+        event = AnnouncementEvent('wiki', 'changed', 'WikiStart')
+        outputs = {}
+        for style in ('text/plain', 'text/plain', 'text/html'):
+            self.assertEqual(u'body', self.distributor._format(
+                outputs, Formatter(), 'email', event, style))
+        self.assertEqual(['text/plain', 'text/html'], calls)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(DeliveryQueueTestCase))
+    suite.addTest(unittest.makeSuite(EmailDistributorTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -14,7 +14,8 @@ from trac.db.api import DatabaseManager
 from trac.test import EnvironmentStub
 
 from announcer.api import AnnouncementSystem
-from announcer.model import Subscription, SubscriptionAttribute
+from announcer.model import (
+    Subscription, SubscriptionAttribute, SubscriptionCache)
 
 
 class SubscriptionTestSetup(unittest.TestCase):
@@ -150,10 +151,89 @@ class SubscriptionAttributeTestCase(SubscriptionTestSetup):
         # def test_find_by_class_and_realm(self):
 
 
+class SubscriptionCacheTestCase(SubscriptionTestSetup):
+    def setUp(self):
+        SubscriptionTestSetup.setUp(self)
+        self.cache = SubscriptionCache(self.env)
+        for sid, klass in [('user', 'GeneralWikiSubscriber'),
+                           ('user', 'TicketComponentSubscriber'),
+                           ('other', 'GeneralWikiSubscriber')]:
+            sub = Subscription(self.env)
+            sub['sid'] = sid
+            sub['authenticated'] = 1
+            sub['distributor'] = 'email'
+            sub['format'] = 'text/plain'
+            sub['adverb'] = 'always'
+            sub['class'] = klass
+            Subscription.add(self.env, sub)
+        SubscriptionAttribute.add(self.env, 'user', 1,
+                                  'GeneralWikiSubscriber', 'wiki',
+                                  ('WikiStart', 'TracWiki'))
+
+    def _compare(self, cached, uncached):
+        self.assertEqual([x.values for x in uncached],
+                         [x.values for x in cached])
+
+    def test_find_matches_db(self):
+        # Passing a db bypasses the cache.
+        db = self.env.db_query
+        for args in [('user', 1, 'email'), ('other', 1, 'email'),
+                     ('nobody', 0, 'email')]:
+            self._compare(
+                Subscription.find_by_sid_and_distributor(self.env, *args),
+                Subscription.find_by_sid_and_distributor(self.env, *args,
+                                                         db=db))
+        uids = [('user', 1), ('other', 1), ('user', 0)]
+        self._compare(
+            Subscription.find_by_sids_and_class(
+                self.env, uids, 'GeneralWikiSubscriber'),
+            Subscription.find_by_sids_and_class(
+                self.env, uids, 'GeneralWikiSubscriber', db=db))
+        self.assertEqual(2, len(Subscription.find_by_class(
+            self.env, 'GeneralWikiSubscriber')))
+        self._compare(
+            SubscriptionAttribute.find_by_sid_and_class(
+                self.env, 'user', 1, 'GeneralWikiSubscriber'),
+            SubscriptionAttribute.find_by_sid_and_class(
+                self.env, 'user', 1, 'GeneralWikiSubscriber', db=db))
+        self._compare(
+            SubscriptionAttribute.find_by_class_realm_and_target(
+                self.env, 'GeneralWikiSubscriber', 'wiki', 'TracWiki'),
+            SubscriptionAttribute.find_by_class_realm_and_target(
+                self.env, 'GeneralWikiSubscriber', 'wiki', 'TracWiki',
+                db=db))
+        self.assertEqual(1, len(
+            SubscriptionAttribute.find_by_sid_class_realm_and_target(
+                self.env, 'user', 1, 'GeneralWikiSubscriber', 'wiki',
+                'WikiStart')))
+        self.assertEqual(2, len(SubscriptionAttribute.find_by_class_and_realm(
+            self.env, 'GeneralWikiSubscriber', 'wiki')))
+
+    def test_hits_and_invalidation(self):
+        Subscription.find_by_class(self.env, 'GeneralWikiSubscriber')
+        misses = self.cache.misses
+        hits = self.cache.hits
+        Subscription.find_by_class(self.env, 'GeneralWikiSubscriber')
+        SubscriptionAttribute.find_by_class_and_realm(
+            self.env, 'GeneralWikiSubscriber', 'wiki')
+        self.assertEqual(hits + 2, self.cache.hits)
+        self.assertEqual(misses, self.cache.misses)
+
+        SubscriptionAttribute.delete_by_sid_and_class(
+            self.env, 'user', 1, 'GeneralWikiSubscriber')
+        self.assertEqual([], SubscriptionAttribute.find_by_class_and_realm(
+            self.env, 'GeneralWikiSubscriber', 'wiki'))
+        self.assertEqual(misses + 1, self.cache.misses)
+        self.assertEqual({'hits': hits + 2, 'misses': misses + 1,
+                          'subscriptions': 3, 'attributes': 0},
+                         self.cache.stats())
+
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(SubscriptionTestCase))
     suite.addTest(unittest.makeSuite(SubscriptionAttributeTestCase))
+    suite.addTest(unittest.makeSuite(SubscriptionCacheTestCase))
     return suite
 
 
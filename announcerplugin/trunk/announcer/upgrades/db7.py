@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008, Stephen Hansen
+# Copyright (c) 2009, Robert Corsaro
+# Copyright (c) 2010-2012, Steffen Hoffmann
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+from trac.db.api import DatabaseManager
+from trac.db.schema import Column, Index, Table
+
+schema = [
+    Table('announcement_queue', key='id')[
+        Column('id', auto_increment=True),
+        Column('time', type='int64'),
+        Column('next_attempt', type='int64'),
+        Column('attempts', type='int'),
+        Column('from_addr'),
+        Column('recipients'),
+        Column('message'),
+        Column('last_error'),
+        Index(['next_attempt'])
+    ]
+]
+
+
+def do_upgrade(env, ver, cursor):
+    """Add `announcement_queue` db table for the persistent email delivery
+    queue.
+    """
+    connector = DatabaseManager(env).get_connector()[0]
+    for table in schema:
+        for stmt in connector.to_sql(table):
+            cursor.execute(stmt)
@@ -17,3 +17,12 @@ def get_target_id(target):
         return target.name
     # Last resort: just stringify.
     return str(target)
+
+
+def chunks(items, size=500):
+    """Split `items` into lists of at most `size` elements, i.e. for
+    keeping the number of parameters in `IN (...)` clauses in bounds.
+    """
+    items = list(items)
+    for idx in range(0, len(items), size):
+        yield items[idx:idx + size]
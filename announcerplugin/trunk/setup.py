@@ -61,6 +61,7 @@ setup(
     },
     entry_points={
         'trac.plugins': [
+            'announcer.admin = announcer.admin',
             'announcer.api = announcer.api',
             'announcer.distributors.mail = announcer.distributors.mail',
             'announcer.distributors.xmppd = announcer.distributors.xmppd[xmpp]',
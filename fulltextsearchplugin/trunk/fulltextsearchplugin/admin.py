@@ -93,9 +93,11 @@ class FullTextSearchAdmin(Component):
         fts = FullTextSearch(self.env)
         realms = realm and [realm] or fts.index_realms
         fields = ['realm', 'id']
-        query, response = fts._do_search('*', realms, sort_by=fields,
+        si = fts.backend.acquire()
+        query, response = fts._do_search(si, '*', realms, sort_by=fields,
                                          field_limit=fields)
-        rows = ((doc['realm'], doc['id']) for doc in fts._docs(query))
+        rows = [(doc['realm'], doc['id']) for doc in fts._docs(query)]
+        fts.backend.release(si)
         print_table(rows, (_("Realm"), _("Id")))
 
     def _do_optimize(self):
@@ -1,10 +1,13 @@
-from Queue import Queue
+from Queue import Empty, Full, Queue
+from collections import deque
 import os
 from datetime import datetime
+from itertools import groupby
 import operator
 import re
 import sunburnt
 from sunburnt.sunburnt import grouper
+import threading
 import types
 
 from trac.env import IEnvironmentSetupParticipant
@@ -26,6 +29,7 @@ from trac.resource import (get_resource_shortname, get_resource_url,
                            Resource, ResourceNotFound)
 from trac.search import ISearchSource, shorten_result
 from trac.util.translation import _
+from trac.config import BoolOption
 from trac.config import IntOption
 from trac.config import ListOption
 from trac.config import Option
@@ -129,100 +133,287 @@ class FullTextSearchObject(object):
 
 
 class Backend(Queue):
-    """
+    """Queue of documents going to Solr.
+
+    Documents are sent when `batch_size` documents are pending, or
+    `flush_interval` seconds after the first pending document was queued.
+    Documents with a file body are sent immediately, since the caller
+    closes the file. Documents which could not be sent, e.g. because Solr
+    is down, are kept in a retry queue of at most `retry_queue_size`
+    documents and are sent again with the next batch.
+
+    Connections to Solr are reused, at most `pool_size` idle connections
+    are kept.
+
+    A thread may queue documents in a batch of its own between
+    `start_batch()` and `end_batch()`, sent every `size` documents
+    regardless of `batch_size`.
     """
 
-    def __init__(self, solr_endpoint, log, si_class=sunburnt.SolrInterface):
+    def __init__(self, solr_endpoint, log, si_class=sunburnt.SolrInterface,
+                 batch_size=1, flush_interval=0, soft_commit=False,
+                 pool_size=4, retry_queue_size=1000):
         Queue.__init__(self)
         self.log = log
         self.solr_endpoint = solr_endpoint
         self.si_class = si_class
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.soft_commit = soft_commit
+        self.retry_queue_size = retry_queue_size
+        self._pool = Queue(pool_size)
+        self._retry = deque()
+        self._flush_lock = threading.RLock()
+        self._timer = None
+        self._local = threading.local()
 
     def create(self, item, quiet=False):
         item.action = 'CREATE'
-        self.put(item)
-        self.commit(quiet=quiet)
+        self._enqueue(item, quiet)
+        self._flush_pending(quiet, hasattr(item.body, 'read'))
 
     def modify(self, item, quiet=False):
         item.action = 'MODIFY'
-        self.put(item)
-        self.commit(quiet=quiet)
+        self._enqueue(item, quiet)
+        self._flush_pending(quiet, hasattr(item.body, 'read'))
 
     def delete(self, item, quiet=False):
         item.action = 'DELETE'
-        self.put(item)
-        self.commit(quiet=quiet)
+        self._enqueue(item, quiet)
+        self._flush_pending(quiet)
 
     def add(self, item, quiet=False):
         if isinstance(item, list):
             for i in item:
-                self.put(i)
+                self._enqueue(i, quiet)
+            has_file = any(hasattr(i.body, 'read') for i in item)
         else:
-            self.put(item)
-        self.commit(quiet=quiet)
+            self._enqueue(item, quiet)
+            has_file = hasattr(item.body, 'read')
+        self._flush_pending(quiet, has_file)
+
+    def start_batch(self, size):
+        """Queue the documents of the current thread in a batch of their
+        own, sent every `size` documents, until `end_batch()`."""
+        self._local.batch = _Batch(size)
+
+    def end_batch(self, quiet=False):
+        """Send the rest of the current thread's batch, along with the
+        pending documents and the retry queue."""
+        batch = self._local.batch
+        try:
+            self._flush_batch(batch, quiet)
+        finally:
+            del self._local.batch
+        self.commit(quiet)
+
+    def when_sent(self, callback):
+        """Call `callback` once the documents queued so far by the
+        current thread have been sent, or now outside of a batch.
+
+        Callbacks of documents which could not be sent are dropped.
+        """
+        batch = getattr(self._local, 'batch', None)
+        if batch is None:
+            callback()
+        elif batch.items:
+            batch.callbacks.append(callback)
+        elif batch.sent:
+            # The documents were sent at once, e.g. file bodies
+            callback()
 
     def remove(self, project_id, realms=None):
         '''Delete docs from index where project=project_id AND realm in realms
 
         If realms is not specified then delete all documents in project_id.
         '''
-        s = self.si_class(self.solr_endpoint)
+        self.commit()
+        s = self.acquire()
         Q = s.query().Q
-        q = s.query(u'project:%s' % project_id)
+        query = s.query(u'project:%s' % project_id)
         if realms:
-            query = q.query(reduce(operator.or_,
-                                   [Q(u'realm:%s' % realm)
-                                    for realm in realms]))
+            query = query.query(reduce(operator.or_,
+                                       [Q(u'realm:%s' % realm)
+                                        for realm in realms]))
         # I would have like some more info back
         s.delete(queries=[query])
-        s.commit()
+        self._commit(s)
+        self.release(s)
 
     def commit(self, quiet=False):
+        """Send the pending documents and the retry queue to Solr."""
+        self._flush_lock.acquire()
         try:
-            s = self.si_class(self.solr_endpoint)
-        except Exception, e:
-            if quiet:
-                self.log.error("Could not commit to Solr due to: %s", e)
-                return
-            else:
-                raise
-        while not self.empty():
-            item = self.get()
-            if item.action in ('CREATE', 'MODIFY'):
-                if hasattr(item.body, 'read'):
-                    try:
-                        s.add(item, extract=True, filename=item.id)
-                    except sunburnt.SolrError, e:
-                        response, content = e.args
-                        self.log.error("Encountered a Solr error "
-                                       "indexing '%s'. "
-                                       "Solr returned: %s %s",
-                                       item, response, content)
-                else:
-                    s.add(item) #We can add multiple documents if we want
-            elif item.action == 'DELETE':
-                s.delete(item)
-            else:
-                if quiet:
-                    self.log.error("Unknown Solr action %s on %s",
-                                   item.action, item)
-                else:
-                    raise ValueError("Unknown Solr action %s on %s"
-                                     % (item.action, item))
-            try:
-                s.commit()
-            except Exception, e:
-                self.log.exception('%s %r', item, item)
-                if not quiet:
-                    raise
+            self._cancel_timer()
+            items = list(self._retry)
+            self._retry.clear()
+            while not self.empty():
+                items.append(self.get())
+            if items:
+                return self._send(items, quiet)
+            return True
+        finally:
+            self._flush_lock.release()
 
     def optimize(self):
-        s = self.si_class(self.solr_endpoint)
+        s = self.acquire()
         try:
             s.optimize()
         except Exception:
             self.log.exception("Error optimizing %s", self.solr_endpoint)
             raise
+        self.release(s)
+
+    def acquire(self):
+        """Return an idle connection to Solr, or a new one."""
+        try:
+            return self._pool.get_nowait()
+        except Empty:
+            return self.si_class(self.solr_endpoint)
+
+    def release(self, s):
+        """Return a connection to the pool, for use by `acquire()`."""
+        try:
+            self._pool.put_nowait(s)
+        except Full:
+            pass
+
+    @property
+    def retry_count(self):
+        """Number of documents waiting to be sent again."""
+        return len(self._retry)
+
+    def _enqueue(self, item, quiet):
+        batch = getattr(self._local, 'batch', None)
+        if batch is None:
+            self.put(item)
+            return
+        # A full batch is sent before the next document, rather than
+        # after the last one, so that the callbacks for it are queued
+        if len(batch.items) >= batch.size:
+            self._flush_batch(batch, quiet)
+        batch.items.append(item)
+
+    def _flush_batch(self, batch, quiet):
+        items, callbacks = batch.items, batch.callbacks
+        batch.items, batch.callbacks = [], []
+        batch.sent = not items or self._send(items, quiet)
+        if batch.sent:
+            for callback in callbacks:
+                callback()
+
+    def _flush_pending(self, quiet, force=False):
+        batch = getattr(self._local, 'batch', None)
+        if batch is not None:
+            if force:
+                self._flush_batch(batch, quiet)
+        elif force or self.qsize() >= self.batch_size:
+            self.commit(quiet=quiet)
+        elif self.flush_interval > 0:
+            self._flush_lock.acquire()
+            try:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.flush_interval,
+                                                  self.commit, (True,))
+                    self._timer.setDaemon(True)
+                    self._timer.start()
+            finally:
+                self._flush_lock.release()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _send(self, items, quiet):
+        """Send `items` to Solr, return `False` if they were queued to be
+        sent again instead (when `quiet`)."""
+        try:
+            s = self.acquire()
+        except Exception, e:
+            self._requeue(items)
+            if quiet:
+                self.log.error("Could not commit to Solr due to: %s", e)
+                return False
+            else:
+                raise
+        try:
+            # Consecutive documents with the same action are sent in one
+            # request, so that the order of additions and deletions of the
+            # same document is kept
+            for action, group in groupby(items, lambda item: item.action):
+                group = list(group)
+                if action in ('CREATE', 'MODIFY'):
+                    self._send_add(s, group)
+                elif action == 'DELETE':
+                    s.delete(group)
+                else:
+                    if quiet:
+                        self.log.error("Unknown Solr action %s on %s",
+                                       action, group)
+                    else:
+                        raise ValueError("Unknown Solr action %s on %s"
+                                         % (action, group))
+                items = items[len(group):]
+            self._commit(s)
+        except ValueError:
+            # Raised above for an unknown action, the connection is usable
+            self.release(s)
+            raise
+        except Exception, e:
+            # The connection may be unusable, it isn't returned to the pool
+            self._requeue(items)
+            self.log.error("Could not commit %d documents to Solr due to: "
+                           "%s", len(items), e)
+            if not quiet:
+                raise
+            return False
+        else:
+            self.release(s)
+            return True
+
+    def _send_add(self, s, items):
+        docs = [item for item in items if not hasattr(item.body, 'read')]
+        if docs:
+            s.add(docs) #We can add multiple documents if we want
+        for item in items:
+            if hasattr(item.body, 'read'):
+                try:
+                    s.add(item, extract=True, filename=item.id)
+                except sunburnt.SolrError, e:
+                    response, content = e.args
+                    self.log.error("Encountered a Solr error "
+                                   "indexing '%s'. "
+                                   "Solr returned: %s %s",
+                                   item, response, content)
+
+    def _commit(self, s):
+        if self.soft_commit:
+            s.commit(softCommit=True)
+        else:
+            s.commit()
+
+    def _requeue(self, items):
+        for item in items:
+            if hasattr(item.body, 'read'):
+                # The file is closed by the caller, it can't be sent again
+                self.log.error("Dropping '%s' from Solr queue", item)
+                continue
+            if len(self._retry) >= self.retry_queue_size:
+                dropped = self._retry.popleft()
+                self.log.error("Solr retry queue is full, dropping '%s'",
+                               dropped)
+            self._retry.append(item)
+
+
+class _Batch(object):
+    """Documents queued by one thread, see `Backend.start_batch()`."""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = []
+        self.callbacks = []
+        self.sent = True
 
 
 class FullTextSearch(Component):
@@ -249,10 +440,38 @@ class FullTextSearch(Component):
         doc="""Maximum document size (in bytes) to indexed.
         """)
 
+    batch_size = IntOption("search", "solr_batch_size", 1,
+        doc="""Number of changed documents sent to Solr in one request.
+        """)
+
+    flush_interval = IntOption("search", "solr_flush_interval", 0,
+        doc="""Seconds after which changed documents are sent to Solr,
+        even if fewer than `solr_batch_size` are pending.
+        """)
+
+    soft_commit = BoolOption("search", "solr_soft_commit", False,
+        doc="""Use soft commits, which make documents visible without
+        flushing the index to disk. Requires Solr 4.0 or later.
+        """)
+
+    retry_queue_size = IntOption("search", "solr_retry_queue_size", 1000,
+        doc="""Maximum number of documents kept to be sent again when Solr
+        is unavailable.
+        """)
+
+    index_batch_size = IntOption("search", "solr_index_batch_size", 100,
+        doc="""Number of documents sent to Solr in one request by
+        `trac-admin fulltext index`.
+        """)
+
     #Warning, sunburnt is case sensitive via lxml on xpath searches while solr is not
     #in the default schema fieldType and fieldtype mismatch gives problem
     def __init__(self):
-        self.backend = Backend(self.solr_endpoint, self.log)
+        self.backend = Backend(self.solr_endpoint, self.log,
+                               batch_size=self.batch_size,
+                               flush_interval=self.flush_interval,
+                               soft_commit=self.soft_commit,
+                               retry_queue_size=self.retry_queue_size)
         self.project = os.path.split(self.env.path)[1]
         self._realms = [
             (u'ticket',     u'Tickets',     True,   self._reindex_ticket),
@@ -436,12 +655,18 @@ class FullTextSearch(Component):
         self.log.info("Started indexing realms: %s",
                       self._fmt_realms(realms))
         summary = {}
-        for realm in realms:
-            indexer = self._indexers[realm]
-            num_indexed = indexer(realm, feedback, finish_fb)
-            self.log.debug('Indexed %i resources in realm: "%s"',
-                           num_indexed, realm)
-            summary[realm] = num_indexed
+        # Send the documents in chunks rather than one request per
+        # document.  Resources are marked indexed once their chunk is sent.
+        self.backend.start_batch(max(self.batch_size, self.index_batch_size))
+        try:
+            for realm in realms:
+                indexer = self._indexers[realm]
+                num_indexed = indexer(realm, feedback, finish_fb)
+                self.log.debug('Indexed %i resources in realm: "%s"',
+                               num_indexed, realm)
+                summary[realm] = num_indexed
+        finally:
+            self.backend.end_batch(quiet=True)
         self.log.info("Completed indexing realms: %s",
                       ', '.join('%s (%i)' % (r, summary[r]) for r in realms))
         return summary
@@ -480,7 +705,10 @@ class FullTextSearch(Component):
             return None
 
     def _set_status(self, resource, status):
-        '''Save the index status of a resource'''
+        '''Save the index status of a resource once its document is sent'''
+        self.backend.when_sent(partial(self._save_status, resource, status))
+
+    def _save_status(self, resource, status):
         @self.env.with_transaction()
         def do_update(db):
             cursor = db.cursor()
@@ -747,12 +975,14 @@ class FullTextSearch(Component):
         if not filters:
             return []
         try:
-            query, response = self._do_search(terms, filters)
+            si = self.backend.acquire()
+            query, response = self._do_search(si, terms, filters)
         except Exception, e:
             self.log.error("Couldn't perform Full text search, falling back "
                            "to built-in search sources: %s", e)
             return self._do_fallback(req, terms, filters)
-        docs = (FullTextSearchObject(**doc) for doc in self._docs(query))
+        docs = [FullTextSearchObject(**doc) for doc in self._docs(query)]
+        self.backend.release(si)
         def _result(doc):
             changed = doc.changed
             href = get_resource_url(self.env, doc.resource, req.href)
@@ -788,13 +1018,14 @@ class FullTextSearch(Component):
                 return ""
         return rec(my_filters[:])
 
-    def _do_search(self, terms, filters, facet='realm', sort_by=None,
-                                         field_limit=None):
-        try:
-            si = self.backend.si_class(self.solr_endpoint)
-        except:
-            raise
+    def _do_search(self, si, terms, filters, facet='realm', sort_by=None,
+                                             field_limit=None):
+        """Return the query for `terms` in the realms of `filters` on the
+        Solr connection `si`, and the response with its first results.
 
+        The query is executed again when iterating over `_docs(query)`,
+        `si` should only be released after that.
+        """
         # Restrict search to chosen realms, if none of our filters were chosen
         # then we won't have any results - return early, empty handed
         # NB Also avoids TypeError if _build_filter_query() returns a string
@@ -1,8 +1,11 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from datetime import datetime, timedelta
 from StringIO import StringIO
 import os
 import shutil
 import tempfile
+import threading
+import time
 import unittest
 import logging
 
@@ -144,6 +147,214 @@ class BackendTestCase(unittest.TestCase):
         self.assertEquals(0, len(si.query('realm:wiki')))
 
 
+SOLR_SCHEMA = """<?xml version="1.0" encoding="UTF-8" ?>
+<schema name="fulltextsearch" version="1.2">
+  <types>
+    <fieldType name="string" class="solr.StrField"/>
+    <fieldType name="text" class="solr.TextField"/>
+  </types>
+  <fields>
+    <field name="doc_id" type="string" indexed="true" stored="true"/>
+    <field name="project" type="string" indexed="true" stored="true"/>
+    <field name="realm" type="string" indexed="true" stored="true"/>
+    <field name="id" type="string" indexed="true" stored="true"/>
+    <field name="title" type="text" indexed="true" stored="true"/>
+    <field name="body" type="text" indexed="true" stored="false"/>
+  </fields>
+  <uniqueKey>doc_id</uniqueKey>
+  <defaultSearchField>body</defaultSearchField>
+</schema>
+"""
+
+
+class SolrStub(HTTPServer):
+    """A local HTTP server answering like Solr to sunburnt.
+
+    Serves the schema, records the update requests and fails them with
+    503 while `down` is set.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.server.requests.append(('GET', self.path, None))
+            if self.path.endswith('schema.xml'):
+                self._respond(200, SOLR_SCHEMA)
+            else:
+                self._respond(404, '')
+
+        def do_POST(self):
+            length = int(self.headers.getheader('content-length') or 0)
+            body = self.rfile.read(length)
+            self.server.requests.append(('POST', self.path, body))
+            if self.server.down:
+                self._respond(503, 'Service Unavailable')
+            else:
+                self._respond(200, '<response><lst name="responseHeader">'
+                                   '<int name="status">0</int></lst>'
+                                   '</response>')
+
+        def _respond(self, status, content):
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/xml; charset=utf-8')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), self.Handler)
+        self.requests = []
+        self.down = False
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:%d/solr/' % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def schema_requests(self):
+        return [r for r in self.requests if r[0] == 'GET']
+
+    def updates(self):
+        return [r for r in self.requests
+                if r[0] == 'POST' and '<add>' in r[2]]
+
+    def commits(self):
+        return [r for r in self.requests
+                if r[0] == 'POST' and '<commit' in r[2]]
+
+
+class BackendSolrStubTestCase(unittest.TestCase):
+    def setUp(self):
+        self.log = logging.getLogger('BackendSolrStubTestCase')
+        self.solr = SolrStub()
+
+    def tearDown(self):
+        self.solr.stop()
+
+    def _fts_obj(self, id):
+        return FullTextSearchObject('ftsproj', realm='wiki', id=id,
+                                    title='Title', body='Lorem ipsum')
+
+    def test_connection_reused(self):
+        backend = Backend(self.solr.endpoint, self.log)
+        for name in ('PageOne', 'PageTwo', 'PageThree'):
+            backend.create(self._fts_obj(name))
+        self.assertEquals(1, len(self.solr.schema_requests()))
+        self.assertEquals(3, len(self.solr.updates()))
+        self.assertEquals(3, len(self.solr.commits()))
+
+    def test_batch_size(self):
+        backend = Backend(self.solr.endpoint, self.log, batch_size=3)
+        backend.create(self._fts_obj('PageOne'))
+        backend.create(self._fts_obj('PageTwo'))
+        self.assertEquals([], self.solr.updates())
+        backend.create(self._fts_obj('PageThree'))
+        updates = self.solr.updates()
+        self.assertEquals(1, len(updates))
+        self.assertEquals(3, updates[0][2].count('<doc>'))
+        self.assertEquals(1, len(self.solr.commits()))
+
+    def test_flush_interval(self):
+        backend = Backend(self.solr.endpoint, self.log, batch_size=100,
+                          flush_interval=0.1)
+        backend.create(self._fts_obj('PageOne'))
+        self.assertEquals([], self.solr.updates())
+        for i in xrange(50):
+            if self.solr.commits():
+                break
+            time.sleep(0.1)
+        self.assertEquals(1, len(self.solr.updates()))
+        self.assertEquals(1, len(self.solr.commits()))
+
+    def test_commit_flushes_pending(self):
+        backend = Backend(self.solr.endpoint, self.log, batch_size=100)
+        backend.create(self._fts_obj('PageOne'))
+        backend.delete(self._fts_obj('PageOne'))
+        backend.create(self._fts_obj('PageTwo'))
+        backend.commit()
+        posts = [r[2] for r in self.solr.requests if r[0] == 'POST']
+        self.assertEquals(4, len(posts))
+        self.assertTrue('<add>' in posts[0])
+        self.assertTrue('<delete>' in posts[1])
+        self.assertTrue('<add>' in posts[2])
+        self.assertTrue('<commit' in posts[3])
+
+    def test_soft_commit(self):
+        backend = Backend(self.solr.endpoint, self.log, soft_commit=True)
+        backend.create(self._fts_obj('PageOne'))
+        self.assertTrue('softCommit=true' in self.solr.commits()[0][1])
+
+    def test_retry_queue(self):
+        backend = Backend(self.solr.endpoint, self.log)
+        self.solr.down = True
+        backend.create(self._fts_obj('PageOne'), quiet=True)
+        self.assertEquals(1, backend.retry_count)
+        self.assertRaises(Exception, backend.create,
+                          self._fts_obj('PageTwo'))
+        self.assertEquals(2, backend.retry_count)
+        self.solr.down = False
+        backend.create(self._fts_obj('PageThree'))
+        self.assertEquals(0, backend.retry_count)
+        self.assertEquals(3, self.solr.updates()[-1][2].count('<doc>'))
+
+    def test_retry_queue_bounded(self):
+        backend = Backend(self.solr.endpoint, self.log, retry_queue_size=2)
+        self.solr.down = True
+        for name in ('PageOne', 'PageTwo', 'PageThree'):
+            backend.create(self._fts_obj(name), quiet=True)
+        self.assertEquals(2, backend.retry_count)
+        self.solr.down = False
+        backend.commit()
+        body = self.solr.updates()[-1][2]
+        self.assertFalse('PageOne' in body)
+        self.assertTrue('PageTwo' in body)
+        self.assertTrue('PageThree' in body)
+
+    def test_batch(self):
+        backend = Backend(self.solr.endpoint, self.log, batch_size=1)
+        sent = []
+        backend.start_batch(2)
+        for name in ('PageOne', 'PageTwo', 'PageThree'):
+            backend.create(self._fts_obj(name))
+            backend.when_sent(lambda name=name: sent.append(name))
+        self.assertEquals(1, len(self.solr.updates()))
+        self.assertEquals(2, self.solr.updates()[0][2].count('<doc>'))
+        self.assertEquals(['PageOne', 'PageTwo'], sent)
+        self.assertEquals(1, backend.batch_size)
+        backend.end_batch()
+        self.assertEquals(2, len(self.solr.updates()))
+        self.assertEquals(['PageOne', 'PageTwo', 'PageThree'], sent)
+
+    def test_batch_retry(self):
+        backend = Backend(self.solr.endpoint, self.log)
+        sent = []
+        backend.start_batch(2)
+        self.solr.down = True
+        for name in ('PageOne', 'PageTwo', 'PageThree'):
+            backend.create(self._fts_obj(name), quiet=True)
+            backend.when_sent(lambda name=name: sent.append(name))
+        self.assertEquals(2, backend.retry_count)
+        self.assertEquals([], sent)
+        self.solr.down = False
+        backend.end_batch(quiet=True)
+        # The retry queue is sent at the end of the batch, the documents
+        # which failed are not reported as sent.
+        self.assertEquals(0, backend.retry_count)
+        updates = self.solr.updates()
+        self.assertTrue('PageThree' in updates[-2][2])
+        self.assertEquals(2, updates[-1][2].count('<doc>'))
+        self.assertEquals(['PageThree'], sent)
+
+
 class FullTextSearchObjectTestCase(unittest.TestCase):
     def setUp(self):
         self.project = 'project1'
@@ -489,6 +700,7 @@ class ChangesetsSvnTestCase(unittest.TestCase):
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(BackendTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(BackendSolrStubTestCase, 'test'))
     suite.addTest(unittest.makeSuite(FullTextSearchObjectTestCase, 'test'))
     suite.addTest(unittest.makeSuite(FullTextSearchTestCase, 'test'))
     # ChangesetsSvnTestCase currently only run under nosetest, under vanilla
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+
+# Time the git calls behind Trac's browser and changeset views, with
+# objects read by running git for each of them and through the
+# `git cat-file --batch` processes.
+#
+# Usage: python contrib/benchmark.py [-r REPEAT] [-n CHANGESETS] GIT_DIR [REV]
+#
+# browse:     list the root tree of REV (default HEAD) and, for each
+#             entry, find the last change and read its commit, like
+#             the source browser does
+# changeset:  read the last CHANGESETS commits along the first parents,
+#             diff them against their parents and read the changed files, like the
+#             changeset view does
+
+import logging
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from tracext.git import PyGIT
+
+
+def browse(g, rev):
+    for mode, type_, sha, size, name in g.ls_tree(rev):
+        last_rev = g.last_change(rev, name)
+        g.ls_tree(rev, name)
+        if type_ == 'blob':
+            g.get_obj_size(sha)
+        g.read_commit(last_rev)
+        g.children(last_rev)
+
+
+def changesets(g, rev, count):
+    for _ in range(count):
+        msg, props = g.read_commit(rev)
+        for parent in props.get('parent', [None]):
+            for mode1, mode2, obj1, obj2, action, path1, path2 in \
+                    g.diff_tree(parent, rev, find_renames=True):
+                for obj, mode in ((obj1, mode1), (obj2, mode2)):
+                    if obj.strip('0') and not mode.startswith('04'):
+                        g.get_file(obj).read()
+        if 'parent' not in props:
+            break
+        rev = props['parent'][0]
+
+
+def main(args):
+    parser = optparse.OptionParser(usage='%prog [options] GIT_DIR [REV]')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int',
+                      default=3, help='number of runs, the best is shown')
+    parser.add_option('-n', '--changesets', dest='changesets', type='int',
+                      default=20, help='number of changesets to read')
+    options, args = parser.parse_args(args)
+    if not 1 <= len(args) <= 2:
+        parser.error('wrong number of arguments')
+    git_dir = args[0]
+
+    logging.basicConfig(level=logging.WARNING)
+    log = logging.getLogger('benchmark')
+
+    print '%-10s %-14s %10s' % ('view', 'objects', 'time (s)')
+    for view in ('browse', 'changeset'):
+        for batch in (False, True):
+            best = None
+            for _ in range(options.repeat):
+                g = PyGIT.Storage(git_dir, log, cat_file_batch=batch)
+                rev = g.verifyrev(len(args) > 1 and args[1] or 'HEAD')
+                start = time.time()
+                if view == 'browse':
+                    browse(g, rev)
+                else:
+                    changesets(g, rev, options.changesets)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            print '%-10s %-14s %10.3f' % (view, ('git per object',
+                                                 'cat-file batch')[batch],
+                                          best)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -15,12 +15,18 @@
 from __future__ import with_statement
 
 import os, re, sys, time, weakref
+from array import array
+from binascii import hexlify, unhexlify
 from collections import deque
 from functools import partial
+from hashlib import sha1
 from threading import Lock
 from subprocess import Popen, PIPE
 import cStringIO
+import mmap
 import string
+import struct
+import tempfile
 
 __all__ = ["git_version", "GitError", "GitErrorSha", "Storage", "StorageFactory"]
 
@@ -30,11 +36,109 @@ class GitError(Exception):
 class GitErrorSha(GitError):
     pass
 
+class GitCatFile:
+    """pool of long-running `git cat-file --batch` (or `--batch-check`)
+    processes, objects are requested and streamed back over pipes
+
+    Each request uses a process of its own so the pool is safe to use
+    from several threads; at most `max_idle` processes are kept
+    around between requests.
+    """
+
+    def __init__(self, cmd, max_idle=4):
+        self.__cmd = cmd
+        self.__max_idle = max_idle
+        self.__content = '--batch' in cmd
+        self.__idle = []
+        self.__lock = Lock()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        "terminate idle processes"
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for p in idle:
+            self.__close(p)
+
+    def __spawn(self):
+        # stderr is never read, a pipe would fill up and block git
+        devnull = open(os.devnull, 'w')
+        try:
+            if sys.platform == "win32":
+                return Popen(self.__cmd, stdin=PIPE, stdout=PIPE,
+                             stderr=devnull)
+            else:
+                return Popen(self.__cmd, stdin=PIPE, stdout=PIPE,
+                             stderr=devnull, close_fds=True)
+        finally:
+            devnull.close()
+
+    @staticmethod
+    def __close(p):
+        try:
+            p.stdin.close()
+            p.wait()
+        except (IOError, OSError):
+            pass
+
+    def get(self, name):
+        """returns (sha, type, size, content) for object `name`, or None
+        if there is no such object; content is None for --batch-check"""
+        if '\n' in name:
+            raise GitError("invalid object name %r" % name)
+
+        with self.__lock:
+            p = self.__idle and self.__idle.pop() or None
+        if p is None:
+            p = self.__spawn()
+
+        try:
+            p.stdin.write(name + '\n')
+            p.stdin.flush()
+            header = p.stdout.readline()
+            if not header.endswith('\n'):
+                raise GitError("git cat-file exited unexpectedly")
+
+            header = header.split()
+            # '<name> missing' or '<name> ambiguous', where <name> may
+            # contain spaces (e.g. '<rev>:<path>')
+            if header[-1] in ('missing', 'ambiguous'):
+                result = None
+            else:
+                sha, type_, size = header
+                size = int(size)
+                content = None
+                if self.__content:
+                    content = p.stdout.read(size)
+                    if len(content) != size or p.stdout.read(1) != '\n':
+                        raise GitError("short read from git cat-file")
+                result = sha, type_, size, content
+        except (IOError, OSError, ValueError, GitError), e:
+            self.__close(p)
+            if isinstance(e, GitError):
+                raise
+            raise GitError("git cat-file failed: %s" % e)
+
+        with self.__lock:
+            if len(self.__idle) < self.__max_idle:
+                self.__idle.append(p)
+                p = None
+        if p is not None:
+            self.__close(p)
+
+        return result
+
 class GitCore:
     def __init__(self, git_dir=None, git_bin="git"):
         self.__git_bin = git_bin
         self.__git_dir = git_dir
 
+        # object readers, processes are started on first use
+        self.batch = GitCatFile(self.__build_git_cmd('cat-file', '--batch'))
+        self.batch_check = GitCatFile(self.__build_git_cmd('cat-file', '--batch-check'))
+
     def __build_git_cmd(self, gitcmd, *args):
         "construct command tuple for git call suitable for Popen()"
 
@@ -105,19 +209,311 @@ class SizedDict(dict):
         # TODO
         raise AttributeError("SizedDict has no setdefault() method")
 
+class RevGraph(object):
+    """commit graph kept in flat arrays inside a single buffer
+
+    The buffer is either a string or a read-only mmap of the cache
+    file, so loading a persisted graph costs next to nothing.  Commits
+    are numbered by position in the order they were added, oldest
+    first; the ordinal id used by Storage is `len(graph) - pos`.
+
+    Layout (native byte order, 32 bit integers):
+
+      header
+      shas      20 byte binary sha per position
+      sidx      positions sorted by sha (used for short-rev lookups)
+      pstart    n+1 offsets into pidx
+      pidx      parent positions
+      cstart    cbase+1 offsets into cidx
+      cidx      child positions of the first cbase positions
+      extra     (parent, child) position pairs added after cidx was
+                built
+      tips      20 byte binary sha per ref tip the graph covers
+
+    It can be used like the former dict of
+    sha -> (children, parents, ordinal_id) tuples.
+    """
+
+    MAGIC = 'TGRC'
+    VERSION = 1
+    BYTE_ORDER = 0x01020304
+    # magic, version, byte order, n, pidx, cbase, cidx, extra, tips
+    HEADER = struct.Struct('=4sIIIIIIII')
+
+    def __init__(self, buf):
+        (magic, version, byte_order, self.n, self.n_pidx, self.cbase,
+         self.n_cidx, self.n_extra, n_tips) = self.HEADER.unpack_from(buf, 0)
+        if (magic, version, byte_order) != \
+                (self.MAGIC, self.VERSION, self.BYTE_ORDER):
+            raise ValueError("not a commit graph")
+
+        self.buf = buf
+        off = self.HEADER.size
+        self.o_shas = off; off += 20 * self.n
+        self.o_sidx = off; off += 4 * self.n
+        self.o_pstart = off; off += 4 * (self.n + 1)
+        self.o_pidx = off; off += 4 * self.n_pidx
+        self.o_cstart = off; off += 4 * (self.cbase + 1)
+        self.o_cidx = off; off += 4 * self.n_cidx
+        self.o_extra = off; off += 8 * self.n_extra
+        o_tips = off; off += 20 * n_tips
+        if off != len(buf):
+            raise ValueError("truncated commit graph")
+
+        # children added since cidx was built
+        self.extra = {}
+        pairs = self.__u32s(self.o_extra, 0, 2 * self.n_extra)
+        for i in xrange(0, len(pairs), 2):
+            self.extra.setdefault(pairs[i], []).append(pairs[i + 1])
+
+        self.tips = frozenset(hexlify(buf[o_tips + 20 * i:o_tips + 20 * (i + 1)])
+                              for i in xrange(n_tips))
+
+    @classmethod
+    def load(cls, filename):
+        "map the graph stored in filename"
+        f = open(filename, 'rb')
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        return cls(buf)
+
+    @classmethod
+    def build(cls, old, commits, tips):
+        """return the buffer of a graph made of `old` (a RevGraph or
+        None) extended with `commits`, a list of (sha, parent shas)
+        youngest first as given by `git rev-list --parents`"""
+
+        old_n = 0
+        if old is not None:
+            old_n = old.n
+
+        # new commits are appended oldest first
+        new_pos = {}
+        new_commits = []
+        for sha, parents in reversed(commits):
+            if sha in new_pos or (old is not None and sha in old):
+                continue
+            new_pos[sha] = old_n + len(new_commits)
+            new_commits.append((sha, parents))
+        n = old_n + len(new_commits)
+
+        def u32(off, count):
+            a = array('I')
+            if count:
+                a.fromstring(old.buf[off:off + 4 * count])
+            return a
+
+        def pos(sha):
+            p = new_pos.get(sha)
+            if p is None and old is not None:
+                p = old.pos(sha)
+            return p
+
+        shas = ''.join([old is not None and old.buf[old.o_shas:old.o_shas + 20 * old_n] or '']
+                       + [unhexlify(sha) for sha, parents in new_commits])
+
+        # parents are appended, a commit's parents never change
+        if old is not None:
+            pstart = u32(old.o_pstart, old_n + 1)
+            pidx = u32(old.o_pidx, old.n_pidx)
+            extra = u32(old.o_extra, 2 * old.n_extra)
+        else:
+            pstart = array('I', [0])
+            pidx = array('I')
+            extra = array('I')
+        for sha, parents in new_commits:
+            for parent in parents:
+                p = pos(parent)
+                if p is None: # shallow or broken history
+                    continue
+                pidx.append(p)
+                extra.extend((p, new_pos[sha]))
+            pstart.append(len(pidx))
+
+        # sorted index, the new positions are sorted and merged into the
+        # old one in a single pass
+        def key(p):
+            return shas[20 * p:20 * p + 20]
+
+        if old is None:
+            sidx = array('I', sorted(xrange(n), key=key))
+        else:
+            old_sidx = u32(old.o_sidx, old_n)
+            sidx = array('I')
+            start = lo = 0
+            for p in sorted(xrange(old_n, n), key=key):
+                k = key(p)
+                hi = old_n
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if key(old_sidx[mid]) < k:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                sidx.extend(old_sidx[start:lo])
+                sidx.append(p)
+                start = lo
+            sidx.extend(old_sidx[start:])
+
+        # children of new commits go to extra, which gets merged into
+        # cidx once it has grown too large
+        if old is not None and len(extra) // 2 <= max(1024, n // 8):
+            cbase = old.cbase
+            cstart = u32(old.o_cstart, cbase + 1)
+            cidx = u32(old.o_cidx, old.n_cidx)
+        else:
+            cbase = n
+            counts = [0] * (n + 1)
+            for p in pidx:
+                counts[p + 1] += 1
+            for i in xrange(n):
+                counts[i + 1] += counts[i]
+            cstart = array('I', counts)
+            fill = counts[:-1]
+            cidx = array('I', [0]) * len(pidx)
+            for child in xrange(n):
+                for i in xrange(pstart[child], pstart[child + 1]):
+                    p = pidx[i]
+                    cidx[fill[p]] = child
+                    fill[p] += 1
+            extra = array('I')
+
+        tips = sorted(tips)
+
+        return ''.join([cls.HEADER.pack(cls.MAGIC, cls.VERSION,
+                                        cls.BYTE_ORDER, n, len(pidx), cbase,
+                                        len(cidx), len(extra) // 2,
+                                        len(tips)),
+                        shas, sidx.tostring(), pstart.tostring(),
+                        pidx.tostring(), cstart.tostring(), cidx.tostring(),
+                        extra.tostring(),
+                        ''.join([unhexlify(t) for t in tips])])
+
+    def __u32s(self, off, i, count):
+        return struct.unpack_from('=%dI' % count, self.buf, off + 4 * i)
+
+    def __u32(self, off, i):
+        return struct.unpack_from('=I', self.buf, off + 4 * i)[0]
+
+    def sha(self, pos):
+        "return the sha of the commit at pos"
+        off = self.o_shas + 20 * pos
+        return hexlify(self.buf[off:off + 20])
+
+    def __sorted_sha(self, i):
+        return self.sha(self.__u32(self.o_sidx, i))
+
+    def prefixed(self, prefix):
+        "return the shas starting with the given hex prefix"
+        prefix = prefix.lower()
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__sorted_sha(mid) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        result = []
+        while lo < self.n:
+            sha = self.__sorted_sha(lo)
+            if not sha.startswith(prefix):
+                break
+            result.append(sha)
+            lo += 1
+        return result
+
+    def pos(self, sha):
+        "return the position of sha or None"
+        if len(sha) != 40:
+            return None
+        binsha = unhexlify(sha)
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            p = self.__u32(self.o_sidx, mid)
+            off = self.o_shas + 20 * p
+            cur = self.buf[off:off + 20]
+            if cur < binsha:
+                lo = mid + 1
+            elif cur > binsha:
+                hi = mid
+            else:
+                return p
+        return None
+
+    def parents_of(self, pos):
+        start, end = self.__u32s(self.o_pstart, pos, 2)
+        return self.__u32s(self.o_pidx, start, end - start)
+
+    def children_of(self, pos):
+        result = ()
+        if pos < self.cbase:
+            start, end = self.__u32s(self.o_cstart, pos, 2)
+            result = self.__u32s(self.o_cidx, start, end - start)
+        return result + tuple(self.extra.get(pos, ()))
+
+    def ordinal(self, pos):
+        return self.n - pos
+
+    def at_ordinal(self, ordinal):
+        "return the sha with the given ordinal id or None"
+        if ordinal < 1 or ordinal > self.n:
+            return None
+        return self.sha(self.n - ordinal)
+
+    def youngest(self):
+        return self.n and self.sha(self.n - 1) or None
+
+    def oldest(self):
+        return self.n and self.sha(0) or None
+
+    # dict interface
+
+    def __len__(self):
+        return self.n
+
+    def __contains__(self, sha):
+        return self.pos(sha) is not None
+
+    has_key = __contains__
+
+    def __getitem__(self, sha):
+        pos = self.pos(sha)
+        if pos is None:
+            raise KeyError(sha)
+        return (tuple(self.sha(c) for c in self.children_of(pos)),
+                tuple(self.sha(p) for p in self.parents_of(pos)),
+                self.ordinal(pos))
+
+    def iterkeys(self):
+        for pos in xrange(self.n - 1, -1, -1):
+            yield self.sha(pos)
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def iteritems(self):
+        for sha in self.iterkeys():
+            yield sha, self[sha]
+
 class StorageFactory:
     __dict = weakref.WeakValueDictionary()
     __dict_nonweak = dict()
     __dict_lock = Lock()
 
-    def __init__(self, repo, log, weak=True, git_bin='git'):
+    def __init__(self, repo, log, weak=True, git_bin='git',
+                 rev_cache_dir=None, cat_file_batch=True):
         self.logger = log
 
         with StorageFactory.__dict_lock:
             try:
                 i = StorageFactory.__dict[repo]
             except KeyError:
-                i = Storage(repo, log, git_bin)
+                i = Storage(repo, log, git_bin, rev_cache_dir, cat_file_batch)
                 StorageFactory.__dict[repo] = i
 
                 # create or remove additional reference depending on 'weak' argument
@@ -141,14 +537,6 @@ class StorageFactory:
 class Storage:
     __SREV_MIN = 4 # minimum short-rev length
 
-    @staticmethod
-    def __rev_key(rev):
-        assert len(rev) >= 4
-        #assert GitCore.is_sha(rev)
-        srev_key = int(rev[:4], 16)
-        assert srev_key >= 0 and srev_key <= 0xffff
-        return srev_key
-
     @staticmethod
     def git_version(git_bin="git"):
         GIT_VERSION_MIN_REQUIRED = (1,5,6)
@@ -179,7 +567,8 @@ class Storage:
         except:
             raise GitError("Could not retrieve GIT version")
 
-    def __init__(self, git_dir, log, git_bin='git'):
+    def __init__(self, git_dir, log, git_bin='git', rev_cache_dir=None,
+                 cat_file_batch=True):
         self.logger = log
 
         # simple sanity checking
@@ -197,12 +586,22 @@ class Storage:
 
         self.repo = GitCore(git_dir, git_bin=git_bin)
 
+        # read objects through `git cat-file --batch` processes instead
+        # of running git for each of them
+        self.cat_file_batch = cat_file_batch
+
         self.commit_encoding = None
 
         # caches
         self.__rev_cache = None
         self.__rev_cache_lock = Lock()
 
+        # the commit graph is persisted in rev_cache_dir (if given)
+        self.__rev_cache_file = None
+        if rev_cache_dir:
+            self.__rev_cache_file = os.path.join(rev_cache_dir,
+                sha1(os.path.abspath(git_dir)).hexdigest() + '.revcache')
+
         # cache the last 200 commit messages
         self.__commit_msg_cache = SizedDict(200)
         self.__commit_msg_lock = Lock()
@@ -216,124 +615,126 @@ class Storage:
     # cache handling
     #
 
-    # called by Storage.sync()
-    def __rev_cache_sync(self, youngest_rev=None):
-        "invalidates revision db cache if necessary"
-        with self.__rev_cache_lock:
-            need_update = False
-            if self.__rev_cache:
-                last_youngest_rev = self.__rev_cache[0]
-                if last_youngest_rev != youngest_rev:
-                    self.logger.debug("invalidated caches (%s != %s)" % (last_youngest_rev, youngest_rev))
-                    need_update = True
-            else:
-                need_update = True # almost NOOP
-
-            if need_update:
-                self.__rev_cache = None
-
-            return need_update
-
-    def get_rev_cache(self):
-        with self.__rev_cache_lock:
-            if self.__rev_cache is None: # can be cleared by Storage.__rev_cache_sync()
-                self.logger.debug("triggered rebuild of commit tree db for %d" % id(self))
-                new_db = {}
-                new_sdb = {}
-                new_tags = set([])
-                youngest = None
-                oldest = None
-                for revs in self.repo.rev_parse("--tags").splitlines():
-                    new_tags.add(revs.strip())
-
-                # helper for reusing strings
-                __rev_seen = {}
-                def __rev_reuse(rev):
-                    rev = str(rev)
-                    return __rev_seen.setdefault(rev, rev)
-
-                rev = ord_rev = 0
-                for revs in self.repo.rev_list("--parents", "--all").splitlines():
-                    revs = revs.strip().split()
-
-                    revs = map(__rev_reuse, revs)
-
-                    rev = revs[0]
-
-                    # shortrev "hash" map
-                    srev_key = self.__rev_key(rev)
-                    new_sdb.setdefault(srev_key, []).append(rev)
-
-                    parents = tuple(revs[1:])
-
-                    ord_rev += 1
-
-                    # first rev seen is assumed to be the youngest one (and has ord_rev=1)
-                    if not youngest:
-                        youngest = rev
-
-                    # new_db[rev] = (children(rev), parents(rev), ordinal_id(rev))
-                    if new_db.has_key(rev):
-                        _children,_parents,_ord_rev = new_db[rev]
-                        assert _children
-                        assert not _parents
-                        assert _ord_rev == 0
-                    else:
-                        _children = []
-
-                    # create/update entry
-                    new_db[rev] = _children, parents, ord_rev
-
-                    # update all parents(rev)'s children
-                    for parent in parents:
-                        # by default, a dummy ordinal_id is used for the mean-time
-                        _children, _parents, _ord_rev = new_db.setdefault(parent, ([], [], 0))
-                        if rev not in _children:
-                            _children.append(rev)
-
-                # last rev seen is assumed to be the oldest one (with highest ord_rev)
-                oldest = rev
-
-                __rev_seen = None
-
-                assert len(new_db) == ord_rev
+    def __ref_tips(self):
+        "returns the set of commits refs (and HEAD) point to and the set of tags"
+        refs = {}
+        tags = set()
+        for line in self.repo.show_ref("--head", "-d").splitlines():
+            sha, name = line.split(None, 1)
+            if name.endswith('^{}'):
+                # peeled annotated tag
+                name = name[:-3]
+            elif name.startswith('refs/tags/'):
+                tags.add(sha)
+            refs[name] = sha
+        return frozenset(refs.itervalues()), tags
+
+    def __rev_cache_load(self):
+        "maps the persisted commit graph, if any"
+        if not self.__rev_cache_file:
+            return None
+        try:
+            graph = RevGraph.load(self.__rev_cache_file)
+        except (EnvironmentError, ValueError, struct.error), e:
+            if os.path.exists(self.__rev_cache_file):
+                self.logger.warning("ignoring commit tree db %s: %s" % (self.__rev_cache_file, e))
+            return None
+        self.logger.debug("loaded commit tree db for %d with %d entries" % (id(self), len(graph)))
+        return graph
 
-                # convert children lists to tuples
-                tmp = {}
+    def __rev_cache_store(self, buf):
+        "persists the graph in buf (if enabled) and returns it as a RevGraph"
+        if self.__rev_cache_file:
+            cache_dir = os.path.dirname(self.__rev_cache_file)
+            try:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix='.tmp')
+                f = os.fdopen(fd, 'wb')
                 try:
-                    while True:
-                        k,v = new_db.popitem()
-                        assert v[2] > 0
-                        tmp[k] = tuple(v[0]),v[1],v[2]
-                except KeyError:
-                    pass
+                    f.write(buf)
+                finally:
+                    f.close()
+                if sys.platform == "win32" and os.path.exists(self.__rev_cache_file):
+                    os.remove(self.__rev_cache_file)
+                os.rename(tmp, self.__rev_cache_file)
+                return RevGraph.load(self.__rev_cache_file)
+            except EnvironmentError, e:
+                self.logger.warning("could not write commit tree db %s: %s" % (self.__rev_cache_file, e))
+        return RevGraph(buf)
+
+    def __rev_list(self, *args):
+        "returns (sha, parent shas) tuples from rev-list --parents, youngest first"
+        # helper for reusing strings
+        __rev_seen = {}
+        def __rev_reuse(rev):
+            return __rev_seen.setdefault(rev, rev)
+
+        commits = []
+        for revs in self.repo.rev_list("--parents", *args).splitlines():
+            revs = map(__rev_reuse, revs.strip().split())
+            commits.append((revs[0], revs[1:]))
+        return commits
+
+    def __rev_cache_update(self, tips, tags):
+        """brings the commit graph up to date with tips, walking only
+        the commits which are new since the graph was built"""
+        if self.__rev_cache is not None:
+            graph = self.__rev_cache[2]
+        else:
+            graph = self.__rev_cache_load()
+
+        if graph is not None and graph.tips != tips:
+            # refs that went away may leave commits unreachable, which
+            # only a rebuild drops
+            gone = list(graph.tips - tips)
+            if gone and self.repo.rev_list("--max-count=1", *(gone + ["--not"] + list(tips))).strip():
+                self.logger.debug("refs removed, rebuilding commit tree db for %d" % id(self))
+                graph = None
+            else:
+                new = list(tips - graph.tips)
+                commits = []
+                if new:
+                    commits = self.__rev_list(*(new + ["--not"] + list(graph.tips)))
+                known = set(sha for sha, parents in commits)
+                if all(sha in known or sha in graph for sha in new):
+                    graph = self.__rev_cache_store(RevGraph.build(graph, commits, tips))
+                    self.logger.debug("added %d commits to commit tree db for %d" % (len(commits), id(self)))
+                else:
+                    # history got rewritten or pruned under us
+                    graph = None
 
-                assert len(new_db) == 0
-                new_db = tmp
+        if graph is None:
+            self.logger.debug("triggered rebuild of commit tree db for %d" % id(self))
+            graph = self.__rev_cache_store(RevGraph.build(None, self.__rev_list("--all"), tips))
+            self.logger.debug("rebuilt commit tree db for %d with %d entries" % (id(self), len(graph)))
 
-                # convert sdb either to dict or array depending on size
-                tmp = [()]*(max(new_sdb.keys())+1) if len(new_sdb) > 5000 else {}
+        # atomically update self.__rev_cache
+        self.__rev_cache = graph.youngest(), graph.oldest(), graph, tags, graph
 
-                try:
-                    while True:
-                        k,v = new_sdb.popitem()
-                        tmp[k] = tuple(v)
-                except KeyError:
-                    pass
+    # called by Storage.sync()
+    def __rev_cache_sync(self, tips, tags):
+        "updates revision db cache if necessary"
+        with self.__rev_cache_lock:
+            if not self.__rev_cache:
+                return True # almost NOOP, built on first use
 
-                assert len(new_sdb) == 0
-                new_sdb = tmp
+            if self.__rev_cache[2].tips == tips and self.__rev_cache[3] == tags:
+                return False
 
-                # atomically update self.__rev_cache
-                self.__rev_cache = youngest, oldest, new_db, new_tags, new_sdb
-                self.logger.debug("rebuilt commit tree db for %d with %d entries" % (id(self),len(new_db)))
+            self.logger.debug("updating caches for changed refs")
+            self.__rev_cache_update(tips, tags)
+            return True
 
-            assert all(e is not None for e in self.__rev_cache) or not any(self.__rev_cache)
+    def get_rev_cache(self):
+        with self.__rev_cache_lock:
+            if self.__rev_cache is None: # built on first use
+                self.__rev_cache_update(*self.__ref_tips())
 
             return self.__rev_cache
         # with self.__rev_cache_lock
 
-    # tuple: youngest_rev, oldest_rev, rev_dict, tag_dict, short_rev_dict
+    # tuple: youngest_rev, oldest_rev, rev_graph, tag_dict, rev_graph
     rev_cache = property(get_rev_cache)
 
     def get_commits(self):
@@ -348,23 +749,14 @@ class Storage:
     def history_relative_rev(self, sha, rel_pos):
         db = self.get_commits()
 
-        if sha not in db:
+        pos = db.pos(sha)
+        if pos is None:
             raise GitErrorSha
 
         if rel_pos == 0:
             return sha
 
-        lin_rev = db[sha][2] + rel_pos
-
-        if lin_rev < 1 or lin_rev > len(db):
-            return None
-
-        for k,v in db.iteritems():
-            if v[2] == lin_rev:
-                return k
-
-        # should never be reached if db is consistent
-        raise GitError("internal inconsistency detected")
+        return db.at_ordinal(db.ordinal(pos) + rel_pos)
 
     def hist_next_revision(self, sha):
         return self.history_relative_rev(sha, -1)
@@ -427,7 +819,7 @@ class Storage:
             return None
 
         srev = rev[:min_len]
-        srevs = set(sdb[self.__rev_key(rev)])
+        srevs = set(sdb.prefixed(rev[:self.__SREV_MIN]))
 
         if len(srevs) == 1:
             return srev # we already got a unique id
@@ -455,12 +847,7 @@ class Storage:
         if not GitCore.is_sha(srev):
             return None
 
-        try:
-            srevs = sdb[self.__rev_key(srev)]
-        except KeyError:
-            return None
-
-        srevs = filter(lambda s: s.startswith(srev), srevs)
+        srevs = sdb.prefixed(srev)
         if len(srevs) == 1:
             return srevs[0]
 
@@ -480,12 +867,64 @@ class Storage:
     def get_tags(self):
         return [e.strip() for e in self.repo.tag("-l").splitlines()]
 
+    def __ls_tree_batch(self, rev, path):
+        "ls_tree() reading tree objects through `git cat-file --batch`"
+        if not path or path.endswith('/'):
+            # the entries of a tree
+            tree_path, name = path.rstrip('/'), None
+        else:
+            # a single entry
+            tree_path, _, name = path.rpartition('/')
+        prefix = tree_path and tree_path + '/'
+
+        obj = self.repo.batch.get(rev + ':' + tree_path)
+        if obj is None or obj[1] != 'tree':
+            return []
+        data = obj[3]
+
+        result = []
+        pos = 0
+        while pos < len(data):
+            # '<mode> <name>\0<20 byte sha>'
+            end = data.index('\0', pos)
+            _mode, fname = data[pos:end].split(' ', 1)
+            _sha = hexlify(data[end + 1:end + 21])
+            pos = end + 21
+
+            if name is not None and fname != name:
+                continue
+
+            _mode = _mode.zfill(6)
+            if _mode == '040000':
+                _type = 'tree'
+            elif _mode == '160000':
+                _type = 'commit'
+            else:
+                _type = 'blob'
+
+            _size = None
+            if _type == 'blob':
+                _size = self.repo.batch_check.get(_sha)[2]
+
+            result.append((_mode, _type, _sha, _size, prefix + fname))
+        return result
+
     def ls_tree(self, rev, path=""):
         rev = rev and str(rev) or 'HEAD' # paranoia
         if path.startswith('/'):
             path = path[1:]
 
-        tree = self.repo.ls_tree("-z", "-l", rev, "--", path).split('\0')
+        # symbolic revs are left to git ls-tree, long running cat-file
+        # processes may not see refs being updated
+        if self.cat_file_batch and len(rev) == 40 and GitCore.is_sha(rev) \
+                and '\n' not in path:
+            return self.__ls_tree_batch(rev, path)
+
+        # newer git versions reject an empty pathspec
+        args = ["-z", "-l", rev]
+        if path:
+            args += ["--", path]
+        tree = self.repo.ls_tree(*args).split('\0')
 
         def split_ls_tree_line(l):
             "split according to '<mode> <type> <sha> <size>\t<fname>'"
@@ -520,7 +959,11 @@ class Storage:
                 return result[0], dict(result[1])
 
             # cache miss
-            raw = self.repo.cat_file("commit", commit_id)
+            if self.cat_file_batch:
+                obj = self.repo.batch.get(commit_id)
+                raw = obj and obj[1] == 'commit' and obj[3] or ''
+            else:
+                raw = self.repo.cat_file("commit", commit_id)
             raw = unicode(raw, self.get_commit_encoding(), 'replace')
             lines = raw.splitlines()
 
@@ -541,11 +984,21 @@ class Storage:
             return result[0], dict(result[1])
 
     def get_file(self, sha):
+        if self.cat_file_batch:
+            # cStringIO shares the string read from the pipe
+            obj = self.repo.batch.get(str(sha))
+            return cStringIO.StringIO(obj and obj[1] == 'blob' and obj[3] or '')
         return cStringIO.StringIO(self.repo.cat_file("blob", str(sha)))
 
     def get_obj_size(self, sha):
         sha = str(sha)
 
+        if self.cat_file_batch:
+            obj = self.repo.batch_check.get(sha)
+            if obj is None:
+                raise GitErrorSha("object '%s' not found" % sha)
+            return obj[2]
+
         try:
             obj_size = int(self.repo.cat_file("-s", sha).strip())
         except ValueError:
@@ -593,8 +1046,7 @@ class Storage:
         return self.get_commits().iterkeys()
 
     def sync(self):
-        rev = self.repo.rev_list("--max-count=1", "--all").strip()
-        return self.__rev_cache_sync(rev)
+        return self.__rev_cache_sync(*self.__ref_tips())
 
     def last_change(self, sha, path):
         return self.repo.rev_list("--max-count=1",
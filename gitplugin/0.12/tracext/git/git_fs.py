@@ -41,7 +41,7 @@ from genshi.builder import tag
 from genshi.core import Markup, escape
 
 from datetime import datetime
-import time, sys
+import os, time, sys
 
 if not sys.version_info[:2] >= (2,5):
         raise TracError("python >= 2.5 dependancy not met")
@@ -166,6 +166,15 @@ class GitConnector(Component):
 
         _git_bin = PathOption('git', 'git_bin', '/usr/bin/git', "path to git executable (relative to trac project folder!)")
 
+        _rev_cache_dir = Option('git', 'rev_cache_dir', 'cache/git',
+                                "directory the commit tree is stored in, so it is only updated"
+                                " with new commits instead of rebuilt when trac restarts"
+                                " (relative to the environment; empty disables storing it)")
+
+        _cat_file_batch = BoolOption('git', 'cat_file_batch', 'true',
+                                     "read objects through long-running `git cat-file --batch`"
+                                     " processes instead of running git for each object")
+
 
         def get_supported_types(self):
                 yield ("git", 8)
@@ -180,10 +189,16 @@ class GitConnector(Component):
                         raise TracError("GIT version %s installed not compatible (need >= %s)" %
                                         (self._version['v_str'], self._version['v_min_str']))
 
+                rev_cache_dir = self._rev_cache_dir
+                if rev_cache_dir:
+                        rev_cache_dir = os.path.join(self.env.path, rev_cache_dir)
+
                 repos = GitRepository(dir, params, self.log,
                                       persistent_cache=self._persistent_cache,
                                       git_bin=self._git_bin,
-                                      shortrev_len=self._shortrev_len)
+                                      shortrev_len=self._shortrev_len,
+                                      rev_cache_dir=rev_cache_dir,
+                                      cat_file_batch=self._cat_file_batch)
 
                 if self._cached_repository:
                         repos = CachedRepository2(self.env, repos, self.log)
@@ -195,14 +210,17 @@ class GitConnector(Component):
 
 class GitRepository(Repository):
         def __init__(self, path, params, log, persistent_cache=False,
-                        git_bin='git', shortrev_len=7):
+                        git_bin='git', shortrev_len=7, rev_cache_dir=None,
+                        cat_file_batch=True):
                 self.logger = log
                 self.gitrepo = path
                 self.params = params
                 self._shortrev_len = max(4, min(shortrev_len, 40))
 
                 self.git = PyGIT.StorageFactory(path, log, not persistent_cache,
-                                                git_bin=git_bin).getInstance()
+                                                git_bin=git_bin,
+                                                rev_cache_dir=rev_cache_dir,
+                                                cat_file_batch=cat_file_batch).getInstance()
                 Repository.__init__(self, "git:"+path, self.params, log)
 
         def close(self):
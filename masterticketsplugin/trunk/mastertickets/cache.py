@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2007-2012 Noah Kantrowitz <noah@coderanger.net>
+# Copyright (c) 2013-2016 Ryan J Ollos <ryan.j.ollos@gmail.com>
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import hashlib
+import os
+import tempfile
+
+from trac.util.text import to_unicode
+
+
+def render_key(source, format):
+    """Return the cache key of the dot `source` rendered in `format`."""
+    sha = hashlib.sha1(to_unicode(format).encode('utf-8'))
+    sha.update('\0')
+    sha.update(to_unicode(source).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class RenderCache(object):
+    """An on-disk cache of rendered graphs.
+
+    Entries are stored as one file per key in `path`. The modification
+    time of a file is refreshed each time it is read, and the least
+    recently used entries are removed when the size of the cache goes
+    over `max_size` bytes.
+    """
+
+    def __init__(self, path, max_size, log=None):
+        self.path = path
+        self.max_size = max_size
+        self.log = log
+
+    def get(self, key):
+        """Return the data cached for `key`, or `None`."""
+        filename = os.path.join(self.path, key)
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            os.utime(filename, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def put(self, key, data):
+        """Store `data` for `key` and evict old entries if needed."""
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, os.path.join(self.path, key))
+        except (IOError, OSError), e:
+            if self.log:
+                self.log.warning("MasterTickets: Can't write to render "
+                                 "cache %s: %s", self.path, e)
+            return
+        self.evict()
+
+    def render(self, key, render_fn):
+        """Return the data cached for `key`, calling `render_fn` to
+        produce it on a miss. Empty results aren't cached.
+        """
+        data = self.get(key)
+        if data is None:
+            data = render_fn()
+            if data:
+                self.put(key, data)
+        return data
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits
+        in `max_size`.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if name.startswith('.tmp'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                continue
+            total -= size
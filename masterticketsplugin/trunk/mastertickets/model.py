@@ -120,29 +120,83 @@ class TicketLinks(object):
                 l(getattr(self, 'blocked_by', [])))
 
     @staticmethod
-    def walk_tickets(env, tkt_ids, full=False):
-        """Return an iterable of all links reachable directly above or
-        below those ones.
+    def walk_tickets(env, tkt_ids, full=False, depth=None):
+        """Return an iterable of `LinkedTicket` for all tickets reachable
+        directly above or below those ones.
+
+        The graph is walked breadth first, loading the links and the
+        tickets of a whole level with a single query each. If `full` is
+        `True` the links are followed in both directions from every
+        ticket. When `depth` is given, the walk stops after following
+        that number of links from `tkt_ids`.
         """
+        if full:
+            walks = [lambda node: node.blocking | node.blocked_by]
+        else:
+            walks = [lambda node: node.blocking,
+                     lambda node: node.blocked_by]
+
+        nodes = {}
+        for next_fn in walks:
+            frontier = set(int(tid) for tid in tkt_ids)
+            seen = set()
+            level = 0
+            while frontier:
+                LinkedTicket.load(env, nodes, frontier - set(nodes))
+                seen |= frontier
+                if depth is not None and level >= depth:
+                    break
+                level += 1
+                frontier = set(n for tid in frontier if tid in nodes
+                                 for n in next_fn(nodes[tid])) - seen
+        return nodes.itervalues()
+
+
+class LinkedTicket(object):
+    """A ticket reached while walking the dependency graph, with the
+    fields needed to render it and its links.
+    """
+
+    # Number of ids bound in a single `IN` clause.
+    chunk_size = 400
+
+    def __init__(self, id, status, summary):
+        self.id = id
+        self.status = status
+        self.summary = summary
+        self.blocking = set()
+        self.blocked_by = set()
+
+    def __nonzero__(self):
+        return bool(self.blocking) or bool(self.blocked_by)
 
-        def visit(tkt, memo, next_fn):
-            if tkt in memo:
-                return False
-
-            links = TicketLinks(env, tkt)
-            memo[tkt] = links
-
-            for n in next_fn(links):
-                visit(n, memo, next_fn)
-
-        memo1 = {}
-        memo2 = {}
-        for tid in tkt_ids:
-            if full:
-                visit(tid, memo1, lambda links: links.blocking |
-                                               links.blocked_by)
-            else:
-                visit(tid, memo1, lambda links: links.blocking)
-                visit(tid, memo2, lambda links: links.blocked_by)
-        memo1.update(memo2)
-        return memo1.itervalues()
+    def __repr__(self):
+        return '<mastertickets.model.LinkedTicket #%s blocking=%r ' \
+               'blocked_by=%r>' % (self.id, sorted(self.blocking),
+                                   sorted(self.blocked_by))
+
+    @classmethod
+    def load(cls, env, nodes, tkt_ids):
+        """Add the tickets `tkt_ids` with all their links to `nodes`.
+
+        Ids of tickets that don't exist are ignored.
+        """
+        tkt_ids = sorted(tkt_ids)
+        for idx in xrange(0, len(tkt_ids), cls.chunk_size):
+            chunk = tkt_ids[idx:idx + cls.chunk_size]
+            holders = ','.join(['%s'] * len(chunk))
+            loaded = {}
+            for id, status, summary in env.db_query("""
+                    SELECT id, status, summary FROM ticket WHERE id IN (%s)
+                    """ % holders, chunk):
+                loaded[id] = cls(id, status, summary)
+            for source, dest in env.db_query("""
+                    SELECT source, dest FROM mastertickets
+                    WHERE source IN (%s) OR dest IN (%s)
+                    """ % (holders, holders), chunk + chunk):
+                source, dest = int(source), int(dest)
+                if source in loaded:
+                    loaded[source].blocking.add(dest)
+                if dest in loaded:
+                    loaded[dest].blocked_by.add(source)
+            nodes.update(loaded)
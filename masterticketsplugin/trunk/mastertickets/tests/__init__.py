@@ -13,8 +13,9 @@ import unittest
 
 
 def suite():
-    from mastertickets.tests import model
+    from mastertickets.tests import cache, model
     suite = unittest.TestSuite()
+    suite.addTest(cache.suite())
     suite.addTest(model.suite())
     return suite
 
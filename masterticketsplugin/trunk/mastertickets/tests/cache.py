@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2007-2012 Noah Kantrowitz <noah@coderanger.net>
+# Copyright (c) 2013-2016 Ryan J Ollos <ryan.j.ollos@gmail.com>
+#
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from trac.test import EnvironmentStub, MockRequest
+from trac.web.api import RequestDone
+
+from mastertickets import graphviz
+from mastertickets.cache import RenderCache, render_key
+from mastertickets.web_ui import MasterTicketsModule
+
+
+class RenderCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = RenderCache(os.path.join(self.path, 'cache'), 25)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _set_mtime(self, key, mtime):
+        os.utime(os.path.join(self.cache.path, key), (mtime, mtime))
+
+    def test_render_key(self):
+        self.assertEqual(render_key(u'digraph {}', 'png'),
+                         render_key('digraph {}', u'png'))
+        self.assertNotEqual(render_key(u'digraph {}', 'png'),
+                            render_key(u'digraph {}', 'svg'))
+        self.assertNotEqual(render_key(u'digraph {}', 'png'),
+                            render_key(u'digraph { Üs }', 'png'))
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', 'data')
+        self.assertEqual('data', self.cache.get('a'))
+
+    def test_render(self):
+        calls = []
+
+        def render_fn():
+            calls.append(1)
+            return 'data'
+
+        self.assertEqual('data', self.cache.render('a', render_fn))
+        self.assertEqual('data', self.cache.render('a', render_fn))
+        self.assertEqual(1, len(calls))
+
+    def test_render_empty_not_cached(self):
+        self.assertEqual('', self.cache.render('a', lambda: ''))
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_evict_least_recently_used(self):
+        self.cache.put('a', '0123456789')
+        self._set_mtime('a', 1000)
+        self.cache.put('b', '0123456789')
+        self._set_mtime('b', 2000)
+        self.cache.get('a')
+        self.cache.put('c', '0123456789')
+        self.assertEqual('0123456789', self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual('0123456789', self.cache.get('c'))
+
+
+class SendRenderedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'mastertickets.*'])
+        self.env.path = tempfile.mkdtemp()
+        self.module = MasterTicketsModule(self.env)
+        self.graph = graphviz.Graph()
+        self.graph[1] > self.graph[2]
+        self.key = render_key(unicode(self.graph), 'png')
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    def test_cached(self):
+        self.module.render_cache.put(self.key, 'PNG')
+        req = MockRequest(self.env)
+        self.assertRaises(RequestDone, self.module._send_rendered,
+                          req, self.graph, 'png', 'image/png')
+        self.assertEqual(['200 Ok'], req.status_sent)
+        self.assertEqual('"%s"' % self.key, req.headers_sent['ETag'])
+        self.assertEqual('PNG', req.response_sent.getvalue())
+
+    def test_not_modified(self):
+        req = MockRequest(self.env)
+        req.environ['HTTP_IF_NONE_MATCH'] = '"%s"' % self.key
+        self.assertRaises(RequestDone, self.module._send_rendered,
+                          req, self.graph, 'png', 'image/png')
+        self.assertEqual(['304 Not Modified'], req.status_sent)
+        self.assertEqual('', req.response_sent.getvalue())
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(RenderCacheTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SendRenderedTestCase, 'test'))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
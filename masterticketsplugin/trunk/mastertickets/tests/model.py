@@ -14,6 +14,10 @@ import tempfile
 import unittest
 
 from trac.test import EnvironmentStub, Mock
+from trac.ticket.model import Ticket
+
+from mastertickets.api import MasterTicketsSystem
+from mastertickets.model import LinkedTicket, TicketLinks
 
 
 class TicketLinksTestCase(unittest.TestCase):
@@ -23,11 +27,61 @@ class TicketLinksTestCase(unittest.TestCase):
                                    enable=['trac.*', 'mastertickets.*'])
         self.env.path = tempfile.mkdtemp()
         self.req = Mock()
+        MasterTicketsSystem(self.env).upgrade_environment()
+        # 1 -> 2 -> 3 -> 4 and 5 -> 3, 6 is unlinked.
+        for idx in range(1, 7):
+            ticket = Ticket(self.env)
+            ticket['summary'] = 'Summary %d' % idx
+            ticket['reporter'] = 'joe'
+            ticket['status'] = 'closed' if idx == 2 else 'new'
+            ticket.insert()
+        self.env.db_transaction.executemany("""
+            INSERT INTO mastertickets (source, dest) VALUES (%s, %s)
+            """, [(1, 2), (2, 3), (3, 4), (5, 3)])
 
     def tearDown(self):
         self.env.shutdown()
         shutil.rmtree(self.env.path)
 
+    def _walk(self, tkt_ids, full=False, depth=None):
+        nodes = TicketLinks.walk_tickets(self.env, tkt_ids, full, depth)
+        return dict((node.id, node) for node in nodes)
+
+    def test_walk_tickets(self):
+        nodes = self._walk([2])
+        self.assertEqual([1, 2, 3, 4], sorted(nodes))
+        self.assertEqual(set([3]), nodes[2].blocking)
+        self.assertEqual(set([1]), nodes[2].blocked_by)
+        self.assertEqual(set([2, 5]), nodes[3].blocked_by)
+        self.assertEqual('closed', nodes[2].status)
+        self.assertEqual('Summary 4', nodes[4].summary)
+
+    def test_walk_tickets_full(self):
+        self.assertEqual([1, 2, 3, 4, 5], sorted(self._walk([2], True)))
+        self.assertEqual([6], sorted(self._walk([6], True)))
+
+    def test_walk_tickets_depth(self):
+        self.assertEqual([2], sorted(self._walk([2], depth=0)))
+        self.assertEqual([1, 2, 3], sorted(self._walk([2], depth=1)))
+        self.assertEqual([1, 2, 3], sorted(self._walk([1], True, 2)))
+        self.assertEqual([1, 2, 3, 4, 5], sorted(self._walk([1], True, 3)))
+
+    def test_walk_tickets_chunked(self):
+        chunk_size = LinkedTicket.chunk_size
+        LinkedTicket.chunk_size = 2
+        try:
+            nodes = self._walk([3], True)
+        finally:
+            LinkedTicket.chunk_size = chunk_size
+        self.assertEqual([1, 2, 3, 4, 5], sorted(nodes))
+        self.assertEqual(set([2, 5]), nodes[3].blocked_by)
+
+    def test_walk_tickets_missing(self):
+        self.env.db_transaction("DELETE FROM ticket WHERE id=4")
+        nodes = self._walk([1])
+        self.assertEqual([1, 2, 3], sorted(nodes))
+        self.assertEqual(set([4]), nodes[3].blocking)
+
 
 def suite():
     suite = unittest.TestSuite()
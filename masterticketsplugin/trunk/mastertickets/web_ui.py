@@ -16,7 +16,8 @@ import re
 import subprocess
 import textwrap
 
-from trac.config import BoolOption, ChoiceOption, ListOption, Option
+from trac.config import BoolOption, ChoiceOption, IntOption, ListOption, \
+                        Option
 from trac.core import Component, TracError, implements
 from trac.mimeview import Mimeview
 from trac.resource import ResourceNotFound, get_resource_summary
@@ -27,9 +28,10 @@ from trac.util.html import html
 from trac.util.presentation import classes
 from trac.util.translation import _, tag_
 from trac.web.api import IRequestFilter, IRequestHandler, \
-                         ITemplateStreamFilter
+                         ITemplateStreamFilter, RequestDone
 from trac.web.chrome import ITemplateProvider, add_ctxtnav, add_script
 
+from cache import RenderCache, render_key
 from model import TicketLinks
 
 
@@ -55,6 +57,17 @@ class MasterTicketsModule(Component):
             by default. If the list is empty, the png format will be used.
             """)
 
+    render_cache_dir = Option('mastertickets', 'render_cache_dir',
+        default='cache/mastertickets',
+        doc="""Directory where rendered graphs are cached. Relative paths
+            are resolved from the environment directory.""")
+
+    render_cache_size = IntOption('mastertickets', 'render_cache_size',
+        default=16,
+        doc="""Maximum size of the render cache in MiB. The least recently
+            used graphs are removed first. Set to 0 to disable the
+            cache.""")
+
     closed_color = Option('mastertickets', 'closed_color', default='green',
         doc="Color of closed tickets")
 
@@ -77,6 +90,10 @@ class MasterTicketsModule(Component):
     full_graph = BoolOption('mastertickets', 'full_graph', default=False,
         doc="Show full dep. graph, not just direct blocking links")
 
+    graph_depth = IntOption('mastertickets', 'graph_depth', default=0,
+        doc="""Maximum number of links followed from the tickets of a
+            dependency graph. Set to 0 to show the whole graph.""")
+
     graph_direction = ChoiceOption('mastertickets', 'graph_direction',
                                    choices=['TD', 'LR', 'DT', 'RL'],
         doc="""Direction of the dependency graph (TD = Top Down,
@@ -96,12 +113,17 @@ class MasterTicketsModule(Component):
                 if not data:
                     return template, data, content_type
                 tkt = data['ticket']
-                links = TicketLinks(self.env, tkt)
+                nodes = dict((node.id, node) for node in
+                             TicketLinks.walk_tickets(self.env, [tkt.id],
+                                                      full=True, depth=1))
+                links = nodes.get(tkt.id)
 
-                for i in links.blocked_by:
-                    if Ticket(self.env, i)['status'] != 'closed':
-                        add_script(req, 'mastertickets/js/disable_resolve.js')
-                        break
+                if links:
+                    for i in links.blocked_by:
+                        if i in nodes and nodes[i].status != 'closed':
+                            add_script(req,
+                                       'mastertickets/js/disable_resolve.js')
+                            break
 
                 # Add link to depgraph if needed.
                 if links:
@@ -262,25 +284,15 @@ class MasterTicketsModule(Component):
                 if format_ in self.acceptable_formats:
                     mimetype = Mimeview(self.env). \
                                mime_map.get(format_, 'text/plain')
-                    req.send(g.render(self.dot_path, format_), mimetype)
+                    self._send_rendered(req, g, format_, mimetype)
                 else:
                     raise TracError(_("The %(format)s format is not allowed.",
                                       format=format_))
 
             if self.use_gs:
-                ps = g.render(self.dot_path, 'ps2')
-                gs = subprocess.Popen(
-                    [self.gs_path, '-q', '-dTextAlphaBits=4',
-                     '-dGraphicsAlphaBits=4', '-sDEVICE=png16m',
-                     '-sOutputFile=%stdout%', '-'],
-                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE)
-                img, err = gs.communicate(ps)
-                if err:
-                    self.log.debug('MasterTickets: Error from gs: %s', err)
+                self._send_rendered(req, g, 'gs-png', 'image/png')
             else:
-                img = g.render(self.dot_path)
-            req.send(img, 'image/png')
+                self._send_rendered(req, g, 'png', 'image/png')
         else:
             data = {}
 
@@ -305,11 +317,63 @@ class MasterTicketsModule(Component):
             except IndexError:
                 data['format'] = 'png'
             data['graph'] = g
-            data['graph_render'] = functools.partial(g.render, self.dot_path)
+            data['graph_render'] = functools.partial(self._render, g)
             data['use_gs'] = self.use_gs
 
             return 'depgraph.html', data, None
 
+    @property
+    def render_cache(self):
+        if self.render_cache_size <= 0:
+            return None
+        path = os.path.join(self.env.path, self.render_cache_dir)
+        return RenderCache(path, self.render_cache_size * 1024 * 1024,
+                           self.log)
+
+    def _send_rendered(self, req, g, format_, mimetype):
+        """Send the graph rendered in `format_`, or a 304 response if the
+        client already has it.
+        """
+        source = to_unicode(g)
+        key = render_key(source, format_)
+        etag = '"%s"' % key
+        if req.get_header('If-None-Match') == etag:
+            req.send_response(304)
+            req.send_header('Content-Length', 0)
+            req.end_headers()
+            raise RequestDone
+        req.send_header('ETag', etag)
+        req.send(self._render(g, format_, source), mimetype)
+
+    def _render(self, g, format_, source=None):
+        """Render the graph in `format_`, from the render cache if it
+        has been rendered before. The `gs-png` format is rendered with
+        ghostscript.
+        """
+        if format_ == 'gs-png':
+            render_fn = functools.partial(self._render_gs, g)
+        else:
+            render_fn = functools.partial(g.render, self.dot_path, format_)
+        cache = self.render_cache
+        if cache is None:
+            return render_fn()
+        if source is None:
+            source = to_unicode(g)
+        return cache.render(render_key(source, format_), render_fn)
+
+    def _render_gs(self, g):
+        ps = g.render(self.dot_path, 'ps2')
+        gs = subprocess.Popen(
+            [self.gs_path, '-q', '-dTextAlphaBits=4',
+             '-dGraphicsAlphaBits=4', '-sDEVICE=png16m',
+             '-sOutputFile=%stdout%', '-'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        img, err = gs.communicate(ps)
+        if err:
+            self.log.debug('MasterTickets: Error from gs: %s', err)
+        return img
+
     def _build_graph(self, req, tkt_ids, label_summary=0):
         g = graphviz.Graph(log=self.log)
         g.label_summary = label_summary
@@ -334,27 +398,31 @@ class MasterTicketsModule(Component):
             g[-2]['fillcolor'] = self.opened_color
             g[-2]['shape'] = 'box'
 
-        links = TicketLinks.walk_tickets(self.env, tkt_ids, self.full_graph)
-        links = sorted(links, key=lambda link: link.tkt.id)
+        links = TicketLinks.walk_tickets(self.env, tkt_ids, self.full_graph,
+                                         self.graph_depth or None)
+        links = sorted(links, key=lambda link: link.id)
+        # With a graph_depth, the tickets at the boundary keep links to
+        # tickets which weren't walked
+        walked = set(link.id for link in links)
         for link in links:
-            tkt = link.tkt
-            node = g[tkt.id]
+            node = g[link.id]
             if label_summary:
-                label = u'#%s %s' % (tkt.id, tkt['summary'])
+                label = u'#%s %s' % (link.id, link.summary)
             else:
-                label = u'#%s' % tkt.id
+                label = u'#%s' % link.id
             node['label'] = escape('\n'.join(textwrap.wrap(label, 30)))
-            node['fillcolor'] = tkt['status'] == 'closed' and \
+            node['fillcolor'] = link.status == 'closed' and \
                                 self.closed_color or self.opened_color
-            node['URL'] = req.href.ticket(tkt.id)
-            node['alt'] = u'Ticket #%s' % tkt.id
-            node['tooltip'] = escape('#%s (%s) %s' % (tkt.id, tkt['status'],
-                                                      tkt['summary']))
-            if self.highlight_target and tkt.id in tkt_ids:
+            node['URL'] = req.href.ticket(link.id)
+            node['alt'] = u'Ticket #%s' % link.id
+            node['tooltip'] = escape('#%s (%s) %s' % (link.id, link.status,
+                                                      link.summary))
+            if self.highlight_target and link.id in tkt_ids:
                 node['penwidth'] = 3
 
             for n in link.blocking:
-                node > g[n]
+                if n in walked:
+                    node > g[n]
 
         return g
 
@@ -7,11 +7,14 @@
 # you should have received as part of this distribution.
 #
 
+from trac.admin import AdminCommandError, IAdminCommandProvider
 from trac.admin import IAdminPanelProvider
 from trac.core import Component, implements
+from trac.util.text import printout
 from trac.web.chrome import Chrome, add_warning
 
 from tractags.api import TagSystem, _
+from tractags.model import rebuild_tag_frequency
 
 
 class TagChangeAdminPanel(Component):
@@ -63,3 +66,34 @@ class TagChangeAdminPanel(Component):
         chrome.add_textarea_grips(req)
 
         return 'admin_tag_change.html', data, {'domain': 'tractags'}
+
+
+class TagAdminCommands(Component):
+    """[opt] Provides `trac-admin` commands for tag system maintenance."""
+
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('tags resync', '[realm]',
+               """Rebuild the tag frequency table
+
+               Recount the tags of all or only the given tag realm, after
+               tags have been changed directly in the database.
+               """,
+               self._complete_realms, self._do_resync)
+
+    # Internal methods
+
+    def _complete_realms(self, args):
+        if len(args) == 1:
+            return sorted(TagSystem(self.env).get_taggable_realms())
+
+    def _do_resync(self, realm=None):
+        if realm and \
+                realm not in TagSystem(self.env).get_taggable_realms():
+            raise AdminCommandError(_("Tags are not supported on the '%s' "
+                                      "realm") % realm)
+        rebuild_tag_frequency(self.env, realm)
+        printout(_("Tag frequencies rebuilt"))
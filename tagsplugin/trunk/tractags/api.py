@@ -13,13 +13,14 @@ import collections
 import pkg_resources
 import re
 import threading
+from itertools import groupby, islice
 
 from trac.config import BoolOption, ListOption, Option
 from trac.core import Component, ExtensionPoint, Interface, TracError
 from trac.core import implements
 from trac.perm import IPermissionPolicy, IPermissionRequestor
 from trac.perm import PermissionError, PermissionSystem
-from trac.resource import IResourceManager, get_resource_url
+from trac.resource import IResourceManager, Resource, get_resource_url
 from trac.resource import get_resource_description
 from trac.util import get_reporter_id
 from trac.util.text import to_unicode
@@ -32,8 +33,8 @@ add_domain, _, N_, gettext, ngettext, tag_, tagn_ = \
                                   'ngettext', 'tag_', 'tagn_'))
 dgettext = None
 
-from tractags.model import resource_tags, tag_frequency, tag_resource
-from tractags.model import tagged_resources
+from tractags.model import TagIndex, resource_tags, tag_frequency
+from tractags.model import tag_resource, tagged_resources
 # Now call module importing i18n methods from here.
 from tractags.query import *
 
@@ -91,6 +92,22 @@ class ITagProvider(Interface):
         """Return a one line description of the tagged resource."""
 
 
+class ITagPermissionPolicy(Interface):
+    """The interface for permission policies, that are able to decide on
+    permissions for many tagged resources at once.
+    """
+    def check_tagged_permissions(action, perm, tagged):
+        """Check a permission for a batch of tagged resources.
+
+        :param action: The permission action, i.e. 'WIKI_VIEW'.
+        :param perm: The `PermissionCache` of the user.
+        :param tagged: A list of (resource, tags) tuples.
+
+        :rtype: dict of {resource_id: decision}; resources without a
+                decision are checked one by one as usual.
+        """
+
+
 class DefaultTagProvider(Component):
     """An abstract base tag provider that stores tags in the database.
 
@@ -104,9 +121,14 @@ class DefaultTagProvider(Component):
 
     abstract = True
 
+    tag_permission_policies = ExtensionPoint(ITagPermissionPolicy)
+
     # Resource realm this provider manages tags for. Set this.
     realm = None
 
+    # Number of resources permission checked together.
+    chunk_size = 1000
+
     revisable = False
 
     def __init__(self):
@@ -125,6 +147,49 @@ class DefaultTagProvider(Component):
         map = {'view': 'TAGS_VIEW', 'modify': 'TAGS_MODIFY'}
         return map[action] in perm('tag')
 
+    def check_resource_permission(self, req, resource, action):
+        """Check permissions for a single resource or, if `resource` is
+        `None`, for the whole realm.
+        """
+        perm = resource and req.perm(resource) or req.perm
+        return self.check_permission(perm, action)
+
+    def filter_permitted(self, req, tagged, action='view'):
+        """Return the (resource, tags) tuples permitted for `action`.
+
+        Resources are checked in chunks, each being offered to the
+        `ITagPermissionPolicy` implementations before falling back to
+        `check_resource_permission`.
+        """
+        tagged = iter(tagged)
+        while True:
+            chunk = list(islice(tagged, self.chunk_size))
+            if not chunk:
+                return
+            decisions = self._check_tagged_permissions(req.perm, chunk, action)
+            for resource, tags in chunk:
+                decision = decisions.get(resource.id)
+                if decision is None:
+                    decision = self.check_resource_permission(req, resource,
+                                                              action)
+                if decision:
+                    yield resource, tags
+
+    def query_tagged_resources(self, req, query):
+        """Return a sequence of resources matching a `Query` and all their
+        tags, sorted by name.
+
+        Resources are selected from the realm's inverted tag index. Only the
+        realm is checked for view permission, resources must be checked by
+        `check_resource_permission` before showing them.
+        """
+        if not self.check_resource_permission(req, None, 'view'):
+            return
+        index = TagIndex(self.env, self.realm)
+        names = index.names
+        for name in index.query(query, self._is_excluded):
+            yield Resource(self.realm, name), set(names[name])
+
     # ITagProvider methods
 
     def get_taggable_realm(self):
@@ -133,8 +198,12 @@ class DefaultTagProvider(Component):
     def get_tagged_resources(self, req, tags=None, filter=None):
         if not self.check_permission(req.perm, 'view'):
             return
+        def batch_check(tagged):
+            return self._check_tagged_permissions(req.perm, tagged, 'view')
         return tagged_resources(self.env, self.check_permission, req.perm,
-                                self.realm, tags, filter)
+                                self.realm, tags, filter,
+                                chunk_size=self.chunk_size,
+                                batch_check=batch_check)
 
     def get_all_tags(self, req, filter=None):
         all_tags = collections.Counter()
@@ -179,11 +248,25 @@ class DefaultTagProvider(Component):
     def _get_author(self, req):
         return get_reporter_id(req, 'author')
 
+    def _check_tagged_permissions(self, perm, tagged, action):
+        action = '%s_%s' % (self.realm.upper(), action.upper())
+        decisions = {}
+        for policy in self.tag_permission_policies:
+            for id, decision in \
+                    (policy.check_tagged_permissions(action, perm, tagged) or
+                     {}).items():
+                decisions.setdefault(id, decision)
+        return decisions
+
+    def _is_excluded(self, name):
+        """Whether a tagged resource is hidden from tag queries."""
+        return False
+
 
 class TagPolicy(Component):
     """[extra] Security policy based on tags."""
 
-    implements(IPermissionPolicy)
+    implements(IPermissionPolicy, ITagPermissionPolicy)
 
     def check_permission(self, action, username, resource, perm):
         if resource is None or action.split('_')[0] != resource.realm.upper():
@@ -191,13 +274,30 @@ class TagPolicy(Component):
 
         from tractags.api import TagSystem
 
-        class FakeRequest(object):
-            def __init__(self, perm):
-                self.perm = perm
+        tags = TagSystem(self.env).get_tags(None, resource)
+        return self._check_tags(action, username, resource.realm, tags)
+
+    # ITagPermissionPolicy method
+
+    def check_tagged_permissions(self, action, perm, tagged):
+        policies = PermissionSystem(self.env).policies
+        if not policies or policies[0] is not self:
+            # Leave decisions to the permission system, if preceding
+            # policies might overrule this one.
+            return {}
+        decisions = {}
+        for resource, tags in tagged:
+            if action.split('_')[0] == resource.realm.upper():
+                decision = self._check_tags(action, perm.username,
+                                            resource.realm, tags)
+                if decision is not None:
+                    decisions[resource.id] = decision
+        return decisions
+
+    # Internal methods
 
+    def _check_tags(self, action, username, realm, tags):
         permission = action.lower().split('_')[1]
-        req = FakeRequest(perm)
-        tags = TagSystem(self.env).get_tags(None, resource)
 
         # Explicitly denied?
         if ':-'.join((username, permission)) in tags:
@@ -206,7 +306,7 @@ class TagPolicy(Component):
         # Find all granted permissions for the requesting user from
         # tagged permissions by expanding any meta action as well.
         if action in set(PermissionSystem(self.env).expand_actions(
-                         ['_'.join([resource.realm, t.split(':')[1]]).upper()
+                         ['_'.join([realm, t.split(':')[1]]).upper()
                           for t in tags if t.split(':')[0] == username])):
             return True
 
@@ -250,14 +350,23 @@ class TagSystem(Component):
 
     # Public methods
 
-    def query(self, req, query='', attribute_handlers=None):
+    def query(self, req, query='', attribute_handlers=None,
+              check_permission=True):
         """Returns a sequence of (resource, tags) tuples matching a query.
 
         Query syntax is described in tractags.query.
 
+        Realms of providers supporting `query_tagged_resources` are queried
+        through their inverted tag index, others by matching all candidate
+        resources.
+
         :param attribute_handlers: Register additional query attribute
                                    handlers. See Query documentation for more
                                    information.
+        :param check_permission: If `False`, view permission checks are not
+                                 done per resource for indexed realms. Pass
+                                 the resources actually shown through
+                                 `filter_permitted` then.
         """
         def realm_handler(_, node, context):
             return query.match(node, [context.realm])
@@ -277,11 +386,30 @@ class TagSystem(Component):
         query_tags = set(query.terms())
         for provider in providers:
             self.env.log.debug('Querying ' + repr(provider))
+            if not attribute_handlers and \
+                    hasattr(provider, 'query_tagged_resources'):
+                results = provider.query_tagged_resources(req, query) or []
+                if check_permission:
+                    results = provider.filter_permitted(req, results)
+                for resource, tags in results:
+                    yield resource, tags
+                continue
             for resource, tags in provider.get_tagged_resources(req,
                                                           query_tags) or []:
                 if query(tags, context=resource):
                     yield resource, tags
 
+    def filter_permitted(self, req, results):
+        """Filter (resource, tags) tuples from an unchecked `query` result
+        by view permission.
+        """
+        for realm, tagged in groupby(results, lambda r: r[0].realm):
+            provider = self._get_provider(realm)
+            if hasattr(provider, 'filter_permitted'):
+                tagged = provider.filter_permitted(req, tagged)
+            for resource, tags in tagged:
+                yield resource, tags
+
     def get_taggable_realms(self, perm=None):
         """Returns the names of available taggable realms as set.
 
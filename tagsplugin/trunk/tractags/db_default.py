@@ -8,7 +8,7 @@
 
 from trac.db import Table, Column, Index
 
-schema_version = 4
+schema_version = 5
 
 
 schema = [
@@ -26,6 +26,11 @@ schema = [
         Column('author'),
         Column('oldtags'),
         Column('newtags'),
+    ],
+    Table('tags_frequency', key=('tagspace', 'tag'))[
+        Column('tagspace'),
+        Column('tag'),
+        Column('frequency', type='int'),
     ]
 ]
 
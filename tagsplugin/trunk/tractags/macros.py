@@ -207,7 +207,9 @@ class TagWikiMacros(TagTemplateProvider):
                     return ''
             query = '(%s) (%s)' % (query or '', ' or '.join(['realm:%s' % (r)
                                                              for r in realms]))
-            query_result = tag_system.query(req, query)
+            # Check view permissions on the displayed page only.
+            query_result = tag_system.query(req, query,
+                                            check_permission=False)
             excludes = [exc.strip()
                         for exc in kw.get('exclude', '' ).split(':')
                         if exc.strip()]
@@ -260,7 +262,7 @@ class TagWikiMacros(TagTemplateProvider):
                 return system_message(_("ListTagged macro error"), e)
             results = self._paginate(req, results, realms)
             rows = []
-            for resource, tags in results:
+            for resource, tags in tag_system.filter_permitted(req, results):
                 desc = tag_system.describe_tagged_resource(req, resource)
                 tags = sorted(tags)
                 wiki_desc = format_to_oneliner(env, context, desc)
@@ -10,6 +10,7 @@
 from datetime import datetime
 from itertools import groupby
 
+from trac.cache import cached
 from trac.resource import Resource
 from trac.util.datefmt import to_datetime, to_utimestamp, utc
 from trac.util.text import to_unicode
@@ -20,6 +21,64 @@ from tractags.util import split_into_tags
 # Public functions (not yet)
 
 
+class TagIndex(object):
+    """In-memory inverted index of the tags stored for one realm.
+
+    The index maps each tag to the set of tagged resource names and each
+    resource name back to its tags. It is kept in the process cache and
+    invalidated per realm by `tag_resource` and `delete_tags`, so writes to
+    one realm never discard the index of another one.
+    """
+
+    def __init__(self, env, realm):
+        self.env = env
+        self.realm = realm
+        self._index_id = 'tractags.model.TagIndex.%s' % realm
+
+    @cached('_index_id')
+    def _index(self):
+        names = {}
+        tags = {}
+        for name, tag in self.env.db_query("""
+                SELECT name, tag FROM tags WHERE tagspace=%s
+                """, (self.realm,)):
+            names.setdefault(name, set()).add(tag)
+            tags.setdefault(tag, set()).add(name)
+        return names, tags
+
+    def invalidate(self):
+        del self._index
+
+    @property
+    def names(self):
+        """Return a mapping of all tagged resource names to their tags."""
+        return self._index[0]
+
+    @property
+    def tags(self):
+        """Return a mapping of all tags to the names of tagged resources."""
+        return self._index[1]
+
+    def query(self, query, exclude=None):
+        """Return the sorted names of resources matching a `Query`.
+
+        :param exclude: If provided, a callable returning `True` for names
+                        to skip.
+        """
+        names = self.names
+        universe = set(names)
+        if exclude:
+            universe = set(n for n in universe if not exclude(n))
+        realm = self.realm
+
+        def realm_handler(_, node, ids):
+            return ids if query.match(node, [realm]) else set()
+
+        matches = query.as_set(self.tags, universe,
+                               attribute_handlers={'realm': realm_handler})
+        return sorted(matches & universe)
+
+
 # Utility functions
 
 def delete_tags(env, resource, tags=None, purge=False):
@@ -33,9 +92,15 @@ def delete_tags(env, resource, tags=None, purge=False):
         args += list(tags)
         sql += " AND tags.tag IN (%s)" % ','.join(['%s'] * len(tags))
     with env.db_transaction as db:
+        removed = [tag for tag, in db("""
+            SELECT tag FROM tags
+            WHERE tagspace=%%s AND name=%%s%s
+            """ % sql, args)]
         db("""DELETE FROM tags
               WHERE tagspace=%%s AND name=%%s%s
               """ % sql, args)
+        _update_frequency(db, resource.realm, removed, -1)
+        TagIndex(env, resource.realm).invalidate()
         if purge:
             # Call outside of another db transaction means resource destruction,
             # so purge change records too.
@@ -44,6 +109,21 @@ def delete_tags(env, resource, tags=None, purge=False):
                   """, (resource.realm, to_unicode(resource.id)))
 
 
+def rebuild_tag_frequency(env, realm=None):
+    """Recount tag frequencies for one or all realms from the tags table."""
+    sql = ''
+    args = []
+    if realm:
+        sql = " WHERE tagspace=%s"
+        args = [realm]
+    with env.db_transaction as db:
+        db("DELETE FROM tags_frequency" + sql, args)
+        db("""INSERT INTO tags_frequency (tagspace, tag, frequency)
+              SELECT tagspace, tag, COUNT(*) FROM tags%s
+              GROUP BY tagspace, tag
+              """ % sql, args)
+
+
 def tag_changes(env, resource, start=None, stop=None):
     """Return tag history for one or all tagged Trac resources."""
     if resource:
@@ -63,16 +143,40 @@ def tag_changes(env, resource, start=None, stop=None):
 
 
 def tag_frequency(env, realm, filter=None, db=None):
-    """Return tags and numbers of their occurrence."""
-    if filter:
-        sql = ''.join(" AND %s" % f for f in filter)
+    """Return tags and numbers of their occurrence.
+
+    Without a filter the maintained `tags_frequency` table is read, otherwise
+    tags are counted from matching resources.
+    """
+    if not filter:
+        for row in env.db_query("""
+                SELECT tag,frequency FROM tags_frequency
+                WHERE tagspace=%s
+                """, (realm,)):
+            yield row[0], row[1]
+        return
+    sql = ''.join(" AND %s" % f for f in filter)
     for row in env.db_query("""
             SELECT tag,count(tag) FROM tags
             WHERE tagspace=%%s%s GROUP BY tag
-            """ % (filter and sql or ''), (realm,)):
+            """ % sql, (realm,)):
         yield row[0], row[1]
 
 
+def last_tag_change(env, realms):
+    """Return the time of the latest recorded tag change in any of the
+    given realms, or `None`.
+    """
+    realms = list(realms)
+    if realms:
+        for time, in env.db_query("""
+                SELECT MAX(time) FROM tags_change
+                WHERE tagspace IN (%s)
+                """ % ','.join(['%s'] * len(realms)), realms):
+            if time:
+                return to_datetime(time)
+
+
 def tag_resource(env, resource, old_id=None, author='anonymous', tags=None,
                  log=False, when=None):
     """Save tags and tag changes for a Trac resource.
@@ -98,6 +202,7 @@ def tag_resource(env, resource, old_id=None, author='anonymous', tags=None,
                WHERE tagspace=%s AND name=%s
                """, (to_unicode(resource.id), resource.realm,
                      to_unicode(old_id)))
+            TagIndex(env, resource.realm).invalidate()
     else:
         # Calculate effective tag changes.
         old_tags = set(resource_tags(env, resource))
@@ -117,6 +222,8 @@ def tag_resource(env, resource, old_id=None, author='anonymous', tags=None,
                     VALUES (%s,%s,%s)
                     """, [(resource.realm, to_unicode(resource.id), tag)
                           for tag in add])
+                _update_frequency(db, resource.realm, add, 1)
+                TagIndex(env, resource.realm).invalidate()
             if log:
                 db("""
                   INSERT INTO tags_change
@@ -129,10 +236,17 @@ def tag_resource(env, resource, old_id=None, author='anonymous', tags=None,
 
 
 def tagged_resources(env, perm_check, perm, realm, tags=None, filter=None,
-                     db=None):
+                     db=None, chunk_size=1000, batch_check=None):
     """Return Trac resources including their associated tags.
 
-    This is currently known to be a major performance hog.
+    Resources are read and permission checked in chunks of `chunk_size`
+    names with a single grouped query per chunk, so neither memory usage nor
+    the size of the SQL statements grow with the number of tagged resources.
+
+    :param batch_check: If provided, a callable taking a list of
+                        (resource, tags) tuples and returning a dict of
+                        resource ids to permission decisions. Resources
+                        without a decision are checked with `perm_check`.
     """
     args = [realm]
     sql = """
@@ -144,27 +258,32 @@ def tagged_resources(env, perm_check, perm, realm, tags=None, filter=None,
     if tags:
         sql += " AND tags.tag IN (%s)" % ','.join(['%s' for tag in tags])
         args += tags
-    sql += " ORDER by name"
-
-    # Inline permission check for efficiency.
-    resources = {}
-    for name, in env.db_query(sql, args):
-        resource = Resource(realm, name)
-        if perm_check(perm(resource), 'view'):
-            resources[resource.id] = resource
-    if not resources:
-        return
+    sql = """
+        SELECT t.name, t.tag
+          FROM (%s AND name>%%s ORDER BY name LIMIT %%s) AS s
+         INNER JOIN tags AS t ON (t.tagspace=%%s AND t.name=s.name)
+         ORDER BY t.name
+        """ % sql
 
-    # DEVEL: Is this going to be excruciatingly slow?
-    #        The explicite resource ID list might even grow beyond some limit.
-    for name, tags in groupby(env.db_query("""
-            SELECT DISTINCT name, tag FROM tags
-            WHERE tagspace=%%s AND name IN (%s)
-            ORDER BY name
-            """ % ', '.join(['%s'] * len(resources)),
-            [realm] + list(resources.keys())), lambda row: row[0]):
-        resource = resources[name]
-        yield resource, set([tag[1] for tag in tags])
+    last = ''
+    while True:
+        tagged = [(Resource(realm, name), set(tag[1] for tag in rows))
+                  for name, rows in groupby(env.db_query(sql, args +
+                                            [last, chunk_size, realm]),
+                                            lambda row: row[0])]
+        if not tagged:
+            return
+        last = tagged[-1][0].id
+        # Inline permission check for efficiency.
+        decisions = batch_check and batch_check(tagged) or {}
+        for resource, tags in tagged:
+            decision = decisions.get(resource.id)
+            if decision is None:
+                decision = perm_check(perm(resource), 'view')
+            if decision:
+                yield resource, tags
+        if len(tagged) < chunk_size:
+            return
 
 
 def resource_tags(env, resource, when=None):
@@ -186,3 +305,33 @@ def resource_tags(env, resource, when=None):
                 """, (resource.realm, id, when)):
             for tag in split_into_tags(newtags):
                 yield tag
+
+
+# Internal functions
+
+def _update_frequency(db, realm, tags, delta):
+    """Adjust the `tags_frequency` table for tags added to or removed from
+    one resource.
+    """
+    tags = list(tags)
+    if not tags:
+        return
+    db.executemany("""
+        UPDATE tags_frequency SET frequency=frequency+%s
+        WHERE tagspace=%s AND tag=%s
+        """, [(delta, realm, tag) for tag in tags])
+    in_tags = ','.join(['%s'] * len(tags))
+    if delta > 0:
+        known = set(tag for tag, in db("""
+            SELECT tag FROM tags_frequency
+            WHERE tagspace=%%s AND tag IN (%s)
+            """ % in_tags, [realm] + tags))
+        db.executemany("""
+            INSERT INTO tags_frequency (tagspace, tag, frequency)
+            VALUES (%s,%s,%s)
+            """, [(realm, tag, delta) for tag in tags if tag not in known])
+    else:
+        db("""
+            DELETE FROM tags_frequency
+            WHERE tagspace=%%s AND tag IN (%s) AND frequency<=0
+            """ % in_tags, [realm] + tags)
@@ -393,6 +393,47 @@ class Query(QueryNode):
                 raise NotImplementedError
         return _convert(self)
 
+    def as_set(self, index, universe, attribute_handlers=None):
+        """Convert Query to set operations on an inverted index.
+
+        `index` maps terms to the set of ids they are associated with,
+        `universe` is the set of all ids, that negation is applied to.
+
+        Attribute handlers are callables with the signature
+        (attribute_name, node, ids) returning the subset of ids matching
+        the RHS node of the attribute expression.
+
+        >>> index = {'foo': set([1, 2]), 'bar': set([2, 3])}
+        >>> sorted(Query('foo bar').as_set(index, set([1, 2, 3, 4])))
+        [2]
+        >>> sorted(Query('foo or bar').as_set(index, set([1, 2, 3, 4])))
+        [1, 2, 3]
+        >>> sorted(Query('-foo').as_set(index, set([1, 2, 3, 4])))
+        [3, 4]
+        """
+        attribute_handlers = attribute_handlers or {}
+        empty = frozenset()
+
+        def _convert(node):
+            if not node or not node.type or node.type == node.NULL:
+                return universe
+            if node.type == node.AND:
+                return _convert(node.left) & _convert(node.right)
+            elif node.type == node.OR:
+                return _convert(node.left) | _convert(node.right)
+            elif node.type == node.NOT:
+                return universe - _convert(node.left)
+            elif node.type == node.TERM:
+                return index.get(node.value, empty)
+            elif node.type == node.ATTR:
+                name = node.left.value
+                if name not in attribute_handlers:
+                    raise InvalidQuery(_("Invalid attribute '%s'") % name)
+                return attribute_handlers[name](name, node.right, universe)
+            else:
+                raise NotImplementedError
+        return _convert(self)
+
     def reduce(self, reduce):
         """Pass each TERM node through `Reducer`."""
         def _reduce(node):
@@ -11,9 +11,11 @@ import shutil
 import tempfile
 import unittest
 
+from trac.admin.api import AdminCommandError, AdminCommandManager
 from trac.test import EnvironmentStub
 
 from tractags.admin import TagChangeAdminPanel
+from tractags.db import TagSetup
 
 
 class TagChangeAdminPanelTestCase(unittest.TestCase):
@@ -32,9 +34,45 @@ class TagChangeAdminPanelTestCase(unittest.TestCase):
         pass
 
 
+class TagAdminCommandsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'tractags.*'])
+        self.env.path = tempfile.mkdtemp()
+        TagSetup(self.env).upgrade_environment()
+        self.cmd_mgr = AdminCommandManager(self.env)
+
+    def tearDown(self):
+        self.env.shutdown()
+        shutil.rmtree(self.env.path)
+
+    def test_resync(self):
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO tags (tagspace, name, tag) VALUES (%s,%s,%s)
+                """, [('wiki', 'WikiStart', 'tag1'),
+                      ('wiki', 'SandBox', 'tag1'),
+                      ('ticket', '1', 'tag2')])
+        self.cmd_mgr.execute_command('tags', 'resync', 'wiki')
+        self.assertEqual([('wiki', 'tag1', 2)], self.env.db_query("""
+            SELECT tagspace, tag, frequency FROM tags_frequency
+            """))
+        self.cmd_mgr.execute_command('tags', 'resync')
+        self.assertEqual([('ticket', 'tag2', 1), ('wiki', 'tag1', 2)],
+                         self.env.db_query("""
+            SELECT tagspace, tag, frequency FROM tags_frequency
+            ORDER BY tagspace
+            """))
+
+    def test_resync_invalid_realm(self):
+        self.assertRaises(AdminCommandError, self.cmd_mgr.execute_command,
+                          'tags', 'resync', 'invalid')
+
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TagChangeAdminPanelTestCase))
+    suite.addTest(unittest.makeSuite(TagAdminCommandsTestCase))
     return suite
 
 
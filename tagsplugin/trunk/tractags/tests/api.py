@@ -52,6 +52,7 @@ class _BaseTestCase(unittest.TestCase):
         with self.env.db_transaction as db:
             db("DROP TABLE IF EXISTS tags")
             db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_frequency")
             db("DELETE FROM system WHERE name='tags_version'")
             db("DELETE FROM permission WHERE action %s" % db.like(),
                ('TAGS_%',))
@@ -87,6 +88,22 @@ class TagPolicyTestCase(_BaseTestCase):
         self.assertEquals(self.check('WIKI_VIEW', 'anonymous', resource,
                                      PermissionCache(self.env)), False)
 
+    def test_check_tagged_permissions(self):
+        tagged = [(Resource('wiki', name), tags) for name, tags in
+                  [('PublicPage', set(['anonymous:view'])),
+                   ('RestrictedPage', set(['anonymous:-view'])),
+                   ('OtherPage', set(['other']))]]
+        policy = tractags.api.TagPolicy(self.env)
+        perm = PermissionCache(self.env)
+        self.assertEqual({'PublicPage': True, 'RestrictedPage': False},
+                         policy.check_tagged_permissions('WIKI_VIEW', perm,
+                                                         tagged))
+        # No decisions, if other policies are consulted first.
+        self.env.config.set('trac', 'permission_policies',
+                            'DefaultPermissionPolicy, TagPolicy')
+        self.assertEqual({}, policy.check_tagged_permissions('WIKI_VIEW',
+                                                             perm, tagged))
+
     def test_meta_action_granted(self):
         resource = Resource('wiki', 'UserPage')
         self.assertEquals(self.check('WIKI_DELETE', 'user', resource,
@@ -138,6 +155,45 @@ class TagSystemTestCase(_BaseTestCase):
                            self.tag_s.query(req, query='')],
                           [])
 
+    def test_query_tag_index(self):
+        req = MockRequest(self.env, authname='editor')
+        for name, tags in [('PageA', ['a']), ('PageB', ['b', 'c']),
+                           ('PageC', ['b'])]:
+            self.tag_s.set_tags(req, Resource('wiki', name), tags)
+        query = 'a or b -c'
+        self.assertEquals(['PageA', 'PageC'],
+                          [res.id for res, tags in
+                           self.tag_s.query(req, query)])
+        # Tag changes are reflected by the index.
+        self.tag_s.set_tags(req, Resource('wiki', 'PageC'), ['c'])
+        self.assertEquals([(Resource('wiki', 'PageA'), set(['a']))],
+                          list(self.tag_s.query(req, query)))
+        self.tag_s.delete_tags(req, Resource('wiki', 'PageA'))
+        self.assertEquals([], list(self.tag_s.query(req, query)))
+
+    def test_query_tag_index_realm(self):
+        req = MockRequest(self.env, authname='editor')
+        self.tag_s.set_tags(req, Resource('wiki', 'WikiStart'), ['a'])
+        self.assertEquals(1, len(list(self.tag_s.query(req, 'a realm:wiki'))))
+        self.assertEquals([], list(self.tag_s.query(req, 'a realm:ticket')))
+
+    def test_query_deferred_permission_check(self):
+        req = MockRequest(self.env, authname='editor')
+        for name in ('PageA', 'PageB'):
+            self.tag_s.set_tags(req, Resource('wiki', name), ['a'])
+        self.env.config.set('trac', 'permission_policies',
+                            'TagPolicy, DefaultPermissionPolicy')
+        self.tag_s.add_tags(req, Resource('wiki', 'PageB'),
+                            ['anonymous:-view'])
+        req = MockRequest(self.env, authname='anonymous')
+        results = list(self.tag_s.query(req, 'a', check_permission=False))
+        self.assertEquals(['PageA', 'PageB'], [r.id for r, t in results])
+        self.assertEquals(['PageA'], [r.id for r, t in
+                                      self.tag_s.filter_permitted(req,
+                                                                  results)])
+        self.assertEquals(['PageA'], [r.id for r, t in
+                                      self.tag_s.query(req, 'a')])
+
     def test_get_taggable_realms(self):
 
         class HiddenTagProvider(tractags.api.DefaultTagProvider):
@@ -39,6 +39,7 @@ class TagSetupTestCase(unittest.TestCase):
         with self.env.db_transaction as db:
             db("DROP TABLE IF EXISTS tags")
             db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_frequency")
             db("DELETE FROM system WHERE name='tags_version'")
             db("DELETE FROM permission WHERE action %s" % db.like(),
                ('TAGS_%',))
@@ -190,6 +191,26 @@ class TagSetupTestCase(unittest.TestCase):
                                'oldtags', 'newtags'], cols)
         self.assertEquals(db_default.schema_version, self.get_db_version())
 
+    def test_upgrade_schema_v4(self):
+        # Add table for tag frequencies to the schema.
+        setup = TagSetup(self.env)
+        setup.upgrade_environment()
+        with self.env.db_transaction as db:
+            db("DROP TABLE tags_frequency")
+            db("""INSERT INTO tags (tagspace, name, tag)
+                  VALUES ('wiki', 'WikiStart', 'tag')""")
+            db("UPDATE system SET value='4' WHERE name='tags_version'")
+
+        self.assertEquals(4, setup.get_schema_version())
+        self.assertTrue(setup.environment_needs_upgrade())
+
+        setup.upgrade_environment()
+        self.assertFalse(setup.environment_needs_upgrade())
+        # Tag frequencies should be counted from existing tags.
+        self.assertEqual([('wiki', 'tag', 1)],
+                         self.env.db_query("SELECT * FROM tags_frequency"))
+        self.assertEquals(db_default.schema_version, self.get_db_version())
+
 
 def test_suite():
     suite = unittest.TestSuite()
@@ -21,12 +21,14 @@ from trac.wiki.test import wikisyntax_test_suite
 
 from tractags.db import TagSetup
 from tractags.macros import TagWikiMacros, query_realms
+from tractags.model import rebuild_tag_frequency
 
 
 def _revert_tractags_schema_init(env):
     with env.db_transaction as db:
         db("DROP TABLE IF EXISTS tags")
         db("DROP TABLE IF EXISTS tags_change")
+        db("DROP TABLE IF EXISTS tags_frequency")
         db("DELETE FROM system WHERE name='tags_version'")
         db("DELETE FROM permission WHERE action %s" % db.like(),
            ('TAGS_%',))
@@ -38,6 +40,7 @@ def _insert_tags(env, tagspace, name, tags):
         db.executemany("""
             INSERT INTO tags (tagspace,name,tag) VALUES (%s,%s,%s)
             """, args)
+        rebuild_tag_frequency(env, tagspace)
 
 
 class _BaseTestCase(unittest.TestCase):
@@ -15,7 +15,9 @@ from trac.resource import Resource
 from trac.test import EnvironmentStub, MockRequest
 
 from tractags.db import TagSetup
-from tractags.model import resource_tags, tag_resource, tagged_resources
+from tractags.model import delete_tags, rebuild_tag_frequency
+from tractags.model import resource_tags, tag_frequency, tag_resource
+from tractags.model import tagged_resources
 from tractags.wiki import WikiTagProvider
 
 
@@ -52,6 +54,7 @@ class TagModelTestCase(unittest.TestCase):
         with self.env.db_transaction as db:
             db("DROP TABLE IF EXISTS tags")
             db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_frequency")
             db("DELETE FROM system WHERE name='tags_version'")
             db("DELETE FROM permission WHERE action %s" % db.like(),
                ('TAGS_%',))
@@ -92,6 +95,56 @@ class TagModelTestCase(unittest.TestCase):
                                               self.realm, tags)],
                          [(resource, tags)])
 
+    def test_get_tagged_resources_chunked(self):
+        perm = PermissionCache(self.env)
+        for name in ('PageA', 'PageB', 'PageC'):
+            tag_resource(self.env, Resource(self.realm, name),
+                         author=self.req.authname, tags=['tag1', 'tag2'])
+        tags = set(['tag1', 'tag2'])
+        expected = [(Resource(self.realm, name), tags)
+                    for name in ('PageA', 'PageB', 'PageC')] + \
+                   [(Resource(self.realm, 'WikiStart'), set(['tag1']))]
+        for chunk_size in (1, 2, 4, 5):
+            self.assertEqual(expected,
+                             list(tagged_resources(self.env, self.check_perm,
+                                                   perm, self.realm, ['tag1'],
+                                                   chunk_size=chunk_size)))
+
+    def test_get_tagged_resources_batch_check(self):
+        self.perms.revoke_permission('anonymous', 'WIKI_VIEW')
+        perm = PermissionCache(self.env)
+        tag_resource(self.env, Resource(self.realm, 'PageA'),
+                     author=self.req.authname, tags=['tag1'])
+        checked = []
+
+        def batch_check(tagged):
+            checked.append([resource.id for resource, tags in tagged])
+            return {'PageA': True}
+        self.assertEqual([(Resource(self.realm, 'PageA'), set(['tag1']))],
+                         list(tagged_resources(self.env, self.check_perm,
+                                               perm, self.realm, ['tag1'],
+                                               chunk_size=1,
+                                               batch_check=batch_check)))
+        self.assertEqual([['PageA'], ['WikiStart']], checked)
+
+    def test_tag_frequency(self):
+        # Initial test data has been inserted directly.
+        rebuild_tag_frequency(self.env)
+        self.assertEqual([('tag1', 1)],
+                         list(tag_frequency(self.env, self.realm)))
+        tag_resource(self.env, Resource(self.realm, 'TaggedPage'),
+                     author=self.req.authname, tags=['tag1', 'tag2'])
+        self.assertEqual([('tag1', 2), ('tag2', 1)],
+                         sorted(tag_frequency(self.env, self.realm)))
+        tag_resource(self.env, Resource(self.realm, 'TaggedPage'),
+                     author=self.req.authname, tags=['tag2', 'tag3'])
+        self.assertEqual([('tag1', 1), ('tag2', 1), ('tag3', 1)],
+                         sorted(tag_frequency(self.env, self.realm)))
+        delete_tags(self.env, Resource(self.realm, 'TaggedPage'))
+        self.assertEqual([('tag1', 1)],
+                         list(tag_frequency(self.env, self.realm)))
+        self.assertEqual([], list(tag_frequency(self.env, 'ticket')))
+
     def test_reparent(self):
         resource = Resource(self.realm, 'TaggedPage')
         old_name = 'WikiStart'
@@ -14,11 +14,13 @@ import unittest
 
 from trac.test import EnvironmentStub, MockPerm, MockRequest
 from trac.perm import PermissionSystem, PermissionError
+from trac.resource import Resource
 from trac.web.api import RequestDone
 from trac.web.main import RequestDispatcher
 
 from tractags.api import TagSystem
 from tractags.db import TagSetup
+from tractags.model import tag_resource
 from tractags.web_ui import TagInputAutoComplete, TagRequestHandler
 from tractags.web_ui import TagTimelineEventFilter, TagTimelineEventProvider
 
@@ -55,6 +57,7 @@ class _BaseTestCase(unittest.TestCase):
         with self.env.db_transaction as db:
             db("DROP TABLE IF EXISTS tags")
             db("DROP TABLE IF EXISTS tags_change")
+            db("DROP TABLE IF EXISTS tags_frequency")
             db("DELETE FROM system WHERE name='tags_version'")
             db("DELETE FROM permission WHERE action %s" % db.like(),
                ('TAGS_%',))
@@ -140,6 +143,24 @@ class TagRequestHandlerTestCase(_BaseTestCase):
                            'tag_body', 'tag_query', 'tag_realms'],
                           sorted(data.keys()))
 
+    def test_get_main_page_not_modified(self):
+        PermissionSystem(self.env).grant_permission('reader', 'WIKI_VIEW')
+        req = MockRequest(self.env, path_info='/tags', authname='reader')
+        self.tag_rh.process_request(req)
+        etag = dict(req._outheaders)['ETag']
+
+        req = MockRequest(self.env, path_info='/tags', authname='reader')
+        req.environ['HTTP_IF_NONE_MATCH'] = etag
+        self.assertRaises(RequestDone, self.tag_rh.process_request, req)
+        self.assertEqual(['304 Not Modified'], req.status_sent)
+
+        # A changed cloud has to be rendered again.
+        tag_resource(self.env, Resource('wiki', 'WikiStart'), tags=['tag1'])
+        req = MockRequest(self.env, path_info='/tags', authname='reader')
+        req.environ['HTTP_IF_NONE_MATCH'] = etag
+        self.tag_rh.process_request(req)
+        self.assertNotEqual(etag, dict(req._outheaders)['ETag'])
+
     def test_get_main_page_no_permission(self):
         req = MockRequest(self.env, path_info='/tags', authname='anonymous')
         self.assertRaises(PermissionError, self.tag_rh.process_request, req)
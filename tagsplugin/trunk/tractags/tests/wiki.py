@@ -18,6 +18,7 @@ from trac.wiki.test import wikisyntax_test_suite
 
 from tractags.api import TagSystem
 from tractags.db import TagSetup
+from tractags.model import rebuild_tag_frequency
 from tractags.wiki import WikiTagProvider
 
 
@@ -25,6 +26,7 @@ def _revert_tractags_schema_init(env):
     with env.db_transaction as db:
         db("DROP TABLE IF EXISTS tags")
         db("DROP TABLE IF EXISTS tags_change")
+        db("DROP TABLE IF EXISTS tags_frequency")
         db("DELETE FROM system WHERE name='tags_version'")
         db("DELETE FROM permission WHERE action %s" % db.like(),
            ('TAGS_%',))
@@ -223,6 +225,7 @@ class WikiTagProviderTestCase(unittest.TestCase):
             INSERT INTO tags (tagspace, name, tag)
             VALUES ('wiki', 'PageTemplates/Template', 'tag2')
             """)
+        rebuild_tag_frequency(self.env)
         tags = ['tag1', 'tag2']
         self.assertEquals(list(self.tag_s.get_all_tags(req).keys()), self.tags)
         self.env.config.set('tags', 'query_exclude_wiki_templates', False)
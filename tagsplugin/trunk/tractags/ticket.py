@@ -20,7 +20,7 @@ from trac.util import get_reporter_id
 from trac.util.text import to_unicode
 
 from tractags.api import DefaultTagProvider, _
-from tractags.model import delete_tags
+from tractags.model import TagIndex, delete_tags, rebuild_tag_frequency
 from tractags.util import MockReq, split_into_tags
 
 
@@ -68,6 +68,9 @@ class TicketTagProvider(DefaultTagProvider):
         return self.check_permission(perm, action) and \
                self.map[action] in perm
 
+    def check_resource_permission(self, req, resource, action):
+        return self._check_permission(req, resource, action)
+
     def get_tagged_resources(self, req, tags=None, filter=None):
         if not self._check_permission(req, None, 'view'):
             return
@@ -219,6 +222,7 @@ class TicketTagProvider(DefaultTagProvider):
                                    WHERE tkt.id=%s%s)
                 """ % (db.cast('tags.name', 'int'), ignore),
                 (self.realm,))
+            changed = rw_cursor.rowcount > 0
 
             ro_cursor.execute(sql, (self.realm,))
 
@@ -229,6 +233,11 @@ class TicketTagProvider(DefaultTagProvider):
                     INSERT INTO tags (tagspace, name, tag)
                     VALUES (%s, %s, %s)
                     """, [(self.realm, str(tkt_id), tag) for tag in ticket_tags])
+                changed = True
+            if changed:
+                rebuild_tag_frequency(self.env, self.realm)
+                TagIndex(self.env, self.realm).invalidate()
+
     @cached
     def _tagged_resources(self):
         """Cached version."""
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+
+from trac.db import Table, Column, DatabaseManager
+
+schema = [
+    Table('tags_frequency', key=('tagspace', 'tag'))[
+        Column('tagspace'),
+        Column('tag'),
+        Column('frequency', type='int'),
+    ]
+]
+
+
+def do_upgrade(env, ver, cursor):
+    """Add new table for tag frequencies per realm."""
+
+    connector = DatabaseManager(env).get_connector()[0]
+    for table in schema:
+        for stmt in connector.to_sql(table):
+            cursor.execute(stmt)
+    cursor.execute("""
+        INSERT INTO tags_frequency
+               (tagspace, tag, frequency)
+            SELECT tagspace, tag, COUNT(*)
+              FROM tags
+             GROUP BY tagspace, tag
+        """)
@@ -20,6 +20,7 @@ from trac.resource import (
 from trac.test import MockRequest
 from trac.timeline.api import ITimelineEventProvider
 from trac.util.html import Markup, html as builder
+from trac.util.datefmt import to_datetime
 from trac.util.text import javascript_quote, to_unicode, unicode_quote_plus
 from trac.web.api import IRequestFilter, IRequestHandler
 from trac.web.chrome import (
@@ -31,7 +32,7 @@ from trac.wiki.model import WikiPage
 from tractags.api import REALM_RE, TagSystem, _, tag_, tagn_
 from tractags.macros import TagTemplateProvider, TagWikiMacros, as_int
 from tractags.macros import query_realms
-from tractags.model import tag_changes
+from tractags.model import last_tag_change, tag_changes
 from tractags.query import InvalidQuery, Query
 from tractags.util import JTransformer, split_into_tags
 
@@ -253,6 +254,8 @@ class TagRequestHandler(TagTemplateProvider):
                               self.cloud_mincount)
             args = mincount and "mincount=%s" % mincount or None
             data['mincount'] = mincount
+            self._check_cloud_modified(req, tag_system, checked_realms,
+                                       mincount)
 
         # When using the given req the page isn't rendered properly. The call
         # to expand_macro() leads to Chrome().render_template(req, ...).
@@ -281,6 +284,15 @@ class TagRequestHandler(TagTemplateProvider):
         add_stylesheet(req, 'tags/css/tractags.css')
         return 'tag_view.html', data, {'domain': 'tractags'}
 
+    # Private methods
+
+    def _check_cloud_modified(self, req, tag_system, realms, mincount):
+        """Send '304 Not Modified' for an unchanged tag cloud."""
+        all_tags = tag_system.get_all_tags(req, realms=realms)
+        last_change = last_tag_change(self.env, realms) or to_datetime(0)
+        req.check_modified(last_change, [sorted(all_tags.items()),
+                                         sorted(realms), mincount])
+
 
 class TagTimelineEventFilter(TagTemplateProvider):
     """[opt] Filters timeline events by tags associated with listed resources
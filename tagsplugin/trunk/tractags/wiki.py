@@ -74,13 +74,14 @@ class WikiTagProvider(DefaultTagProvider):
     def get_all_tags(self, req, filter=None):
         if not self.check_permission(req.perm, 'view'):
             return collections.Counter()
-        if self.exclude_templates:
-            with self.env.db_transaction as db:
-                like_templates = ''.join(
-                    ["'", db.like_escape(WikiModule.PAGE_TEMPLATES_PREFIX),
-                     "%%'"])
-                filter = (' '.join(['name NOT', db.like() % like_templates]),)
-        return super(WikiTagProvider, self).get_all_tags(req, filter)
+        all_tags = super(WikiTagProvider, self).get_all_tags(req, filter)
+        if self.exclude_templates and not filter:
+            # Deduct the few tags of page templates, reading an index range.
+            prefix = WikiModule.PAGE_TEMPLATES_PREFIX
+            filter = ("name>='%s'" % prefix,
+                      "name<'%s%s'" % (prefix[:-1], chr(ord(prefix[-1]) + 1)))
+            all_tags -= super(WikiTagProvider, self).get_all_tags(req, filter)
+        return all_tags
 
     def describe_tagged_resource(self, req, resource):
         if not self.check_permission(req.perm(resource), 'view'):
@@ -91,6 +92,10 @@ class WikiTagProvider(DefaultTagProvider):
             return ret and ret.group(1) or ''
         return ''
 
+    def _is_excluded(self, name):
+        return self.exclude_templates and \
+               name.startswith(WikiModule.PAGE_TEMPLATES_PREFIX)
+
 
 class WikiTagInterface(TagTemplateProvider):
     """[main] Implements the user interface for tagging Wiki pages."""
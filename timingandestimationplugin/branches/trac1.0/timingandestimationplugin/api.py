@@ -52,7 +52,7 @@ class TimeTrackingSetupParticipant(Component):
         # Setup logging
         self.statuses_key = 'T&E-statuses'
         self.db_version_key = 'TimingAndEstimationPlugin_Db_Version'
-        self.db_version = 6
+        self.db_version = 7
         # Initialise database schema version tracking.
         self.db_installed_version = dbhelper.get_system_value(self.env, \
             self.db_version_key) or 0
@@ -94,6 +94,24 @@ class TimeTrackingSetupParticipant(Component):
 
         #version 6 upgraded reports
 
+        if self.db_installed_version < 7:
+            if not dbhelper.db_table_exists(self.env, 'hours_ledger'):
+                print "Creating hours_ledger table"
+                sql = """
+                CREATE TABLE hours_ledger (
+                ticket integer,
+                time bigint,
+                author text,
+                hours decimal(10,2),
+                PRIMARY KEY (ticket, time)
+                );"""
+                dbhelper.execute_non_query(self.env, sql)
+                sql = "CREATE INDEX hours_ledger_time_idx ON hours_ledger (time)"
+                dbhelper.execute_non_query(self.env, sql)
+            print "Filling hours_ledger table"
+            with self.env.db_transaction as db:
+                rebuild_hours_ledger(db)
+
         # This statement block always goes at the end this method
         dbhelper.set_system_value(self.env, self.db_version_key, self.db_version)
         self.db_installed_version = self.db_version
@@ -8,7 +8,7 @@ billing_reports = [
         {
     "uuid":"b24f08c0-d41f-4c63-93a5-25e18a8513c2",
     "title":"Ticket Work Summary",
-    "version":21,
+    "version":22,
     "sql":"""
 SELECT __ticket__ as __group__, __style__, ticket,
 newvalue as Work_added, author, time as datetime, _ord
@@ -16,18 +16,16 @@ FROM(
   SELECT '' as __style__, author,
   t.summary as __ticket__,
   t.id as ticket,
-  CASE WHEN newvalue = '' OR newvalue IS NULL THEN 0.0
-    ELSE CAST( newvalue AS DECIMAL(10,2) ) END AS newvalue,
-  ticket_change.time as time, 0 as _ord
-  FROM ticket_change
-  JOIN ticket t on t.id = ticket_change.ticket
+  hours_ledger.hours as newvalue,
+  hours_ledger.time as time, 0 as _ord
+  FROM hours_ledger
+  JOIN ticket t on t.id = hours_ledger.ticket
   LEFT JOIN ticket_custom as billable on billable.ticket = t.id
     and billable.name = 'billable'
-  WHERE field = 'hours' and
-    t.status IN (#STATUSES#)
+  WHERE t.status IN (#STATUSES#)
       AND billable.value in ($BILLABLE, $UNBILLABLE)
-      AND ticket_change.time >= $STARTDATE
-      AND ticket_change.time < $ENDDATE
+      AND hours_ledger.time >= $STARTDATE
+      AND hours_ledger.time < $ENDDATE
 
   UNION
 
@@ -35,18 +33,16 @@ FROM(
     'Total work done on the ticket in the selected time period ' as author,
     t.summary as __ticket__,
     t.id as ticket,
-  SUM( CASE WHEN newvalue = '' OR newvalue IS NULL THEN 0.0
-         ELSE CAST( newvalue AS DECIMAL(10,2) ) END ) as newvalue,
+  SUM(hours_ledger.hours) as newvalue,
     NULL as time, 1 as _ord
-  FROM ticket_change
-  JOIN ticket t on t.id = ticket_change.ticket
+  FROM hours_ledger
+  JOIN ticket t on t.id = hours_ledger.ticket
   LEFT JOIN ticket_custom as billable on billable.ticket = t.id
     and billable.name = 'billable'
-  WHERE field = 'hours' and
-    t.status IN (#STATUSES#)
+  WHERE t.status IN (#STATUSES#)
       AND billable.value in ($BILLABLE, $UNBILLABLE)
-      AND ticket_change.time >= $STARTDATE
-      AND ticket_change.time < $ENDDATE
+      AND hours_ledger.time >= $STARTDATE
+      AND hours_ledger.time < $ENDDATE
   GROUP By t.id, t.summary
 )  as tbl
 ORDER BY __ticket__, _ord ASC, time ASC
@@ -56,7 +52,7 @@ ORDER BY __ticket__, _ord ASC, time ASC
         {
     "uuid":"af13564f-0e36-4a17-96c0-632dc68d8d14",
     "title":"Milestone Work Summary",
-    "version":18,
+    "version":19,
     "sql":"""
 
 SELECT
@@ -64,35 +60,31 @@ SELECT
   time  as datetime, _ord
 FROM(
   SELECT '' as __style__, t.id as ticket,
-    SUM( CASE WHEN newvalue = '' OR newvalue IS NULL THEN 0
-         ELSE CAST( newvalue AS DECIMAL(10,2) ) END) as newvalue, t.summary as summary,
-    MAX(ticket_change.time) as time, t.milestone as milestone, 0 as _ord
-  FROM ticket_change
-  JOIN ticket t on t.id = ticket_change.ticket
+    SUM(hours_ledger.hours) as newvalue, t.summary as summary,
+    MAX(hours_ledger.time) as time, t.milestone as milestone, 0 as _ord
+  FROM hours_ledger
+  JOIN ticket t on t.id = hours_ledger.ticket
   LEFT JOIN ticket_custom as billable on billable.ticket = t.id
     and billable.name = 'billable'
-  WHERE field = 'hours' and
-    t.status IN (#STATUSES#)
+  WHERE t.status IN (#STATUSES#)
       AND billable.value in ($BILLABLE, $UNBILLABLE)
-      AND ticket_change.time >= $STARTDATE
-      AND ticket_change.time < $ENDDATE
+      AND hours_ledger.time >= $STARTDATE
+      AND hours_ledger.time < $ENDDATE
   GROUP BY t.milestone, t.id, t.summary
 
   UNION
 
   SELECT 'background-color:#DFE;' as __style__, 0 as ticket,
-    sum( CASE WHEN newvalue = '' OR newvalue IS NULL THEN 0
-         ELSE CAST( newvalue AS DECIMAL(10,2) ) END) as newvalue, 'Total work done' as summary,
+    SUM(hours_ledger.hours) as newvalue, 'Total work done' as summary,
     NULL as time, t.milestone as milestone, 1 as _ord
-  FROM ticket_change
-  JOIN ticket t on t.id = ticket_change.ticket
+  FROM hours_ledger
+  JOIN ticket t on t.id = hours_ledger.ticket
   LEFT JOIN ticket_custom as billable on billable.ticket = t.id
     and billable.name = 'billable'
-  WHERE field = 'hours' and
-    t.status IN (#STATUSES#)
+  WHERE t.status IN (#STATUSES#)
       AND billable.value in ($BILLABLE, $UNBILLABLE)
-      AND ticket_change.time >= $STARTDATE
-      AND ticket_change.time < $ENDDATE
+      AND hours_ledger.time >= $STARTDATE
+      AND hours_ledger.time < $ENDDATE
   GROUP By t.milestone
 )  as tbl
 ORDER BY milestone,  _ord ASC, ticket, time
@@ -105,42 +97,38 @@ ORDER BY milestone,  _ord ASC, ticket, time
     {
     "uuid":"7bd4b0ce-da6d-4b11-8be3-07e65b540d99",
     "title":"Developer Work Summary",
-    "version":18,
+    "version":19,
     "sql":"""
 SELECT author as __group__,__style__, ticket, summary,
   newvalue as Work_added, time as datetime, _ord
 FROM(
   SELECT '' as __style__, author, t.id  as ticket,
     t.summary as summary,
-    CASE WHEN newvalue = '' OR newvalue IS NULL THEN 0
-         ELSE CAST( newvalue AS DECIMAL(10,2) ) END as newvalue,
-    ticket_change.time as time, 0 as _ord
-  FROM ticket_change
-  JOIN ticket t on t.id = ticket_change.ticket
+    hours_ledger.hours as newvalue,
+    hours_ledger.time as time, 0 as _ord
+  FROM hours_ledger
+  JOIN ticket t on t.id = hours_ledger.ticket
   LEFT JOIN ticket_custom as billable on billable.ticket = t.id
     and billable.name = 'billable'
-  WHERE field = 'hours' and
-    t.status IN (#STATUSES#)
+  WHERE t.status IN (#STATUSES#)
       AND billable.value in ($BILLABLE, $UNBILLABLE)
-      AND ticket_change.time >= $STARTDATE
-      AND ticket_change.time < $ENDDATE
+      AND hours_ledger.time >= $STARTDATE
+      AND hours_ledger.time < $ENDDATE
 
   UNION
 
   SELECT 'background-color:#DFE;' as __style__, author, 0 as ticket,
     Null as summary,
-    SUM( CASE WHEN newvalue = '' OR newvalue IS NULL THEN 0
-         ELSE CAST( newvalue AS DECIMAL(10,2) ) END) as newvalue,
+    SUM(hours_ledger.hours) as newvalue,
     NULL as time, 1 as _ord
-  FROM ticket_change
-  JOIN ticket t on t.id = ticket_change.ticket
+  FROM hours_ledger
+  JOIN ticket t on t.id = hours_ledger.ticket
   LEFT JOIN ticket_custom as billable on billable.ticket = t.id
     and billable.name = 'billable'
-  WHERE field = 'hours' and
-    t.status IN (#STATUSES#)
+  WHERE t.status IN (#STATUSES#)
       AND billable.value in ($BILLABLE, $UNBILLABLE)
-      AND ticket_change.time >= $STARTDATE
-      AND ticket_change.time < $ENDDATE
+      AND hours_ledger.time >= $STARTDATE
+      AND hours_ledger.time < $ENDDATE
   GROUP By author
 )  as tbl
 ORDER BY author,  _ord ASC, time
@@ -1,5 +1,7 @@
 from trac.ticket import ITicketChangeListener, Ticket, ITicketManipulator
+from trac.admin import IAdminCommandProvider
 from trac.core import *
+from trac.util.text import printout
 import datetime
 import dbhelper
 
@@ -52,13 +54,44 @@ def update_hours_to_floats(db, ticket_id):
                        "WHERE ticket=%s AND time=%s AND field='hours'",
                        (str(convertfloat(newvalue)), ticket_id, time))
 
+## The hours ledger holds one row per hours change with the hours as
+## numbers, so that totals and billing reports don't have to scan and
+## cast ticket_change
+hours_ledger_insert_sql = """
+   INSERT INTO hours_ledger (ticket, time, author, hours)
+   SELECT ticket, time, author,
+          CASE WHEN newvalue = '' OR newvalue IS NULL THEN 0
+               ELSE CAST( newvalue AS DECIMAL(10,2) ) END
+     FROM ticket_change
+    WHERE field='hours' """
+
+def update_hours_ledger( db, ticket_id):
+    """adds the hours changes of the ticket newer than its last ledger row"""
+    cursor = db.cursor()
+    cursor.execute(hours_ledger_insert_sql +
+                   """AND ticket=%s
+                      AND time > (SELECT COALESCE(MAX(time), -1)
+                                    FROM hours_ledger WHERE ticket=%s)""",
+                   (ticket_id, ticket_id))
+
+def rebuild_hours_ledger( db, ticket_id=None):
+    """refills the ledger of a ticket, or of all tickets, from ticket_change"""
+    cursor = db.cursor()
+    if ticket_id is None:
+        cursor.execute("DELETE FROM hours_ledger")
+        cursor.execute(hours_ledger_insert_sql)
+    else:
+        cursor.execute("DELETE FROM hours_ledger WHERE ticket=%s",
+                       (ticket_id,))
+        cursor.execute(hours_ledger_insert_sql + "AND ticket=%s",
+                       (ticket_id,))
+
 def update_totalhours_custom( db, ticket_id):
     cursor = db.cursor()
     sumSql = """
-       (SELECT SUM( CASE WHEN newvalue = '' OR newvalue IS NULL THEN 0
-                         ELSE CAST( newvalue AS DECIMAL(10,2) ) END ) as total 
-          FROM ticket_change
-         WHERE ticket=%s and field='hours')  """
+       (SELECT COALESCE(SUM(hours), 0) as total
+          FROM hours_ledger
+         WHERE ticket=%s)  """
     cursor.execute("UPDATE ticket_custom SET value="+sumSql+
                    "WHERE ticket=%s AND name='totalhours'",
                (ticket_id,ticket_id))
@@ -74,26 +107,22 @@ def update_totalhours_custom( db, ticket_id):
 def insert_totalhours_changes( db, ticket_id):
     sql = """
        INSERT INTO ticket_change (ticket, author, time, field, oldvalue, newvalue)
-       SELECT ticket, author, time, 'totalhours',  
-               (SELECT SUM( CASE WHEN newvalue = '' OR newvalue IS NULL THEN 0
-                           ELSE CAST( newvalue AS DECIMAL(10,2) ) END ) as total
-               FROM ticket_change as guts 
-               WHERE guts.ticket = ticket_change.ticket AND guts.field='hours'
-                 AND guts.time < ticket_change.time
-              ) as oldvalue, 
-              (SELECT SUM( CASE WHEN newvalue = '' OR newvalue IS NULL THEN 0
-                           ELSE CAST( newvalue AS DECIMAL(10,2) ) END ) as total
-               FROM ticket_change as guts 
-               WHERE guts.ticket = ticket_change.ticket AND guts.field='hours'
-                 AND guts.time <= ticket_change.time
+       SELECT ticket, author, time, 'totalhours',
+              (SELECT SUM(hours) FROM hours_ledger as guts
+               WHERE guts.ticket = hours_ledger.ticket
+                 AND guts.time < hours_ledger.time
+              ) as oldvalue,
+              (SELECT SUM(hours) FROM hours_ledger as guts
+               WHERE guts.ticket = hours_ledger.ticket
+                 AND guts.time <= hours_ledger.time
               ) as newvalue
-          FROM ticket_change
-         WHERE ticket=%s and field='hours'
+          FROM hours_ledger
+         WHERE ticket=%s
            AND NOT EXISTS( SELECT ticket
-                             FROM ticket_change as guts 
-                            WHERE guts.ticket=ticket_change.ticket
-                              AND guts.author=ticket_change.author
-                              AND guts.time=ticket_change.time
+                             FROM ticket_change as guts
+                            WHERE guts.ticket=hours_ledger.ticket
+                              AND guts.author=hours_ledger.author
+                              AND guts.time=hours_ledger.time
                               AND field='totalhours')
     """
     cursor = db.cursor()
@@ -105,11 +134,15 @@ class TimeTrackingTicketObserver(Component):
     def __init__(self):
         pass
 
-    def watch_hours(self, ticket):
+    def watch_hours(self, ticket, rebuild=False):
         ticket_id = ticket.id
         with self.env.db_transaction as db:
             update_hours_to_floats(db, ticket_id)
             save_custom_field_value( db, ticket_id, "hours", '0')
+            if rebuild:
+                rebuild_hours_ledger( db, ticket_id )
+            else:
+                update_hours_ledger( db, ticket_id )
             insert_totalhours_changes( db, ticket_id )
             update_totalhours_custom ( db, ticket_id )
 
@@ -129,11 +162,38 @@ class TimeTrackingTicketObserver(Component):
 
     def ticket_change_deleted(self, ticket, cdate, changes):
         """called when a ticket change is deleted"""
-        self.watch_hours(ticket)
+        self.watch_hours(ticket, rebuild=True)
 
     def ticket_deleted(self, ticket):
         """Called when a ticket is deleted."""
-        pass
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("DELETE FROM hours_ledger WHERE ticket=%s",
+                           (ticket.id,))
+
+
+class HoursLedgerAdmin(Component):
+    implements(IAdminCommandProvider)
+
+    def get_admin_commands(self):
+        yield ('hours_ledger rebuild', '',
+               'Refill the hours ledger from the ticket changes',
+               None, self._do_rebuild)
+
+    def _do_rebuild(self):
+        with self.env.db_transaction as db:
+            rebuild_hours_ledger(db)
+            cursor = db.cursor()
+            # tickets whose hours changes were all deleted still have a
+            # stale totalhours value but no ledger row
+            cursor.execute("""
+               SELECT ticket FROM hours_ledger
+                UNION
+               SELECT ticket FROM ticket_custom WHERE name='totalhours'""")
+            ticket_ids = [row[0] for row in cursor.fetchall()]
+            for ticket_id in ticket_ids:
+                update_totalhours_custom(db, ticket_id)
+        printout("Hours ledger rebuilt for %s tickets" % len(ticket_ids))
 
 
 class TimeTrackingTicketValidator(Component):
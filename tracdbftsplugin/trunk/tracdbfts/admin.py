@@ -6,23 +6,28 @@
 # This software is licensed as described in the file COPYING, which
 # you should have received as part of this distribution.
 
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from time import time
+import json
 import os
 import sys
 
-from trac.admin.api import IAdminCommandProvider
+from trac.admin.api import AdminCommandError, IAdminCommandProvider
 from trac.attachment import Attachment
 from trac.core import Component, TracError, implements
 from trac.resource import ResourceNotFound
 from trac.ticket.model import Milestone, Ticket
-from trac.util.datefmt import format_datetime, from_utimestamp
-from trac.util.text import console_print, exception_to_unicode, print_table
+from trac.util.datefmt import (format_datetime, from_utimestamp,
+                               to_utimestamp)
+from trac.util.text import (console_print, exception_to_unicode, print_table,
+                            printout)
 from trac.versioncontrol.api import (Changeset, NoSuchChangeset,
                                      RepositoryManager)
 from trac.versioncontrol.cache import CachedChangeset, CachedRepository
 from trac.wiki.model import WikiPage
 
-from tracdbfts.api import TracDbftsSystem
+from tracdbfts.api import TracDbftsSystem, _build_hash, _hash_from_db
 
 
 class TracDbftsCommandProvider(Component):
@@ -32,48 +37,195 @@ class TracDbftsCommandProvider(Component):
     # IAdminCommandProvider methods
 
     def get_admin_commands(self):
-        yield ('dbfts index', '[realms...]',
-               'Build fulltext index for resources',
+        yield ('dbfts index',
+               '[--jobs=N] [--batch=N] [--resume] [--force] [realms...]',
+               """Build fulltext index for resources
+
+               Documents whose indexed time is unchanged are skipped unless
+               --force is given. Contents are built in N worker threads
+               (--jobs, default 1) and written in transactions of N
+               documents (--batch, default 1000). The last resource
+               written is saved with each transaction, so that an
+               interrupted run can be continued after it with --resume.
+               """,
                None, self._do_index)
+        yield ('dbfts drain', '[limit]',
+               """Index resources in the queue
+
+               Resources are added to the queue when [dbfts] async_indexing
+               is enabled.
+               """,
+               None, self._do_drain)
         yield ('dbfts search', 'query',
                'Search resources using fulltext index',
                None, self._do_search)
 
     # Internal methods
 
-    def _do_index(self, *realms):
-        if not realms:
-            realms = ('wiki', 'ticket', 'milestone', 'changeset', 'attachment')
+    realms = ('wiki', 'ticket', 'milestone', 'changeset', 'attachment')
+
+    _checkpoint_key = 'dbfts_index_checkpoint'
+
+    def _do_index(self, *args):
+        jobs = 1
+        batch = 1000
+        resume = force = False
+        realms = []
+        for arg in args:
+            if arg.startswith('--jobs='):
+                jobs = self._parse_positive(arg)
+            elif arg.startswith('--batch='):
+                batch = self._parse_positive(arg)
+            elif arg == '--resume':
+                resume = True
+            elif arg == '--force':
+                force = True
+            elif arg in self.realms:
+                realms.append(arg)
+            else:
+                raise AdminCommandError('Invalid argument "%s"' % arg)
+        realms = tuple(realms or self.realms)
         out = sys.stderr
         isatty = hasattr(out, 'fileno') and os.isatty(out.fileno())
 
-        def print_stat(n, realm, newline=True):
+        def print_stat(n, updated, realm, newline=True):
             if isatty:
-                msg = 'Indexed %d objects from %s%s' % \
-                      (n, realm, '' if newline else '\r')
+                msg = 'Indexed %d objects (%d updated) from %s%s' % \
+                      (n, updated, realm, '' if newline else '\r')
                 console_print(out, msg, newline=newline)
 
+        checkpoint = self._get_checkpoint() if resume else None
+        if checkpoint and checkpoint[0] in realms:
+            realms = realms[realms.index(checkpoint[0]):]
+        else:
+            checkpoint = None
+        pool = ThreadPool(jobs) if jobs > 1 else None
+        try:
+            for realm in realms:
+                after = checkpoint[1] if checkpoint else None
+                checkpoint = None
+                self._index_realm(realm, after, force, batch, pool,
+                                  print_stat)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        self._set_checkpoint(None)
+
+    def _index_realm(self, realm, after, force, batch, pool, print_stat):
         mod = TracDbftsSystem(self.env)
-        specs = {
-            'wiki': (self._iter_wikis, mod.wiki_page_added),
-            'ticket': (self._iter_tickets, mod.ticket_created),
-            'milestone': (self._iter_milestones, mod.milestone_created),
-            'changeset': (self._iter_changesets, mod.changeset_added),
-            'attachment': (self._iter_attachments, mod.attachment_added),
+        iterators = {
+            'wiki': self._iter_wikis,
+            'ticket': self._iter_tickets,
+            'milestone': self._iter_milestones,
+            'changeset': self._iter_changesets,
+            'attachment': self._iter_attachments,
         }
+        iter_ = iterators[realm]
+        build_key, build_content, timed = mod._record_builders()[realm]
+        map_ = pool.map if pool else map
+        with self.env.db_query as db:
+            existing = dict((_hash_from_db(hash_), time)
+                            for hash_, time in db("SELECT hash, time "
+                                                  "FROM dbfts WHERE realm=%s",
+                                                  (realm,)))
+        seen = set()
+        pending = []
+        n = updated = 0
+        last = None
+
+        def flush(last):
+            contents = list(map_(build_content,
+                                 [item for key, item in pending]))
+            records = [mod._record_values(key[0], content, *key[1:])
+                       for (key, item), content in zip(pending, contents)]
+            replaced = [(r[0],) for r in records if r[0] in existing]
+            with self.env.db_transaction as db:
+                if replaced:
+                    db.executemany("DELETE FROM dbfts WHERE hash=%s",
+                                   replaced)
+                mod._insert_records(db, records)
+                self._set_checkpoint((realm, last))
+            del pending[:]
+            return len(records)
+
+        print_stat(n, updated, realm, newline=False)
+        for n, (last, hash_, item) in enumerate(iter_(after), 1):
+            if item is None:
+                # indexed before the checkpoint
+                seen.add(hash_)
+                continue
+            key = build_key(item)
+            seen.add(key[0])
+            if not force and timed and key[0] in existing:
+                time = key[1]
+                if isinstance(time, datetime):
+                    time = to_utimestamp(time)
+                if existing[key[0]] == time:
+                    continue
+            pending.append((key, item))
+            if len(pending) >= batch:
+                updated += flush(last)
+                print_stat(n, updated, realm, newline=False)
+        if pending:
+            updated += flush(last)
+        stale = [(hash_,) for hash_ in existing if hash_ not in seen]
         with self.env.db_transaction as db:
-            db("DELETE FROM dbfts WHERE realm IN ({0})"
-               .format(','.join(['%s'] * len(realms))), realms)
-            for realm in realms:
-                iter_, add = specs[realm]
-                n = 0
-                print_stat(n, realm, newline=False)
-                for n, item in enumerate(iter_(), 1):
-                    if not isinstance(item, tuple):
-                        item = [item]
-                    add(*item)
-                    print_stat(n, realm, newline=False)
-                print_stat(n, realm)
+            if stale:
+                db.executemany("DELETE FROM dbfts WHERE hash=%s", stale)
+            self._set_checkpoint((realm, last))
+        print_stat(n, updated, realm)
+
+    def _parse_positive(self, arg):
+        try:
+            value = int(arg.split('=', 1)[1])
+        except ValueError:
+            value = 0
+        if value < 1:
+            raise AdminCommandError('Invalid argument "%s"' % arg)
+        return value
+
+    def _get_checkpoint(self):
+        """Return the realm and the key of the last resource written,
+        which is `None` if no resource of the realm was written."""
+        for value, in self.env.db_query("""\
+                SELECT value FROM system WHERE name=%s
+                """, (self._checkpoint_key,)):
+            try:
+                realm, key = json.loads(value)
+            except ValueError:
+                return None
+            return realm, tuple(key) if key is not None else None
+
+    def _set_checkpoint(self, checkpoint):
+        with self.env.db_transaction as db:
+            db("DELETE FROM system WHERE name=%s", (self._checkpoint_key,))
+            if checkpoint:
+                db("INSERT INTO system (name,value) VALUES (%s,%s)",
+                   (self._checkpoint_key, json.dumps(checkpoint)))
+
+    def _after_cond(self, columns, after):
+        """Return an SQL expression which is true for the rows whose
+        `columns` sort after the `after` values, and its arguments.
+
+        The expression is selected by the iterators below, which yield
+        `(key, hash, None)` for the resources up to `after`, so that the
+        comparison uses the collation of the database."""
+        if after is None:
+            return '1=1', []
+        cond = '%s>%%s' % columns[-1]
+        args = [after[-1]]
+        for column, value in zip(columns[-2::-1], after[-2::-1]):
+            cond = '%s>%%s OR %s=%%s AND (%s)' % (column, column, cond)
+            args = [value, value] + args
+        return cond, args
+
+    def _do_drain(self, limit=None):
+        if limit is not None:
+            limit = self._parse_positive('limit=' + limit)
+        mod = TracDbftsSystem(self.env)
+        n = mod.process_queue(limit)
+        printout('%d queued resources processed' % n)
 
     def _do_search(self, query):
         mod = TracDbftsSystem(self.env)
@@ -92,65 +244,99 @@ class TracDbftsCommandProvider(Component):
                 results.append(result)
         elapse = time() - elapse
         print_table(results, header)
-        print('%d matches (%0.2f seconds)' % (n, elapse))
+        printout('%d matches (%0.2f seconds)' % (n, elapse))
 
-    def _iter_wikis(self):
+    def _iter_wikis(self, after=None):
+        cond, args = self._after_cond(('name',), after)
         with self.env.db_query as db:
             cursor = db.cursor()
-            cursor.execute("SELECT DISTINCT name FROM wiki")
-            for row in cursor:
+            cursor.execute("SELECT DISTINCT name, %s FROM wiki "
+                           "ORDER BY name" % cond, args)
+            for name, resume in cursor:
+                key = (name,)
+                if not resume:
+                    yield key, _build_hash('wiki', name), None
+                    continue
                 try:
-                    page = WikiPage(self.env, row[0])
+                    page = WikiPage(self.env, name)
                 except ResourceNotFound:
                     continue
                 if page.exists:
-                    yield page
+                    yield key, None, page
 
-    def _iter_tickets(self):
+    def _iter_tickets(self, after=None):
+        cond, args = self._after_cond(('id',), after)
         with self.env.db_query as db:
             cursor = db.cursor()
-            cursor.execute("SELECT id FROM ticket")
-            for row in cursor:
+            cursor.execute("SELECT id, %s FROM ticket ORDER BY id" % cond,
+                           args)
+            for id_, resume in cursor:
+                key = (id_,)
+                if not resume:
+                    yield key, _build_hash('ticket', id_), None
+                    continue
                 try:
-                    ticket = Ticket(self.env, row[0])
+                    ticket = Ticket(self.env, id_)
                 except ResourceNotFound:
                     continue
-                yield ticket
+                yield key, None, ticket
 
-    def _iter_milestones(self):
+    def _iter_milestones(self, after=None):
+        cond, args = self._after_cond(('name',), after)
         with self.env.db_query as db:
             cursor = db.cursor()
-            cursor.execute("SELECT name FROM milestone")
-            for row in cursor:
+            cursor.execute("SELECT name, %s FROM milestone ORDER BY name"
+                           % cond, args)
+            for name, resume in cursor:
+                key = (name,)
+                if not resume:
+                    yield key, _build_hash('milestone', name), None
+                    continue
                 try:
-                    milestone = Milestone(self.env, row[0])
+                    milestone = Milestone(self.env, name)
                 except ResourceNotFound:
                     continue
-                yield milestone
+                yield key, None, milestone
 
-    def _iter_changesets(self):
+    def _iter_changesets(self, after=None):
         manager = RepositoryManager(self.env)
-        for repos in manager.get_real_repositories():
-            iter_csets = self._iter_cached_csets \
-                         if isinstance(repos, CachedRepository) else \
-                         self._iter_normal_csets
-            for cset in iter_csets(repos):
-                yield repos, cset
-
-    def _iter_cached_csets(self, repos):
+        for repos in sorted(manager.get_real_repositories(),
+                            key=lambda repos: repos.reponame):
+            if not isinstance(repos, CachedRepository):
+                # Without a cache the history has no key order to resume
+                # from, the repository is indexed again
+                for cset in self._iter_normal_csets(repos):
+                    yield (repos.reponame, cset.rev), None, (repos, cset)
+                continue
+            if after is None or repos.reponame > after[0]:
+                cond, args = '1=1', []
+            elif repos.reponame == after[0]:
+                cond, args = self._after_cond(('rev',), after[1:])
+            else:
+                cond, args = '1=0', []
+            for item in self._iter_cached_csets(repos, cond, args):
+                yield item
+
+    def _iter_cached_csets(self, repos, cond, args):
         with self.env.db_query as db:
             cursor = db.cursor()
             cursor.execute("""\
-                SELECT rev, time, author, message FROM revision
-                WHERE repos=%s
-                """, (repos.id,))
-            for rev, date, author, message in cursor:
+                SELECT rev, time, author, message, %s FROM revision
+                WHERE repos=%%s ORDER BY rev
+                """ % cond, args + [repos.id])
+            for rev, date, author, message, resume in cursor:
+                key = (repos.reponame, rev)
+                if not resume:
+                    yield key, _build_hash('changeset', rev, 'repository',
+                                           repos.reponame), None
+                    continue
                 try:
                     repos.normalize_rev(rev)
                 except NoSuchChangeset:
                     continue
-                yield PseudoChangeset(repos, rev, message, author,
-                                      from_utimestamp(date))
+                cset = PseudoChangeset(repos, rev, message, author,
+                                       from_utimestamp(date))
+                yield key, None, (repos, cset)
 
     def _iter_normal_csets(self, repos):
         try:
@@ -172,18 +358,24 @@ class TracDbftsCommandProvider(Component):
             else:
                 yield cset
 
-    def _iter_attachments(self):
+    def _iter_attachments(self, after=None):
+        cond, args = self._after_cond(('type', 'id', 'filename'), after)
         query = "SELECT type, id, filename, description, size, time, author"
         if self.env.database_version < 42:
             query += ", ipnr"
-        query += " FROM attachment ORDER BY type, id"
+        query += ", %s FROM attachment ORDER BY type, id, filename" % cond
         with self.env.db_query as db:
             cursor = db.cursor()
-            cursor.execute(query)
+            cursor.execute(query, args)
             for row in cursor:
+                key = tuple(row[:3])
+                if not row[-1]:
+                    yield key, _build_hash('attachment', row[2], row[0],
+                                           row[1]), None
+                    continue
                 attachment = Attachment(self.env, row[0], row[1])
-                attachment._from_database(*row[2:])
-                yield attachment
+                attachment._from_database(*row[2:-1])
+                yield key, None, attachment
 
 
 class PseudoChangeset(CachedChangeset):
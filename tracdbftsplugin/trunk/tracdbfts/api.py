@@ -7,22 +7,29 @@
 # you should have received as part of this distribution.
 
 from datetime import datetime
+from time import sleep
 import base64
 import collections
 import hashlib
 import re
+import threading
 import unicodedata
 import sys
 
-from trac.attachment import IAttachmentChangeListener
+from trac.attachment import Attachment, IAttachmentChangeListener
+from trac.config import BoolOption, FloatOption
 from trac.core import Component, TracError, implements
 from trac.db.api import DatabaseManager
+from trac.db.schema import Column, Table
 from trac.env import IEnvironmentSetupParticipant
+from trac.resource import ResourceNotFound
 from trac.ticket.api import IMilestoneChangeListener, ITicketChangeListener
+from trac.ticket.model import Milestone, Ticket
 from trac.util import lazy
-from trac.util.datefmt import to_utimestamp
-from trac.util.text import to_unicode
-from trac.versioncontrol.api import IRepositoryChangeListener
+from trac.util.datefmt import datetime_now, to_utimestamp, utc
+from trac.util.text import exception_to_unicode, to_unicode
+from trac.versioncontrol.api import (IRepositoryChangeListener,
+                                     NoSuchChangeset, RepositoryManager)
 from trac.versioncontrol.cache import CachedRepository
 from trac.wiki.api import IWikiChangeListener
 from trac.wiki.model import WikiPage
@@ -40,12 +47,44 @@ else:
 __all__ = ('SearchQuery', 'SearchResult', 'TracDbftsSystem')
 
 
+_queue_schema = Table('dbfts_queue', key='hash')[
+    Column('hash'),
+    Column('time', type='int64'),
+    Column('realm'),
+    Column('id'),
+    Column('parent_realm'),
+    Column('parent_id'),
+]
+
+
 class TracDbftsSystem(Component):
 
     implements(IEnvironmentSetupParticipant, IAttachmentChangeListener,
                IWikiChangeListener, ITicketChangeListener,
                IMilestoneChangeListener, IRepositoryChangeListener)
 
+    async_indexing = BoolOption('dbfts', 'async_indexing', 'disabled',
+        """Add changed resources to a queue instead of indexing them while
+        saving. Repeated changes of a resource are indexed once. The queue
+        is processed by `queue_worker` or `trac-admin $ENV dbfts drain`.
+        """)
+
+    queue_worker = BoolOption('dbfts', 'queue_worker', 'enabled',
+        """Process the queue in a background thread of the process which
+        added to the queue. Disable it to process the queue only using
+        `trac-admin $ENV dbfts drain`, e.g. from cron.
+        """)
+
+    queue_worker_delay = FloatOption('dbfts', 'queue_worker_delay', 2.0,
+        """Seconds to wait before the background thread processes the
+        queue.
+        """)
+
+    def __init__(self):
+        self._worker = None
+        self._worker_wanted = False
+        self._worker_lock = threading.Lock()
+
     # Public methods
 
     realms = ('wiki', 'ticket', 'milestone', 'changeset')
@@ -63,23 +102,101 @@ class TracDbftsSystem(Component):
                             'instance')
         return self._interface.search(query, realms or self.realms)
 
+    def process_queue(self, limit=None, batch=100):
+        """Index the resources in the queue and return the number of
+        processed entries.
+
+        Entries are claimed by deleting them before indexing, so that
+        concurrent workers never index the same entry. An entry which
+        fails to be indexed is put back in the queue, and is skipped
+        until the next call."""
+        n = 0
+        failed = set()
+        builders = self._record_builders()
+        while limit is None or n < limit:
+            size = batch if limit is None else min(batch, limit - n)
+            rows = self.env.db_query("""\
+                SELECT hash, time, realm, id, parent_realm, parent_id
+                FROM dbfts_queue ORDER BY time LIMIT %s""",
+                (size + len(failed),))
+            rows = [row for row in rows if row[0] not in failed][:size]
+            if not rows:
+                break
+            claimed = []
+            with self.env.db_transaction as db:
+                cursor = db.cursor()
+                for row in rows:
+                    cursor.execute("DELETE FROM dbfts_queue "
+                                   "WHERE hash=%s AND time=%s", row[:2])
+                    if cursor.rowcount == 1:
+                        claimed.append(row)
+            hashes = []
+            records = []
+            retries = []
+            for row in claimed:
+                key, time, realm, id_, parent_realm, parent_id = row
+                try:
+                    item = self._load_queued(realm, id_, parent_realm,
+                                             parent_id)
+                    if item is not None:
+                        build_key, build_content = builders[realm][:2]
+                        record_key = build_key(item)
+                        records.append(self._record_values(
+                            record_key[0], build_content(item),
+                            *record_key[1:]))
+                except Exception as e:
+                    self.log.warning('Exception caught while indexing %s '
+                                     '%s: %s', realm, id_,
+                                     exception_to_unicode(e, traceback=True))
+                    retries.append(row)
+                    failed.add(key)
+                else:
+                    hashes.append((key.encode('ascii'),))
+            with self.env.db_transaction as db:
+                if hashes:
+                    db.executemany("DELETE FROM dbfts WHERE hash=%s", hashes)
+                self._insert_records(db, records)
+                for row in retries:
+                    # unless the resource has been queued again meanwhile
+                    if not db("SELECT 1 FROM dbfts_queue WHERE hash=%s",
+                              (row[0],)):
+                        db("""\
+                            INSERT INTO dbfts_queue (hash,time,realm,id,
+                                                     parent_realm,parent_id)
+                            VALUES (%s,%s,%s,%s,%s,%s)""", row)
+            n += len(claimed)
+        return n
+
     # IEnvironmentSetupParticipant methods
 
     def environment_created(self):
         self._interface.create_schema()
+        DatabaseManager(self.env).create_tables([_queue_schema])
 
     def environment_needs_upgrade(self, db=None):
         with self.env.db_query as db:
-            if 'dbfts' not in db.get_table_names():
-                return True
+            tables = db.get_table_names()
+        if 'dbfts' not in tables or 'dbfts_queue' not in tables:
+            return True
+        return self._interface.schema_needs_upgrade()
 
     def upgrade_environment(self, db=None):
-        self._interface.create_schema()
+        with self.env.db_query as db:
+            tables = db.get_table_names()
+        if 'dbfts' not in tables:
+            self._interface.create_schema()
+        elif self._interface.schema_needs_upgrade():
+            self._interface.upgrade_schema()
+        if 'dbfts_queue' not in tables:
+            DatabaseManager(self.env).create_tables([_queue_schema])
 
     # IAttachmentChangeListener methods
 
     def attachment_added(self, attachment):
         hash_ = self._build_attachment_hash(attachment)
+        if self._enqueue(hash_, 'attachment', attachment.filename,
+                         attachment.parent_realm, attachment.parent_id):
+            return
         content = self._build_attachment_content(attachment)
         self._insert_record(hash_, content, attachment.date, 'attachment',
                             attachment.filename, attachment.parent_realm,
@@ -101,6 +218,8 @@ class TracDbftsSystem(Component):
 
     def wiki_page_added(self, page):
         hash_ = self._build_wiki_hash(page)
+        if self._enqueue(hash_, page.realm, page.name):
+            return
         content = self._build_wiki_content(page)
         self._insert_record(hash_, content, page.time, page.realm, page.name)
 
@@ -120,8 +239,7 @@ class TracDbftsSystem(Component):
             old_page = WikiPage(self.env, old_name)
             old_key = _build_hash(page.realm, old_name)
             if old_page.exists:
-                content = self._build_wiki_content(old_page)
-                self._update_record(old_key, content, old_page.time)
+                self._wiki_changed(old_page)
             else:
                 self._delete_record(old_key)
             self.wiki_page_added(page)
@@ -130,6 +248,8 @@ class TracDbftsSystem(Component):
 
     def ticket_created(self, ticket):
         hash_ = self._build_ticket_hash(ticket)
+        if self._enqueue(hash_, 'ticket', ticket.id):
+            return
         content = self._build_ticket_content(ticket)
         self._insert_record(hash_, content, ticket['time'], 'ticket',
                             ticket.id)
@@ -152,6 +272,8 @@ class TracDbftsSystem(Component):
 
     def milestone_created(self, milestone):
         hash_ = self._build_milestone_hash(milestone)
+        if self._enqueue(hash_, 'milestone', milestone.name):
+            return
         content = self._build_milestone_content(milestone)
         self._insert_record(hash_, content,
                             milestone.completed or milestone.due,
@@ -159,6 +281,8 @@ class TracDbftsSystem(Component):
 
     def milestone_changed(self, milestone, old_values):
         hash_ = self._build_milestone_hash(milestone)
+        if self._enqueue(hash_, 'milestone', milestone.name):
+            return
         content = self._build_milestone_content(milestone)
         self._update_record(hash_, content,
                             milestone.completed or milestone.due)
@@ -172,12 +296,18 @@ class TracDbftsSystem(Component):
     def changeset_added(self, repos, changeset):
         rev = _db_rev(changeset)
         hash_ = self._build_changeset_hash(repos, changeset)
+        if self._enqueue(hash_, 'changeset', rev, 'repository',
+                         repos.reponame):
+            return
         content = self._build_changeset_content(changeset)
         self._insert_record(hash_, content, changeset.date, 'changeset', rev,
                             'repository', repos.reponame)
 
     def changeset_modified(self, repos, changeset, old_changeset):
         hash_ = self._build_changeset_hash(repos, changeset)
+        if self._enqueue(hash_, 'changeset', _db_rev(changeset),
+                         'repository', repos.reponame):
+            return
         content = self._build_changeset_content(changeset)
         self._update_record(hash_, content, changeset.date)
 
@@ -201,20 +331,31 @@ class TracDbftsSystem(Component):
             raise ValueError('%r is not supported' % type_)
         return ctor(self.env)
 
+    _insert_stmt = """\
+        INSERT INTO dbfts (hash,time,realm,id,parent_realm,parent_id,content)
+                    VALUES (%s,%s,%s,%s,%s,%s,%s)"""
+
     def _insert_record(self, hash_, content, time, realm, id_,
                        parent_realm=None, parent_id=None):
-        stmt = """\
-            INSERT INTO dbfts (hash,time,realm,id,parent_realm,parent_id,
-                               content)
-                        VALUES (%s,%s,%s,%s,%s,%s,%s)"""
+        self.env.db_transaction(self._insert_stmt,
+                                self._record_values(hash_, content, time,
+                                                    realm, id_, parent_realm,
+                                                    parent_id))
+
+    def _insert_records(self, db, records):
+        """Insert the records which are tuples of `_record_values`."""
+        cursor = db.cursor()
+        cursor.executemany(self._insert_stmt, records)
+
+    def _record_values(self, hash_, content, time, realm, id_,
+                       parent_realm=None, parent_id=None):
         if time is not None and isinstance(time, datetime):
             time = to_utimestamp(time)
         if id_ is not None and isinstance(id_, basestring):
             id_ = to_unicode(id_)
         if parent_id is not None and isinstance(parent_id, basestring):
             parent_id = to_unicode(parent_id)
-        self.env.db_transaction(stmt, (hash_, time, realm, id_, parent_realm,
-                                       parent_id, content))
+        return (hash_, time, realm, id_, parent_realm, parent_id, content)
 
     def _update_record(self, hash_, content, time):
         if time is not None and isinstance(time, datetime):
@@ -225,13 +366,122 @@ class TracDbftsSystem(Component):
     def _delete_record(self, hash_):
         self.env.db_transaction("DELETE FROM dbfts WHERE hash=%s", (hash_,))
 
+    def _enqueue(self, hash_, realm, id_, parent_realm=None,
+                 parent_id=None):
+        """Add the resource to the queue if `async_indexing` is enabled.
+        Return `False` if the resource should be indexed immediately."""
+        if not self.async_indexing:
+            return False
+        key = hash_.decode('ascii')
+        with self.env.db_transaction as db:
+            db("DELETE FROM dbfts_queue WHERE hash=%s", (key,))
+            db("""\
+                INSERT INTO dbfts_queue (hash,time,realm,id,parent_realm,
+                                         parent_id)
+                VALUES (%s,%s,%s,%s,%s,%s)""",
+               (key, to_utimestamp(datetime_now(utc)), realm,
+                unicode(id_), parent_realm, parent_id))
+        if self.queue_worker:
+            self._notify_worker()
+        return True
+
+    def _notify_worker(self):
+        with self._worker_lock:
+            self._worker_wanted = True
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run_worker,
+                                                name='dbfts-queue-worker')
+                self._worker.daemon = True
+                self._worker.start()
+
+    def _run_worker(self):
+        # The entries may be added in uncommitted transactions, so that
+        # the worker exits after a pass without entries and notifications.
+        while True:
+            sleep(self.queue_worker_delay)
+            with self._worker_lock:
+                wanted = self._worker_wanted
+                self._worker_wanted = False
+            try:
+                n = self.process_queue()
+            except Exception as e:
+                self.log.warning('Exception caught while processing the '
+                                 'queue: %s',
+                                 exception_to_unicode(e, traceback=True))
+                n = 0
+            if n or wanted:
+                continue
+            with self._worker_lock:
+                if not self._worker_wanted:
+                    self._worker = None
+                    return
+
+    def _load_queued(self, realm, id_, parent_realm, parent_id):
+        """Return the resource object for the queue entry, or `None` if
+        the resource no longer exists."""
+        try:
+            if realm == 'wiki':
+                page = WikiPage(self.env, id_)
+                return page if page.exists else None
+            if realm == 'ticket':
+                return Ticket(self.env, int(id_))
+            if realm == 'milestone':
+                return Milestone(self.env, id_)
+            if realm == 'attachment':
+                return Attachment(self.env, parent_realm, parent_id, id_)
+            if realm == 'changeset':
+                repos = RepositoryManager(self.env).get_repository(parent_id)
+                if repos is None:
+                    return None
+                rev = repos.rev_db(id_) \
+                      if isinstance(repos, CachedRepository) else id_
+                return repos, repos.get_changeset(rev)
+        except (ResourceNotFound, NoSuchChangeset):
+            return None
+        raise ValueError('Unrecognized realm %r' % realm)
+
+    def _record_builders(self):
+        """Return key builder, content builder and whether the time can
+        be used to detect modifications, for each realm. A key is a tuple
+        of hash, time, realm, id, parent realm and parent id."""
+        return {
+            'wiki': (lambda page: (self._build_wiki_hash(page), page.time,
+                                   page.realm, page.name),
+                     self._build_wiki_content, True),
+            'ticket': (lambda ticket: (self._build_ticket_hash(ticket),
+                                       ticket['changetime'], 'ticket',
+                                       ticket.id),
+                       self._build_ticket_content, True),
+            'milestone': (lambda milestone: (
+                              self._build_milestone_hash(milestone),
+                              milestone.completed or milestone.due,
+                              'milestone', milestone.name),
+                          self._build_milestone_content, False),
+            'changeset': (lambda item: (self._build_changeset_hash(*item),
+                                        item[1].date, 'changeset',
+                                        _db_rev(item[1]), 'repository',
+                                        item[0].reponame),
+                          lambda item: self._build_changeset_content(item[1]),
+                          True),
+            'attachment': (lambda attachment: (
+                               self._build_attachment_hash(attachment),
+                               attachment.date, 'attachment',
+                               attachment.filename, attachment.parent_realm,
+                               attachment.parent_id),
+                           self._build_attachment_content, True),
+        }
+
     def _wiki_changed(self, page):
         hash_ = self._build_wiki_hash(page)
+        if self._enqueue(hash_, page.realm, page.name):
+            return
         content = self._build_wiki_content(page)
         self._update_record(hash_, content, page.time)
 
     def _ticket_changed(self, ticket):
         hash_ = self._build_ticket_hash(ticket)
+        if self._enqueue(hash_, 'ticket', ticket.id):
+            return
         content = self._build_ticket_content(ticket)
         self._update_record(hash_, content, ticket['changetime'])
 
@@ -306,9 +556,9 @@ class SearchQuery(object):
         self.terms = terms
 
     _parse_re = re.compile(r"""
-        (?: \S+
-          | "[^"]*(?:"|\Z)
-          | '[^']*(?:'|\Z)
+        (?: -?"[^"]*(?:"|\Z)
+          | -?'[^']*(?:'|\Z)
+          | \S+
         )
     """, re.UNICODE | re.VERBOSE)
 
@@ -336,7 +586,7 @@ class SearchQuery(object):
                     negative = False
                 if token.startswith('"'):
                     token = token.strip('"')
-                elif token.endswith("'"):
+                elif token.startswith("'"):
                     token = token.strip("'")
                 if token:
                     return TOKEN_NOT(token) if negative else token
@@ -379,6 +629,12 @@ class DbftsInterface(object):
     def create_schema(self):
         raise NotImplementedError
 
+    def schema_needs_upgrade(self):
+        return False
+
+    def upgrade_schema(self):
+        pass
+
     def search(self, query, realms):
         raise NotImplementedError
 
@@ -448,6 +704,12 @@ class MySQLDbftsInterface(DbftsInterface):
 
 class PostgreSQLDbftsInterface(DbftsInterface):
 
+    # Words which the "simple" text search configuration keeps as a single
+    # lexeme. Other terms, e.g. CJK text without word boundaries or terms
+    # containing punctuation, are matched using LIKE and pg_bigm index.
+    _tsword_re = re.compile(u'(?:(?![\u2e80-\uffff])[^\\W_])+\\Z',
+                            re.UNICODE)
+
     def create_schema(self):
         with self.env.db_transaction as db:
             cursor = db.cursor()
@@ -460,25 +722,45 @@ class PostgreSQLDbftsInterface(DbftsInterface):
                     parent_realm    TEXT,
                     parent_id       TEXT,
                     content         TEXT,
+                    tsv             TSVECTOR,
                     PRIMARY KEY (hash))
                 """)
             cursor.execute("""\
                 CREATE INDEX key_dbfts_content ON dbfts
                     USING gin (content public.gin_bigm_ops)
                 """)
+            self._create_tsvector(cursor)
+
+    def schema_needs_upgrade(self):
+        with self.env.db_query as db:
+            return 'tsv' not in db.get_column_names('dbfts')
+
+    def upgrade_schema(self):
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("ALTER TABLE dbfts ADD COLUMN tsv TSVECTOR")
+            self._create_tsvector(cursor)
+            cursor.execute("UPDATE dbfts SET "
+                           "tsv=to_tsvector('pg_catalog.simple', content)")
 
     def search(self, query, realms):
         with self.env.db_query as db:
             condition, args = self._build_query(query, db.like_escape)
+            rank = self._build_rank_query(query)
+            if rank:
+                score = "ts_rank(tsv, to_tsquery('pg_catalog.simple', %s))"
+                args.insert(0, rank)
+            else:
+                score = 'NULL'
             args.extend(realms)
             args.extend(realms)
             cursor = db.cursor()
             cursor.execute("""\
-                SELECT time, realm, id, parent_realm, parent_id, NULL AS score
+                SELECT time, realm, id, parent_realm, parent_id, {0} AS score
                 FROM dbfts
-                WHERE {0} AND (realm IN ({1}) OR parent_realm IN ({1}))
-                ORDER BY time DESC
-                """.format(condition, ','.join(['%s'] * len(realms))),
+                WHERE {1} AND (realm IN ({2}) OR parent_realm IN ({2}))
+                ORDER BY score DESC, time DESC
+                """.format(score, condition, ','.join(['%s'] * len(realms))),
                 args)
             for row in cursor:
                 yield SearchResult(*row)
@@ -486,24 +768,70 @@ class PostgreSQLDbftsInterface(DbftsInterface):
     def normalize(self, value):
         return unicodedata.normalize('NFKC', value).lower()
 
+    def _create_tsvector(self, cursor):
+        cursor.execute("""\
+            CREATE INDEX key_dbfts_tsv ON dbfts USING gin (tsv)
+            """)
+        cursor.execute("""\
+            CREATE TRIGGER dbfts_tsv BEFORE INSERT OR UPDATE ON dbfts
+            FOR EACH ROW EXECUTE PROCEDURE
+            tsvector_update_trigger(tsv, 'pg_catalog.simple', content)
+            """)
+
+    def _to_tsquery(self, item):
+        """Return a tsquery expression for the term, or `None` if the term
+        cannot be matched with the text search index. The last word is
+        prefix matched and the words of a phrase must be adjacent."""
+        words = self.normalize(item).split()
+        if not words or not all(self._tsword_re.match(w) for w in words):
+            return None
+        return ' <-> '.join(words) + ':*'
+
     def _build_query(self, query, like_escape):
         exprs = []
         args = []
+
+        def like(item, negative=False):
+            args.append('%' + like_escape(self.normalize(item)) + '%')
+            return "content %sLIKE %%s ESCAPE '/'" % \
+                   ('NOT ' if negative else '')
+
+        def match(tsquery, negative=False):
+            args.append(tsquery)
+            return "%stsv @@ to_tsquery('pg_catalog.simple', %%s)" % \
+                   ('NOT ' if negative else '')
+
         for item in query.items:
             if isinstance(item, TOKEN_OR):
-                exprs.append("(%s)" % ' OR '.join(["content LIKE %s ESCAPE "
-                                                   "'/'"] * len(item)))
-                args.extend(self.normalize(v) for v in item)
+                tsqueries = [self._to_tsquery(v) for v in item]
+                if all(tsqueries):
+                    exprs.append(match(' | '.join('(%s)' % q
+                                                  for q in tsqueries)))
+                else:
+                    exprs.append('(%s)' % ' OR '.join(
+                        match(q) if q else like(v)
+                        for v, q in zip(item, tsqueries)))
             else:
-                if isinstance(item, TOKEN_NOT):
-                    exprs.append("content NOT LIKE %s ESCAPE '/'")
+                negative = isinstance(item, TOKEN_NOT)
+                tsquery = self._to_tsquery(item)
+                if tsquery:
+                    exprs.append(match(tsquery, negative))
                 else:
-                    exprs.append("content LIKE %s ESCAPE '/'")
-                args.append(self.normalize(item))
+                    exprs.append(like(item, negative))
 
-        args = ['%' + like_escape(arg) + '%' for arg in args]
         return ' AND '.join(exprs), args
 
+    def _build_rank_query(self, query):
+        tsqueries = []
+        for item in query.items:
+            if isinstance(item, TOKEN_NOT):
+                continue
+            for v in item if isinstance(item, TOKEN_OR) else [item]:
+                tsquery = self._to_tsquery(v)
+                if tsquery:
+                    tsqueries.append('(%s)' % tsquery)
+        return ' | '.join(tsqueries)
+
 
 class SQLiteDbftsInterface(DbftsInterface):
 
@@ -530,29 +858,48 @@ class SQLiteDbftsInterface(DbftsInterface):
                     parent_id       TEXT,
                     content         TEXT)
                 """)
-            cursor.execute("DROP TRIGGER IF EXISTS dbfts_insert")
-            cursor.execute("DROP TRIGGER IF EXISTS dbfts_insert")
-            cursor.execute("DROP TRIGGER IF EXISTS dbfts_delete")
-            cursor.execute("""\
-                CREATE TRIGGER dbfts_insert AFTER INSERT ON dbfts BEGIN
-                    INSERT INTO dbfts_idx (rowid, content)
-                                VALUES (new.pkey, new.content);
-                END
-                """)
-            cursor.execute("""\
-                CREATE TRIGGER dbfts_delete AFTER DELETE ON dbfts BEGIN
-                    INSERT INTO dbfts_idx(dbfts_idx, rowid)
-                                VALUES ('delete', old.pkey);
-                END
-                """)
-            cursor.execute("""\
-                CREATE TRIGGER dbfts_update AFTER UPDATE ON dbfts BEGIN
-                    INSERT INTO dbfts_idx(dbfts_idx, rowid)
-                                VALUES ('delete', old.pkey);
-                    INSERT INTO dbfts_idx (rowid, content)
-                                VALUES (new.pkey, new.content);
-                END
-                """)
+            self._create_triggers(cursor)
+
+    def schema_needs_upgrade(self):
+        with self.env.db_query as db:
+            for sql, in db("SELECT sql FROM sqlite_master "
+                           "WHERE type='trigger' AND name='dbfts_delete'"):
+                return 'old.content' not in sql
+        return True
+
+    def upgrade_schema(self):
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            self._create_triggers(cursor)
+            cursor.execute("INSERT INTO dbfts_idx(dbfts_idx) "
+                           "VALUES ('rebuild')")
+
+    def _create_triggers(self, cursor):
+        # The old content must be given to the 'delete' command of the
+        # external content table, otherwise the index is corrupted.
+        cursor.execute("DROP TRIGGER IF EXISTS dbfts_insert")
+        cursor.execute("DROP TRIGGER IF EXISTS dbfts_update")
+        cursor.execute("DROP TRIGGER IF EXISTS dbfts_delete")
+        cursor.execute("""\
+            CREATE TRIGGER dbfts_insert AFTER INSERT ON dbfts BEGIN
+                INSERT INTO dbfts_idx (rowid, content)
+                            VALUES (new.pkey, new.content);
+            END
+            """)
+        cursor.execute("""\
+            CREATE TRIGGER dbfts_delete AFTER DELETE ON dbfts BEGIN
+                INSERT INTO dbfts_idx(dbfts_idx, rowid, content)
+                            VALUES ('delete', old.pkey, old.content);
+            END
+            """)
+        cursor.execute("""\
+            CREATE TRIGGER dbfts_update AFTER UPDATE ON dbfts BEGIN
+                INSERT INTO dbfts_idx(dbfts_idx, rowid, content)
+                            VALUES ('delete', old.pkey, old.content);
+                INSERT INTO dbfts_idx (rowid, content)
+                            VALUES (new.pkey, new.content);
+            END
+            """)
 
     def search(self, query, realms):
         query = self._build_query(query)
@@ -613,6 +960,12 @@ def _build_hash(*values):
     return base64.b64encode(d.digest()).rstrip(b'=')
 
 
+def _hash_from_db(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return bytes(value)  # buffer, memoryview or bytearray
+
+
 def _db_rev(cset):
     rev = cset.rev
     if isinstance(rev, basestring):
@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2010-2014 Chris Nelson <Chris.Nelson@SIXNET.com>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+
+# Time ResourceScheduler on synthetic task graphs.
+#
+# Usage: python contrib/benchmark.py [-n SIZES] [-r REPEAT] [-s SEED]
+#
+# Each graph is a random DAG: every task gets up to three predecessors
+# among the tasks created shortly before it, one of a handful of owners
+# and a random priority.  Tasks are scheduled ASAP and ALAP with
+# resource leveling and the best of REPEAT runs is reported.
+
+import optparse
+import random
+import sys
+import time
+
+from trac.test import EnvironmentStub
+
+from tracjsgantt.tracpm import ResourceScheduler
+
+
+def _tasks(n, rnd, priorities):
+    owners = ['user%d' % i for i in range(20)]
+    tasks = {}
+    for tid in range(1, n + 1):
+        tasks[tid] = {
+            'id': tid,
+            'type': 'task',
+            'status': 'new',
+            'owner': rnd.choice(owners),
+            'priority': rnd.choice(priorities),
+            'milestone': '',
+            'estimatedhours': str(rnd.randint(1, 16)),
+            'children': [],
+            'pred': [],
+            'succ': [],
+        }
+    for tid in range(2, n + 1):
+        for pid in rnd.sample(range(max(1, tid - 50), tid),
+                              min(tid - 1, rnd.randint(0, 3))):
+            tasks[tid]['pred'].append(pid)
+            tasks[pid]['succ'].append(tid)
+    return tasks
+
+
+def _copy(tasks):
+    result = {}
+    for tid, task in tasks.iteritems():
+        task = dict(task)
+        task['pred'] = list(task['pred'])
+        task['succ'] = list(task['succ'])
+        result[tid] = task
+    return result
+
+
+def main(args):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--sizes', dest='sizes',
+                      default='1000,5000,10000,50000',
+                      help='comma separated numbers of tasks')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int',
+                      default=3, help='number of runs, the best is shown')
+    parser.add_option('-s', '--seed', dest='seed', type='int', default=1,
+                      help='seed of the random graphs')
+    options, args = parser.parse_args(args)
+
+    env = EnvironmentStub(default_data=True,
+                          enable=['trac.*', 'tracjsgantt.*'])
+    env.config.set('TracPM', 'fields.estimate', 'estimatedhours')
+    env.config.set('TracPM', 'date_format', '%Y-%m-%d')
+    env.config.set('TracPM', 'relation.pred-succ',
+                   'mastertickets,dest,source')
+    scheduler = ResourceScheduler(env)
+    priorities = [name for name, in env.db_query("""
+            SELECT name FROM enum WHERE type='priority'""")]
+
+    # Deep dependency chains recurse through predecessors.
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 100000))
+
+    print('%8s %-5s %10s' % ('tasks', 'mode', 'time (s)'))
+    for n in [int(size) for size in options.sizes.split(',')]:
+        tasks = _tasks(n, random.Random(options.seed), priorities)
+        for schedule in ('asap', 'alap'):
+            best = None
+            for _ in range(options.repeat):
+                ticketsByID = _copy(tasks)
+                start = time.time()
+                scheduler.scheduleTasks({'schedule': schedule,
+                                         'hoursPerDay': 8.0,
+                                         'doResourceLeveling': '1',
+                                         'useActuals': False,
+                                         'start': '2020-01-06',
+                                         'finish': '2029-12-31'},
+                                        ticketsByID)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            print('%8d %-5s %10.3f' % (n, schedule, best))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -21,6 +21,13 @@ class ITaskSorter(Interface):
     def compareTasks(self, t1, t2):
         """Called to compare two tasks"""
 
+    # Optionally, provide a key for sorting tasks in the same order as
+    # compareTasks().  May be used as key argument for sorted() and
+    # list.sort().  Called after prepareTasks().  Schedulers fall
+    # back to compareTasks() for sorters without sortKey().
+    def sortKey(self, ticket):
+        """Called to get the sort key of a task"""
+
 
 class IResourceCalendar(Interface):
     # Return the number of hours available for the resource on the
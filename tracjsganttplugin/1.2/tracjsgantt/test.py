@@ -124,8 +124,38 @@ class TracPMTestCase(unittest.TestCase):
                             self._get_data, 'test_resource_leveling_1_ASAP')
 
 
+class SortKeyTestCase(unittest.TestCase):
+
+    def test_sort_field(self):
+        class FieldSorter(BaseSorter):
+            sortField = 'effectivePriority'
+
+        tickets = [{'id': 1, 'effectivePriority': 3},
+                   {'id': 2, 'effectivePriority': 1},
+                   {'id': 3, 'effectivePriority': 2}]
+        tickets.sort(key=FieldSorter().sortKey)
+        self.assertEquals([2, 3, 1], [t['id'] for t in tickets])
+
+    def test_compare_tasks_only(self):
+        class DueSorter(BaseSorter):
+            # Latest due date first, then lower id
+            def compareTasks(self, t1, t2):
+                return self.compareOneField('due', t2, t1) or \
+                    self.compareOneField('id', t1, t2)
+
+        tickets = [{'id': 1, 'due': '2014-01-01'},
+                   {'id': 2, 'due': '2014-03-01'},
+                   {'id': 3, 'due': '2014-01-01'},
+                   {'id': 4, 'due': '2014-02-01'}]
+        tickets.sort(key=DueSorter().sortKey)
+        self.assertEquals([2, 4, 1, 3], [t['id'] for t in tickets])
+
+
 def suite():
-    return unittest.makeSuite(TracPMTestCase, 'test')
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TracPMTestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SortKeyTestCase, 'test'))
+    return suite
 
 
 if __name__ == '__main__':
@@ -9,19 +9,24 @@
 import copy
 import datetime
 import operator
+import re
+import threading
+from collections import OrderedDict
 from pkg_resources import resource_filename
 
 
 from trac.config import IntOption, Option
 from trac.core import Component, TracError, implements
-from trac.util.datefmt import localtz, to_utimestamp
+from trac.util.datefmt import format_datetime, localtz, to_utimestamp
+from trac.util.html import html
+from trac.util.presentation import to_json
 from trac.util.text import javascript_quote
-from trac.web.api import IRequestFilter
+from trac.web.api import IRequestFilter, IRequestHandler
 from trac.web.chrome import ITemplateProvider, add_script, add_stylesheet
 from trac.wiki.api import parse_args
 from trac.wiki.macros import WikiMacroBase
 
-from tracpm import TracPM
+from tracpm import TicketRescheduler, TracPM
 
 
 class TracJSGanttSupport(Component):
@@ -162,7 +167,18 @@ Site-wide defaults for macro arguments may be set in the `trac-jsgantt` section
 
 All other macro arguments are treated as TracQuery specification (e.g., milestone=ms1|ms2) to control which tickets are displayed.
 
+The page only holds a placeholder for the chart, the tasks are loaded
+from `/tracjsgantt/tasks` when the page is displayed.  Computed charts
+are kept in memory until a ticket, milestone or the stored schedule
+changes so repeated views, and several charts with the same arguments,
+are only computed once.
+
     """
+    implements(IRequestHandler)
+
+    cache_size = IntOption('trac-jsgantt', 'cache_size', 20,
+        """Number of computed charts to keep in memory (0 disables
+        caching).""")
 
     pm = None
     options = {}
@@ -190,6 +206,16 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
 
         self.GanttID = 'g'
 
+        # Queried tickets, indexed by chart arguments and data version,
+        # and computed tasks, indexed by the same and the tickets the
+        # user may view (see _task_items()).  Oldest first.
+        self._queries = OrderedDict()
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # The chart computation keeps its state in the component and
+        # the scheduler so only one chart is computed at a time.
+        self._lock = threading.RLock()
+
         # All the macro's options with default values.
         # Anything else passed to the macro is a TracQuery field.
         options = ('format', 'formats', 'sample', 'res', 'dur', 'comp',
@@ -233,14 +259,40 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
         text += '}\n'
         return text
 
-    def _end_gantt(self, options):
+    def _draw_gantt(self, options):
         chart = ''
         chart += self.GanttID + '.Draw();\n'
         if options['showdep']:
             chart += self.GanttID + '.DrawDependencies();\n'
-        chart += '</script>\n'
         return chart
 
+    def _end_gantt(self, options):
+        return self._draw_gantt(options) + '</script>\n'
+
+    # Load the tasks from the tasks handler and draw the chart when
+    # they arrive.
+    def _load_tasks(self, options, url):
+        text = ''
+        text += 'jQuery.getJSON("%s", function(tasks) {\n' % \
+            javascript_quote(url)
+        text += '  if (tasks.length == 0) {\n'
+        text += '    jQuery("#GanttChartDIV_' + self.GanttID + \
+            '").text("No tasks selected.");\n'
+        text += '    return;\n'
+        text += '  }\n'
+        text += '  jQuery.each(tasks, function(i, a) {\n'
+        text += '    t = new JSGantt.TaskItem(' + self.GanttID + ', ' + \
+            ', '.join('a[%d]' % i for i in range(14)) + ');\n'
+        text += '    ' + self.GanttID + '.AddTaskItem(t);\n'
+        text += '  });\n'
+        text += self._draw_gantt(options)
+        text += '}).fail(function() {\n'
+        text += '  jQuery("#GanttChartDIV_' + self.GanttID + \
+            '").text("Failed to load tasks.");\n'
+        text += '});\n'
+        text += '</script>\n'
+        return text
+
     def _gantt_options(self, options):
         opt = ''
         if (options['linkStyle']):
@@ -323,7 +375,7 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
 
     # Get the required columns for the tickets which match the
     # criteria in options.
-    def _query_tickets(self, options):
+    def _query_tickets(self, req, options):
         query_options = {}
         for key in options.keys():
             if key not in self.options:
@@ -343,13 +395,7 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
         if 'colorBy' in options:
             fields.add(str(options['colorBy']))
 
-        rawtickets = self.pm.query(query_options, fields, self.req)
-
-        # Do permissions check on tickets
-        tickets = [t for t in rawtickets
-                   if 'TICKET_VIEW' in self.req.perm('ticket', t['id'])]
-
-        return tickets
+        return self.pm.query(query_options, fields, req)
 
     def _compare_tickets(self, t1, t2):
         # If t2 depends on t1, t2 is first
@@ -453,13 +499,13 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
             display = '#ff7f3f'
         return display
 
-    # Format a ticket into JavaScript source to display the
-    # task. ticket is expected to have:
+    # Format a ticket into the arguments of the JSGantt.TaskItem
+    # displaying the task (after the chart).  ticket is expected to
+    # have:
     #   children - child ticket IDs or None
     #   description - ticket description.
     #   id - ticket ID, an integer
     #   level - levels from root (0)
-    #   link - What to link to
     #   owner - Used as resource name.
     #   percent - integer percent complete, 0..100 (or "act/est")
     #   priority - used to color the task
@@ -470,8 +516,11 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
     #   status - string displayed in tool tip ; FIXME - not displayed yet
     #   summary - ticket summary
     #   type - string displayed in tool tip FIXME - not displayed yet
+    #
+    # The link (pLink) is left empty, it depends on the request the
+    # task is sent for (see _send_tasks()).
 
-    def _format_ticket(self, ticket, options):
+    def _task_item(self, ticket, options):
         # Translate owner to full name
         def _owner(ticket):
             if self.pm.isMilestone(ticket):
@@ -490,7 +539,7 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
                         owner_name = self.user_map[owner_name]
             return owner_name
 
-        task = ''
+        task = []
 
         # pID, pName
         if self.pm.isMilestone(ticket):
@@ -504,43 +553,42 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
             name = "#%d:%s (%s %s)" % \
                    (ticket['id'], ticket['summary'],
                     ticket['status'], ticket['type'])
-        task += 't = new JSGantt.TaskItem(%s,%d,"%s",' % \
-            (self.GanttID, ticket['id'], javascript_quote(name))
+        task += [ticket['id'], name]
 
         # pStart, pEnd
-        task += '"%s",' % self.pm.start(ticket).strftime(self.pyDateFormat)
-        task += '"%s",' % self.pm.finish(ticket).strftime(self.pyDateFormat)
+        task.append(self.pm.start(ticket).strftime(self.pyDateFormat))
+        task.append(self.pm.finish(ticket).strftime(self.pyDateFormat))
 
         # pDisplay
-        task += '"%s",' % javascript_quote(self._task_display(ticket, options))
+        task.append(self._task_display(ticket, options))
 
         # pLink
-        task += '"%s",' % javascript_quote(ticket['link'])
+        task.append('')
 
         # pMile
         if self.pm.isMilestone(ticket):
-            task += '1,'
+            task.append(1)
         else:
-            task += '0,'
+            task.append(0)
 
         # pRes (owner)
-        task += '"%s",' % javascript_quote(_owner(ticket))
+        task.append(_owner(ticket))
 
         # pComp (percent complete); integer 0..100
-        task += '"%s",' % self.pm.percentComplete(ticket)
+        task.append('%s' % self.pm.percentComplete(ticket))
 
         # pGroup (has children)
         if self.pm.children(ticket):
-            task += '%s,' % 1
+            task.append(1)
         else:
-            task += '%s,' % 0
+            task.append(0)
 
         # pParent (parent task ID)
         # If there's no parent, don't link to it
         if self.pm.parent(ticket) is None:
-            task += '%s,' % 0
+            task.append(0)
         else:
-            task += '%s,' % self.pm.parent(ticket)
+            task.append(int(self.pm.parent(ticket)))
 
         # open
         if int(ticket['level']) < int(options['openLevel']) and \
@@ -549,24 +597,19 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
             openGroup = 1
         else:
             openGroup = 0
-        task += '%d,' % openGroup
+        task.append(openGroup)
 
         # predecessors
         pred = [str(s) for s in self.pm.predecessors(ticket)]
-        if len(pred):
-            task += '"%s",' % javascript_quote(','.join(pred))
-        else:
-            task += '"%s",' % javascript_quote(','.join(''))
+        task.append(','.join(pred))
 
         # caption
         # FIXME - if caption isn't set to caption, use "" because the
         # description could be quite long and take a long time to make
         # safe and display.
-        task += '"%s (%s %s)"' % (javascript_quote(ticket['description']),
-                                  javascript_quote(ticket['status']),
-                                  javascript_quote(ticket['type']))
-        task += ');\n'
-        task += self.GanttID + '.AddTaskItem(t);\n'
+        task.append('%s (%s %s)' % (ticket['description'],
+                                    ticket['status'],
+                                    ticket['type']))
         return task
 
     def _filter_tickets(self, options, tickets):
@@ -676,47 +719,131 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
 
         return tickets
 
-    def _add_tasks(self, options):
-        if options.get('sample') and int(options['sample']) != 0:
-            tasks = self._add_sample_tasks()
-        else:
-            tasks = ''
-            self.tickets = self._query_tickets(options)
-
-            # Faster lookups for WBS and scheduling.
-            self.ticketsByID = {}
-            for t in self.tickets:
-                self.ticketsByID[t['id']] = t
-
-            # Schedule the tasks
-            self.pm.computeSchedule(options, self.tickets)
-
-            # Sort tickets by date for computing WBS
-            self.tickets.sort(self._compare_tickets)
-
-            # Compute the WBS
-            self._compute_wbs()
-
-            # Set the link for clicking through the Gantt chart
-            for t in self.tickets:
-                if t['id'] > 0:
-                    t['link'] = self.req.href.ticket(t['id'])
-                else:
-                    t['link'] = self.req.href.milestone(t['summary'])
-
-            # Filter tickets based on options (omitMilestones, display, etc.)
-            displayTickets = self._filter_tickets(options, self.tickets)
-
-            # Sort the remaining tickets for display (based on order option).
-            displayTickets = self._sortTickets(displayTickets, options)
-
-            for ticket in displayTickets:
-                tasks += self._format_ticket(ticket, options)
+    # Compute the tasks to display for options from tickets, as
+    # returned by _query_tickets().
+    #
+    # @return a list of (ticket ID, summary, task item) tuples in
+    # display order; see _task_item()
+    def _compute_tasks(self, options, tickets):
+        self.tickets = tickets
 
+        # Faster lookups for WBS and scheduling.
+        self.ticketsByID = {}
+        for t in self.tickets:
+            self.ticketsByID[t['id']] = t
+
+        # Schedule the tasks
+        self.pm.computeSchedule(options, self.tickets)
+
+        # Sort tickets by date for computing WBS
+        self.tickets.sort(self._compare_tickets)
+
+        # Compute the WBS
+        self._compute_wbs()
+
+        # Filter tickets based on options (omitMilestones, display, etc.)
+        displayTickets = self._filter_tickets(options, self.tickets)
+
+        # Sort the remaining tickets for display (based on order option).
+        displayTickets = self._sortTickets(displayTickets, options)
+
+        return [(ticket['id'], ticket['summary'],
+                 self._task_item(ticket, options))
+                for ticket in displayTickets]
+
+    # Return a value which changes whenever the data a chart is
+    # computed from changes: tickets, links from relation tables,
+    # milestones or the schedule stored by the background
+    # rescheduler.
+    def _data_version(self):
+        with self.env.db_query as db:
+            changetime = db("SELECT MAX(changetime) FROM ticket")[0][0]
+            scheduled = db("SELECT MAX(time) FROM schedule_change")[0][0]
+            milestones = db("""
+                    SELECT name, due, completed FROM milestone
+                    ORDER BY name""")
+            # Relation tables have no time stamps.
+            links = []
+            for relation in sorted(self.pm.relations.values()):
+                tbl, src, dst = relation[2:]
+                links.append(frozenset(db("SELECT %s, %s FROM %s" %
+                                          (src, dst, tbl))))
+        return (changetime, scheduled, hash(tuple(milestones)),
+                hash(tuple(links)))
+
+    def _cache_get(self, cache, key):
+        with self._cache_lock:
+            value = cache.pop(key, None)
+            if value is not None:
+                cache[key] = value
+        return value
+
+    def _cache_put(self, cache, key, value):
+        if self.cache_size > 0:
+            with self._cache_lock:
+                cache.pop(key, None)
+                cache[key] = value
+                while len(cache) > self.cache_size:
+                    cache.popitem(last=False)
+
+    # Get the tasks for args (the macro arguments), from the cache if
+    # they were already computed for the current data.
+    #
+    # The queried tickets are cached for the chart arguments and the
+    # data version.  Schedules start from today and "$USER" in a query
+    # depends on who asks so both are part of the key as needed.
+    # Each request schedules only the tickets it may view, so that
+    # hidden tickets affect neither the dates nor the links of the
+    # others, and users who see the same tickets share the tasks.
+    def _task_items(self, req, args):
+        options = self._parse_options(args)
+
+        key = [tuple(sorted((k, unicode(v)) for k, v in options.items())),
+               self._data_version(),
+               datetime.date.today()]
+        if any('$USER' in unicode(v) for v in args.values()):
+            key.append(req.authname)
+        key = tuple(key)
+
+        tickets = self._cache_get(self._queries, key)
+        if tickets is None:
+            tickets = self._query_tickets(req, options)
+            self._cache_put(self._queries, key, tickets)
+        tickets = self.pm.viewableTickets(req, tickets)
+
+        key += (tuple(sorted(t['id'] for t in tickets)),)
+        tasks = self._cache_get(self._cache, key)
+        if tasks is None:
+            with self._lock:
+                # The same chart may have been computed meanwhile.
+                tasks = self._cache_get(self._cache, key)
+                if tasks is None:
+                    # Each computation needs to build its own map.
+                    self.classMap = None
+                    tasks = self._compute_tasks(options, tickets)
+            self._cache_put(self._cache, key, tasks)
         return tasks
 
-    def _parse_options(self, content):
-        _, options = parse_args(content, strict=False)
+    # Send the tasks, with links for req.
+    def _send_tasks(self, req, tasks):
+        items = []
+        for tid, summary, task in tasks:
+            task = list(task)
+            # Set the link for clicking through the Gantt chart
+            if tid > 0:
+                task[5] = req.href.ticket(tid)
+            else:
+                task[5] = req.href.milestone(summary)
+            items.append(task)
+        req.send(to_json(items), 'application/json')
+
+    # @param args macro arguments, either the macro content or the
+    #   parsed arguments
+    def _parse_options(self, args):
+        if isinstance(args, dict):
+            options = dict(args)
+        else:
+            _, options = parse_args(args, strict=False)
 
         for opt in self.options.keys():
             if opt in options:
@@ -738,23 +865,78 @@ All other macro arguments are treated as TracQuery specification (e.g., mileston
         return options
 
     def expand_macro(self, formatter, name, content):
-        self.req = formatter.req
-
-        # Each invocation needs to build its own map.
-        self.classMap = None
+        req = formatter.req
 
         options = self._parse_options(content)
 
         # Surely we can't create two charts in one microsecond.
         self.GanttID = 'g_%s' % to_utimestamp(datetime.datetime.now(localtz))
         chart = ''
-        tasks = self._add_tasks(options)
-        if len(tasks) == 0:
-            chart += 'No tasks selected.'
-        else:
+        if options.get('sample') and int(options['sample']) != 0:
             chart += self._begin_gantt(options)
             chart += self._gantt_options(options)
-            chart += tasks
+            chart += self._add_sample_tasks()
             chart += self._end_gantt(options)
+        else:
+            # The tasks handler doesn't know what ticket the chart is
+            # on so resolve "self" here.
+            _, args = parse_args(content, strict=False)
+            matches = re.match('/ticket/(\d+)', req.path_info)
+            for key in ('root', 'goal'):
+                if args.get(key) == 'self' and matches:
+                    args[key] = matches.group(1)
+
+            chart += self._begin_gantt(options)
+            chart += self._gantt_options(options)
+            chart += self._load_tasks(
+                options, req.href('tracjsgantt', 'tasks', **args))
 
         return chart
+
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        return req.path_info == '/tracjsgantt/tasks'
+
+    def process_request(self, req):
+        req.perm.require('TICKET_VIEW')
+
+        args = dict((str(k), v) for k, v in req.args.items())
+        self._send_tasks(req, self._task_items(req, args))
+
+
+class RescheduleProfileMacro(WikiMacroBase):
+    """
+Displays how long the most recent background reschedules took.
+
+Each reschedule lists the changed tickets and, for each step, the
+number of tickets processed and the time it took.  Profiles are kept
+in memory by the server process, the number kept is set by
+`profile_history` in the `[TracPM]` section.
+"""
+
+    def expand_macro(self, formatter, name, content):
+        profiles = TicketRescheduler(self.env).profiles
+        if not profiles:
+            return html.p('No tickets rescheduled yet.')
+
+        rows = []
+        for profile in reversed(profiles):
+            steps = profile['steps'] or [['', '', '']]
+            for i, step in enumerate(steps):
+                row = html.tr()
+                if i == 0:
+                    row(html.td(format_datetime(profile['time']),
+                                rowspan=len(steps)),
+                        html.td(', '.join('#%s' % tid
+                                          for tid in profile['tickets']),
+                                rowspan=len(steps)))
+                row(html.td(step[0]), html.td(step[1]), html.td(step[2]))
+                rows.append(row)
+
+        return html.table(
+            html.thead(html.tr(html.th('Time'), html.th('Changed'),
+                               html.th('Step'), html.th('Tickets'),
+                               html.th('Duration'))),
+            html.tbody(rows),
+            class_='listing')
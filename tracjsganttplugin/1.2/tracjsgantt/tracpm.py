@@ -6,20 +6,28 @@
 # This software is licensed as described in the file COPYING, which
 # you should have received as part of this distribution.
 
+import atexit
 import re
 import time
 import math
 import copy
+import functools
+import heapq
+import itertools
+import threading
+from collections import deque
 from datetime import timedelta, datetime
 
 import db_default
-from trac.config import Option, ExtensionOption
+from trac.config import IntOption, Option, ExtensionOption
 from trac.core import Component, ExtensionPoint, TracError, implements
 from trac.db import DatabaseManager
 from trac.env import IEnvironmentSetupParticipant
 from trac.ticket.api import ITicketChangeListener
 from trac.ticket.query import Query
 from trac.util.datefmt import format_date, localtz, to_datetime, to_utimestamp
+from trac.util.text import exception_to_unicode
+from trac.web.api import IRequestFilter
 
 from pmapi import IResourceCalendar, ITaskScheduler, ITaskSorter
 
@@ -576,47 +584,46 @@ class TracPM(Component):
     # We could name our sets white, grey, and black, but that's much
     # less clear than naming them for what they contain.
     #
+    # Each step fetches the links of the whole border with a single
+    # query (see LinkCache).
+    #
     # @param origins list of integer ticket IDs to fan out from
     # @param depth how how many times to traverse links (-1=all, default)
+    # @param links LinkCache to use, a new one if None
     # @return list of ticket ID strings for tickets reachable from
     #   origins (including origins)
-    def _reachable(self, origins, depth=-1):
+    def _reachable(self, origins, depth=-1, links=None):
+        if links is None:
+            links = LinkCache(self)
+
+        # The links to follow, with the format of ticket IDs in them.
+        #
+        # Following parent gets children, children gets parents (only
+        # available from a relation), pred gets successors and succ
+        # gets predecessors.
+        fields = []
+        if self.isCfg('parent'):
+            fields.append(('parent', self.parent_format))
+        if self.isRelation('parent'):
+            fields.append(('children', '%s'))
+        if self.isCfg('pred'):
+            fields.append(('pred', '%s'))
+        if self.isCfg('succ'):
+            fields.append(('succ', '%s'))
+
         # Helper to find the immediate neighbors of a set of nodes.
         # @param nodes a set of nodes to find neighbors of
         def neighbors(nodes):
+            links.fetch(nodes, fields)
             n = set()
-            nodes = list(nodes)
-            # Get parents of nodes
-            if self.isCfg('parent'):
-                n |= set(self._followLink(nodes,
-                                          'parent',
-                                          self.parent_format,
-                                          1))
-            # Get children of nodes
-            if self.isRelation('parent'):
-                n |= set(self._followLink(nodes,
-                                          'children',
-                                          '%s',
-                                          1))
-            # Get immediate predecessors of nodes
-            if self.isCfg('pred'):
-                n |= set(self._followLink(nodes,
-                                          'pred',
-                                          '%s',
-                                          1))
-            # Get immedicate successors of nodes
-            if self.isCfg('succ'):
-                n |= set(self._followLink(nodes,
-                                          'succ',
-                                          '%s',
-                                          1))
-
-            return n
+            for field, format in fields:
+                n |= links.follow(nodes, field, format)
+            return set(['%s' % tid for tid in n])
 
         # We haven't explored anything yet.
         explored = set()
         # We'll explore out from the initial set
-        toExplore = set(origins)
+        toExplore = set(['%s' % tid for tid in origins])
         # While we have more exploring to do
         while toExplore != set() and depth != 0:
             depth -= 1
@@ -635,7 +642,7 @@ class TracPM(Component):
     # Expand the list of tickets in origins to include those
     # related through field.
     #
-    # Recurses following link until
+    # Follows link until
     #  * no new items are found, or
     #  * field has been followed depth times
     #
@@ -643,74 +650,48 @@ class TracPM(Component):
     # @param field the field to follow
     # @param format the format of ticket IDs in field
     # @param depth how many steps to follow the link (default -1, no limit)
+    # @param links LinkCache to use, a new one if None
     #
-    # @return a list of integer ticket IDs of tickets up to depth
+    # @return a list of ticket ID strings of tickets up to depth
     # steps from origins via field
 
-    def _followLink(self, origins, field, format, depth=-1):
-        if len(origins) == 0 or depth == 0:
-            return []
-
-        node_list = [format % tid for tid in origins]
-        with self.env.db_query as db:
-            cursor = db.cursor()
-            # Query from external table
-            if self.isRelation(field):
-                relation = self.relations[self.sources[field]]
-                # Forward query
-                if field == relation[0]:
-                    (f1, f2, tbl, src, dst) = relation
-                # Reverse query
-                elif field == relation[1]:
-                    (f1, f2, tbl, dst, src) = relation
-                else:
-                    raise TracError('Relation configuration error for %s' %
-                                    field)
-
-                # Build up enough instances of %s to represent all the
-                # nodes.  The DB API will replace them with items from
-                # node_list, properly quoted for the DB back-end.
-                #
-                # In 0.12, we could do
-                #
-                #   ','.join([db.quote(node) for node in node_list])
-                #
-                # but 0.11 doesn't have db.quote()
-                inClause = "IN (%s)" % ','.join(('%s',) * len(node_list))
-                cursor.execute("SELECT %s FROM %s WHERE %s " %
-                               (dst, tbl, src) +
-                               inClause,
-                               node_list)
-            # Query from custom field
-            elif self.isField(field):
-                fieldName = self.fields[self.sources[field]]
-                # See explantion in relation handling, above.
-                inClause = "IN (%s)" % ','.join(('%s',) * len(node_list))
-                cursor.execute("SELECT t.id "
-                               "FROM ticket AS t "
-                               "LEFT OUTER JOIN ticket_custom AS p ON "
-                               "    (t.id=p.ticket AND p.name=%s) "
-                               "WHERE p.value " + inClause,
-                               [fieldName] + node_list)
-            # We really can't get here because the callers test for
-            # isCfg() but it's nice form to have an else.
-            else:
-                raise TracError('Cannot expand %s; '
-                                'Not configured as a field or relation.' %
-                                field)
+    def _followLink(self, origins, field, format, depth=-1, links=None):
+        if links is None:
+            links = LinkCache(self)
 
+        found = []
+        known = set(['%s' % tid for tid in origins])
+        nodes = known
+        while nodes and depth != 0:
+            depth -= 1
             # Get tickets IDs of related tickets as strings
-            nodes = ['%s' % row[0] for row in cursor]
+            nodes = set(['%s' % tid
+                         for tid in links.follow(nodes, field, format)])
             # Filter out ticket IDs we already know about
-            nodes = [tid for tid in nodes if tid not in origins]
-
-        return nodes + self._followLink(nodes, field, format, depth - 1)
+            nodes -= known
+            known |= nodes
+            found.extend(nodes)
+
+        return found
+
+    # Return the LinkCache shared by the queries made for req, or a
+    # new one if there is no request.
+    def linkCache(self, req=None):
+        if req is None:
+            return LinkCache(self)
+        links = getattr(req, '_tracpm_links', None)
+        if links is None:
+            links = req._tracpm_links = LinkCache(self)
+        return links
 
     # Returns (possibily empty) set of ID strings of tickets
     # meeting PM constraints.
     # FIXME - dumb name
 
-    def preQuery(self, options, req=None):
+    def preQuery(self, options, req=None, links=None):
+        if links is None:
+            links = self.linkCache(req)
+
         ids = set()
 
         this_ticket = None
@@ -745,7 +726,8 @@ class TracPM(Component):
                 ids |= nodes
                 ids |= set(self._followLink(nodes,
                                             'parent',
-                                            self.parent_format))
+                                            self.parent_format,
+                                            links=links))
 
         if options.get('goal'):
             if not self.isCfg('succ'):
@@ -769,13 +751,15 @@ class TracPM(Component):
                 nodes2 = set()
                 while nodes != nodes2:
                     # Get all the predecessors
-                    nodes2 = nodes | set(self._followLink(nodes, 'succ', '%s'))
+                    nodes2 = nodes | set(self._followLink(nodes, 'succ', '%s',
+                                                          links=links))
 
                     # Get the children, if parent configured
                     if self.isCfg('parent'):
                         nodes = nodes2 | set(
                             self._followLink(nodes2, 'parent',
-                                             self.parent_format))
+                                             self.parent_format,
+                                             links=links))
                     else:
                         nodes = nodes2
 
@@ -1011,7 +995,7 @@ class TracPM(Component):
     #
     # Milestones for the tickets are added as pseudo-tickets.
 
-    def postQuery(self, options, tickets):
+    def postQuery(self, options, tickets, links=None):
         # Handle custom fields.
 
         # Clean up custom fields which might be null ('--') vs. blank ('')
@@ -1101,53 +1085,23 @@ class TracPM(Component):
 
         # Fill in relations
         if ids:
-            with self.env.db_query as db:
-                cursor = db.cursor()
-
-                # For each configured relation ...
-                for r in self.relations:
-                    # Get the elements of the relationship ...
-                    f1, f2, tbl, src, dst = self.relations[r]
-                    # ... query all relations with desired IDs on either end.
-                    # See explanation in _followLink()
-                    inClause = "IN (%s)" % ','.join(('%s',) * len(ids))
-                    # Use AND, not OR, here so we only get links between the
-                    # tickets were care about and don't create dangling
-                    # references.
-                    cursor.execute("SELECT %s, %s FROM %s " % (src, dst, tbl) +
-                                   "WHERE %s " % src + inClause +
-                                   " AND %s " % dst + inClause,
-                                   ids + ids)
-
-                    # ... quickly build a local cache of the forward and
-                    # reverse links (where both ends are in the list we care
-                    # about) ...
-                    fwd = {}
-                    rev = {}
-                    for row in cursor:
-                        # FIXME - this masks src, dst field names above.
-                        (src, dst) = row
-
-                        if dst in fwd:
-                            fwd[dst].append(src)
-                        else:
-                            fwd[dst] = [src]
-
-                        if src in rev:
-                            rev[src].append(dst)
-                        else:
-                            rev[src] = [dst]
-
-                    # ... and put the links in the tickets.
-                    for t in tickets:
-                        if t['id'] in fwd:
-                            t[f1] = fwd[t['id']]
-                        else:
-                            t[f1] = []
-                        if t['id'] in rev:
-                            t[f2] = rev[t['id']]
-                        else:
-                            t[f2] = []
+            if links is None:
+                links = LinkCache(self)
+            idSet = set(ids)
+
+            # For each configured relation ...
+            for r in self.relations:
+                f1, f2 = self.relations[r][:2]
+                # ... get the links of all the tickets in both
+                # directions (following f2 gives f1 and vice versa) ...
+                links.fetch(ids, [(f1, '%s'), (f2, '%s')])
+
+                # ... and put the links between the tickets we care
+                # about in the tickets.  Use only those so we don't
+                # create dangling references.
+                for t in tickets:
+                    t[f1] = sorted(links.follow([t['id']], f2, '%s') & idSet)
+                    t[f2] = sorted(links.follow([t['id']], f1, '%s') & idSet)
 
         # Get precomputed schedule, close dates, etc.
         self.getTicketDates(tickets)
@@ -1166,7 +1120,7 @@ class TracPM(Component):
     # @return a list of ticket results, each item is a hash of ticket
     #   fields including those named in fields and those required for PM
     #
-    def query(self, options, fields, req=None):
+    def query(self, options, fields, req=None, links=None):
         query_args = {}
         # Copy query args from caller (e.g., q_a['owner'] = 'monty|phred')
         for key in options.keys():
@@ -1179,7 +1133,9 @@ class TracPM(Component):
 
         # Expand (or set) list of IDs to include those specified by PM
         # query meta-options (e.g., root)
-        pm_ids = self.preQuery(options, req)
+        if links is None:
+            links = self.linkCache(req)
+        pm_ids = self.preQuery(options, req, links)
         if len(pm_ids) != 0:
             if 'id' in query_args:
                 query_args['id'] += '|' + '|'.join(pm_ids)
@@ -1205,10 +1161,36 @@ class TracPM(Component):
         tickets = query.execute(req)
 
         # Post process to add more PM stuff
-        self.postQuery(options, tickets)
+        self.postQuery(options, tickets, links)
 
         return tickets
 
+    # Return copies of the tickets returned by query() which req may
+    # view.  Links to the other tickets are removed from the copies,
+    # as query() does for tickets outside of its result.  Pseudo-tickets
+    # for Trac milestones are kept.  The link lists are copied too
+    # since scheduling extends them (see augmentTickets()).
+    def viewableTickets(self, req, tickets):
+        visible = [t for t in tickets
+                   if self.isTracMilestone(t) or
+                   'TICKET_VIEW' in req.perm('ticket', t['id'])]
+
+        ids = set(t['id'] for t in visible)
+        linkFields = set(['children'])
+        for field in ('pred', 'succ', 'parent', 'children'):
+            if self.isField(field):
+                linkFields.add(self.fields[self.sources[field]])
+            elif self.isRelation(field):
+                linkFields.add(field)
+        result = []
+        for t in visible:
+            t = dict(t)
+            for field in linkFields:
+                if isinstance(t.get(field), list):
+                    t[field] = [tid for tid in t[field] if tid in ids]
+            result.append(t)
+        return result
+
     # tickets is an unordered list of tickets as returned by TracPM.query().
     #
     # TracPM.query() preloads schedule data from the database, if present.
@@ -1361,6 +1343,134 @@ class TracPM(Component):
                 # (which recurses to update other descendants)
                 propagateDependencies(tid)
 
+# ------------------------------------------------------------------------
+# Links between tickets, read from the configured relations and custom
+# fields.
+#
+# For a field, the links of a ticket are the IDs of the tickets which
+# have it in that field, as one step of TracPM._followLink() finds:
+# following 'parent' gives children, 'children' gives parents, 'pred'
+# gives successors and 'succ' gives predecessors.
+#
+# The links of all the tickets and fields asked for at once are read
+# with a single query and remembered, so a LinkCache shared by
+# preQuery(), postQuery() and _reachable() reads each link only once.
+
+
+class LinkCache(object):
+    # Most query parameters to use in one query.  (SQLite allows 999.)
+    maxParams = 900
+
+    def __init__(self, pm):
+        self.pm = pm
+        # Indexed by field then integer ticket ID.  Elements are sets
+        # of integer ticket IDs.
+        self.links = {}
+
+    # Convert ticket IDs to integers, skipping anything else.
+    def _ids(self, ids):
+        result = set()
+        for tid in ids:
+            try:
+                result.add(int(tid))
+            except (TypeError, ValueError):
+                pass
+        return result
+
+    # Build the select for one field.  Rows are the field index, the
+    # ticket the link was asked for and the linked ticket.
+    #
+    # @return SQL and arguments, and a map of the ticket column values
+    #   to ticket IDs (None if the column is a plain ID).
+    def _select(self, db, index, field, format, ids):
+        pm = self.pm
+        holders = ','.join(('%s',) * len(ids))
+        # Query from external table
+        if pm.isRelation(field):
+            relation = pm.relations[pm.sources[field]]
+            # Forward query
+            if field == relation[0]:
+                (f1, f2, tbl, src, dst) = relation
+            # Reverse query
+            elif field == relation[1]:
+                (f1, f2, tbl, dst, src) = relation
+            else:
+                raise TracError('Relation configuration error for %s' %
+                                field)
+            sql = 'SELECT %d, %s, %s FROM %s WHERE %s IN (%s)' % \
+                (index, db.cast(src, 'text'), db.cast(dst, 'text'),
+                 tbl, src, holders)
+            return sql, ['%s' % tid for tid in ids], None
+        # Query from custom field
+        elif pm.isField(field):
+            fieldName = pm.fields[pm.sources[field]]
+            values = dict((format % tid, tid) for tid in ids)
+            sql = 'SELECT %d, p.value, %s ' \
+                  'FROM ticket AS t ' \
+                  'INNER JOIN ticket_custom AS p ON ' \
+                  '    (t.id=p.ticket AND p.name=%%s) ' \
+                  'WHERE p.value IN (%s)' % \
+                  (index, db.cast('t.id', 'text'), holders)
+            return sql, [fieldName] + list(values), values
+        else:
+            raise TracError('Cannot expand %s; '
+                            'Not configured as a field or relation.' %
+                            field)
+
+    # Read the links of ids for each (field, format) in fields that
+    # aren't known yet.
+    def fetch(self, ids, fields):
+        ids = self._ids(ids)
+        todo = []
+        for field, format in fields:
+            known = self.links.setdefault(field, {})
+            missing = sorted(ids - set(known))
+            if missing:
+                todo.append((field, format, missing))
+                for tid in missing:
+                    known[tid] = set()
+        if not todo:
+            return
+
+        size = max(1, (self.maxParams - len(todo)) // len(todo))
+        offset = 0
+        with self.pm.env.db_query as db:
+            while True:
+                selects = []
+                args = []
+                values = []
+                for index, (field, format, missing) in enumerate(todo):
+                    chunk = missing[offset:offset + size]
+                    if chunk:
+                        sql, a, v = self._select(db, index, field, format,
+                                                 chunk)
+                        selects.append(sql)
+                        args.extend(a)
+                        values.append(v)
+                    else:
+                        values.append(None)
+                if not selects:
+                    break
+                for index, tid, other in db(' UNION ALL '.join(selects),
+                                            args):
+                    field = todo[index][0]
+                    if values[index] is None:
+                        tid = int(tid)
+                    else:
+                        tid = values[index][tid]
+                    self.links[field][tid].add(int(other))
+                offset += size
+
+    # Return the set of integer IDs of tickets linked to ids via field.
+    def follow(self, ids, field, format):
+        ids = self._ids(ids)
+        self.fetch(ids, [(field, format)])
+        result = set()
+        known = self.links[field]
+        for tid in ids:
+            result |= known[tid]
+        return result
+
 # ========================================================================
 # Really simple calendar
 #
@@ -1417,6 +1527,17 @@ class BaseSorter:
 
         return avgValue
 
+    # The field compareTasks() sorts on, if it sorts on one field.
+    sortField = None
+
+    # Sort key of a task, ordering tasks like compareTasks().  Valid
+    # after prepareTasks().  Sorters without a sortField are ordered
+    # by compareTasks() itself.
+    def sortKey(self, ticket):
+        if self.sortField is None:
+            return functools.cmp_to_key(self.compareTasks)(ticket)
+        return ticket[self.sortField]
+
     # Compare two tasks by a single field.
     def compareOneField(self, field, t1, t2):
         p1 = t1[field]
@@ -1436,6 +1557,8 @@ class SimpleSorter(BaseSorter, Component):
 
     prioMap = None
 
+    sortField = 'priority'
+
     def __init__(self):
         self.prioMap = self._buildEnumMap('priority')
 
@@ -1470,6 +1593,8 @@ class ProjectSorter(BaseSorter, Component):
 
     prioMap = None
 
+    sortField = 'effectivePriority'
+
     def __init__(self):
         self.prioMap = self._buildEnumMap('priority')
         # FIXME - would I be better off having the PM pass itself in
@@ -1531,6 +1656,20 @@ class ProjectSorter(BaseSorter, Component):
 # resources are available.
 
 
+# Inverts the ordering of a value so a min-heap returns the greatest
+# value first.
+
+
+class _Descending(object):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
 class ResourceScheduler(Component):
     implements(ITaskScheduler)
 
@@ -2151,37 +2290,57 @@ class ResourceScheduler(Component):
                       eligibleField,
                       nextIndex,
                       dependentFunction):
-            unscheduled = ticketsByID.keys()
+            unscheduled = set(ticketsByID)
+
+            # Sort keys are computed once, when a ticket becomes
+            # eligible.  Sorters that only provide compareTasks() are
+            # wrapped so their keys call it.
+            sortKey = getattr(self.sorter, 'sortKey', None) or \
+                functools.cmp_to_key(self.sorter.compareTasks)
+
+            # Eligible tickets are kept in a heap with the best one on
+            # top.  Entries carry a sequence number so tickets with the
+            # same key come out in the order they became eligible (or
+            # in reverse order for nextIndex -1), as when sorting the
+            # eligible list and popping nextIndex.
+            eligible = []
+            sequence = itertools.count()
+
+            def push(ticket):
+                entry = (sortKey(ticket), next(sequence), ticket)
+                if nextIndex == -1:
+                    entry = _Descending(entry)
+                heapq.heappush(eligible, entry)
+
+            def pop():
+                entry = heapq.heappop(eligible)
+                if nextIndex == -1:
+                    entry = entry.value
+                return entry[2]
 
             # FIXME - Sometimes, eligible includes a group which has
             # children which have predecessors or successors.  Do I
             # need to propagate dependencies up, too?  This seems to
             # work but I guess needs more testing.
-            eligible = [ticketsByID[tid] for tid in unscheduled
-                        if ticketsByID[tid][eligibleField] == 0]
+            for tid in ticketsByID:
+                if ticketsByID[tid][eligibleField] == 0:
+                    push(ticketsByID[tid])
 
-            details = True
             while unscheduled and eligible:
-                # FIXME - Maybe sort after adding some. I may not need
-                # to sort every loop.)
-                eligible.sort(self.sorter.compareTasks)
-                if details:
-                    self.env.log.debug('Eligible tickets:%s' %
-                                       [t['id'] for t in eligible])
                 # Schedule the best eligible task
-                ticket = eligible.pop(nextIndex)
+                ticket = pop()
                 tid = ticket['id']
                 if tid in unscheduled:
                     unscheduled.remove(tid)
-                    if details:
-                        self.env.log.debug('  scheduling:%s' % tid)
-                        self.env.log.debug('  unscheduled:%s' % unscheduled)
+                    self.env.log.debug('  scheduling:%s' % tid)
                 else:
                     self.env.log.debug(
                         'Could not remove %s from unscheduled list' % tid)
-                    self.env.log.debug(' unscheduled:%s' % unscheduled)
+                    self.env.log.debug(' unscheduled:%s' %
+                                       sorted(unscheduled))
                     self.env.log.debug(' ticket:%s' % ticket)
-                    self.env.log.debug(' eligible:%s' % eligible)
+                    self.env.log.debug(' eligible:%s' %
+                                       [pop()['id'] for e in list(eligible)])
                     raise TracError(
                         'Could not remove %s from unscheduled list' % tid)
 
@@ -2196,17 +2355,18 @@ class ResourceScheduler(Component):
                         other = ticketsByID[tid]
                         other[eligibleField] -= 1
                         if other[eligibleField] == 0:
-                            eligible.append(other)
+                            push(other)
 
-                if not eligible and len(unscheduled):
-                    details = True
+                if not eligible and unscheduled:
+                    remaining = [tid for tid in ticketsByID
+                                 if tid in unscheduled]
                     self.env.log.error('Not all tickets scheduled')
                     self.env.log.error('%s remain ineligible.  Scheduling.' %
-                                       unscheduled)
-                    eligible = [ticketsByID[tid] for tid in unscheduled]
-                    # Make sure we don't add them again
-                    for ticket in eligible:
-                        ticket[eligibleField] = 0
+                                       remaining)
+                    for tid in remaining:
+                        # Make sure we don't add them again
+                        ticketsByID[tid][eligibleField] = 0
+                        push(ticketsByID[tid])
 
         # Main schedule processing
 
@@ -2265,15 +2425,46 @@ class ResourceScheduler(Component):
 
 
 class TicketRescheduler(Component):
-    implements(ITicketChangeListener)
+    implements(IRequestFilter, ITicketChangeListener)
 
     pm = None
     scheduleFields = None
     options = {}
 
+    reschedule_delay = IntOption('TracPM', 'reschedule_delay', 5,
+        """Seconds to wait after a ticket change before rescheduling in
+        the background.  Changes made while waiting are rescheduled
+        together.  0 reschedules the tickets affected by a change while
+        saving it, as do processes that don't serve web requests for
+        long, like trac-admin and CGI.  Pending changes are rescheduled
+        when the server exits.""")
+
+    profile_history = IntOption('TracPM', 'profile_history', 20,
+        """Number of rescheduling profiles kept for display by the
+        RescheduleProfile macro.""")
+
     def __init__(self):
         self.pm = TracPM(self.env)
 
+        # Changes waiting to be rescheduled, indexed by ticket ID.
+        # Each is [ticket, old_values].
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._timer = None
+        self._running = False
+        self._exiting = False
+        self._atexit = False
+
+        # Whether this process serves web requests for long enough to
+        # reschedule in the background.  Set by pre_process_request().
+        self._longLived = False
+
+        # The most recent profiles, newest last.  Each is a
+        # dictionary with the time of the run, the IDs of the changed
+        # tickets and the profile steps.
+        self.profiles = deque(maxlen=max(1, self.profile_history))
+
         self.scheduleFields = []
 
         # Built-in fields that can affect scheduling
@@ -2349,8 +2540,10 @@ class TicketRescheduler(Component):
     # @param ticket ticket object passed to change listener
     # @param old_values list of old values passed to change listener
     #
+    # @param links LinkCache to use, a new one if None
+    #
     # @return a list of ticket ID strings
-    def _findAffected(self, ticket, old_values):
+    def _findAffected(self, ticket, old_values, links=None):
         # Helper to find owners of tickets
         # @param ids set of tickets ID strings
         # @return set of owner strings
@@ -2437,7 +2630,7 @@ class TicketRescheduler(Component):
         # @param ids set of ticket ID strings to find more tickets from
         # @return set of IDs for tickets related to ids
         def more(ids):
-            n = set(self.pm._reachable(list(ids)))
+            n = set(self.pm._reachable(list(ids), links=links))
 
             # Get owners for these tickets
             newOwners = ownersOf(n)
@@ -2606,15 +2799,16 @@ class TicketRescheduler(Component):
     # to reschedule
     #
     # @param ids list of ticket IDs to get data for
+    # @param links LinkCache to use, a new one if None
     #
     # @return list of hashes for tickets
 
-    def queryTickets(self, ids):
+    def queryTickets(self, ids, links=None):
         options = {}
         options['max'] = 0
         options['id'] = "|".join(ids)
 
-        return self.pm.query(options, set())
+        return self.pm.query(options, set(), links=links)
 
     ##
     # Update in-memory relationships because other plugins' ticket
@@ -2684,13 +2878,15 @@ class TicketRescheduler(Component):
             if linkFieldNames['parent'] in old_values:
                 # Remove ticket from children of old parent
                 parent = \
-                    ticketsByID[old_values[[linkFieldsName['parent']]]]
-                parent['children'] = \
-                    [cid for cid in parent['children'] if cid != ticket.id]
+                    ticketsByID.get(old_values[linkFieldNames['parent']])
+                if parent:
+                    parent['children'] = \
+                        [cid for cid in parent['children']
+                         if cid != ticket.id]
                 # Add ticket to children of new parent
                 parent = \
-                    ticketsByID[ticket[linkFieldsNames['parent']]]
-                if ticket.id not in parent['children']:
+                    ticketsByID.get(ticket[linkFieldNames['parent']])
+                if parent and ticket.id not in parent['children']:
                     parent['children'].append(ticket.id)
 
             # The custom fields which allow previewing predecessors
@@ -2726,13 +2922,13 @@ class TicketRescheduler(Component):
                 # being used.
                 if previewFields[fwd] in old_values:
                     # Get the set of old and new dependants
-                    if len(old_values[previewFields[fwd]]) == 0:
+                    if not old_values[previewFields[fwd]]:
                         oldDependants = set()
                     else:
                         ids = old_values[previewFields[fwd]].split(',')
                         oldDependants = set([int(tid) for tid in ids])
 
-                    if len(ticket[previewFields[fwd]]) == 0:
+                    if not ticket[previewFields[fwd]]:
                         newDependants = set()
                     else:
                         ids = ticket[previewFields[fwd]].split(',')
@@ -2743,6 +2939,12 @@ class TicketRescheduler(Component):
                     removed = oldDependants - newDependants
                     added = newDependants - oldDependants
 
+                    # Only tickets in the graph can be linked.
+                    if ticket.id not in ticketsByID:
+                        continue
+                    removed &= set(ticketsByID)
+                    added &= set(ticketsByID)
+
                     # Remove from both ends, if needed
                     for tid in removed:
                         ticketsByID[ticket.id][fwdField] = \
@@ -2841,6 +3043,7 @@ class TicketRescheduler(Component):
                 # (Build before/after values as we go to update history next.)
                 start = datetime.now()
                 values = []
+                updates = []
                 for t in tickets:
                     if t['id'] in toUpdate:
                         value = ()
@@ -2855,16 +3058,15 @@ class TicketRescheduler(Component):
                                   to_utimestamp(self.pm.finish(t)))
 
                         values.append(value)
+                        updates.append((value[4], value[5], t['id']))
 
-                        cursor.execute('UPDATE schedule'
+                # Third, update the schedule and insert the history
+                # for the updated tickets.
+                if len(toUpdate) != 0:
+                    cursor.executemany('UPDATE schedule'
                                        ' SET start=%s, finish=%s'
                                        ' WHERE ticket=%s',
-                                       (to_utimestamp(self.pm.start(t)),
-                                        to_utimestamp(self.pm.finish(t)),
-                                        t['id']))
-
-                # Third, insert the history for the updated tickets.
-                if len(toUpdate) != 0:
+                                       updates)
                     cursor.executemany('INSERT INTO schedule_change' +
                                        ' (ticket, time,' +
                                        ' oldstart, oldfinish,' +
@@ -2932,19 +3134,15 @@ class TicketRescheduler(Component):
         # Each entry is [ step, ticketcount, time ]
         profile = []
 
+        # Links read while finding and querying tickets
+        links = self.pm.linkCache()
+
         with self.env.db_query as db:
             cursor = db.cursor()
 
             # Get IDs of active goals
             start = datetime.now()
-            inClause = 'IN (%s)' % \
-                ','.join(('%s',) * len(self.pm.activeGoalStatuses))
-            cursor.execute('SELECT id FROM ticket' +
-                           ' WHERE type = %s' +
-                           ' AND status ' + inClause,
-                           [self.pm.goalTicketType] +
-                           self.pm.activeGoalStatuses)
-            activeGoals = ['%s' % row[0] for row in cursor]
+            activeGoals = self._activeGoals(cursor)
             end = datetime.now()
             profile.append(['getting active goals',
                             len(activeGoals),
@@ -2955,7 +3153,8 @@ class TicketRescheduler(Component):
             # NOTE: This includes closed tickets which are predecessors of
             # work still to be done.
             start = datetime.now()
-            nowActive = self.pm.preQuery({'goal': '|'.join(activeGoals)})
+            nowActive = self.pm.preQuery({'goal': '|'.join(activeGoals)},
+                                         links=links)
             end = datetime.now()
             profile.append(['getting active tickets',
                             len(nowActive),
@@ -3002,36 +3201,163 @@ class TicketRescheduler(Component):
         else:
             self.env.log.debug('%s is not active' % tid)
         if tid in nowActive or tid in wasActive:
-            start = datetime.now()
+            tickets, idle = self._queryActive(wasActive, nowActive,
+                                              profile, links)
+        else:
+            idle = []
+            tickets = []
+
+        self._reschedule(tickets, idle, profile)
+        self._recordProfile([ticket.id], profile)
 
-            # Get ticket details of all tickets to process
-            details = self.queryTickets(wasActive | nowActive)
+    # Reschedule the tickets affected by a set of changes.
+    #
+    # Unlike rescheduleTickets(), which reschedules every active
+    # ticket, only the subgraph of tickets affected by the changes
+    # (see _findAffected()) is queried and rescheduled.  That subgraph
+    # holds every ticket related to, or sharing an owner with, a
+    # ticket in it so it can be scheduled on its own.
+    #
+    # @param changes list of [ticket, old_values] as passed to
+    # TicketChangeListener methods
+    #
+    # No return.  The calculated start and finish dates in the ticket
+    # database may be updated.
+    def rescheduleChanges(self, changes):
+        # If active statuses configured
+        if not self.pm.activeGoalStatuses:
+            self.env.log.info('Background ticket rescheduler requires' +
+                              ' goal ticket type and active goal statuses' +
+                              ' to be configured.')
+            return
 
-            # Get the active tickets
-            tickets = [t for t in details if str(t['id']) in nowActive]
-            self.env.log.debug('There are %d active tickets' % len(tickets))
+        # Each step (e.g., finding, querying, pruning) has an entry
+        # Each entry is [ step, ticketcount, time ]
+        profile = []
 
-            # Prune to those that aren't closed
-            self._pruneClosed(tickets)
-            self.env.log.debug('There are %d active, open tickets' %
-                               len(tickets))
+        # Links read while finding and querying tickets
+        links = self.pm.linkCache()
 
-            # Update nowActive based on pruning
-            nowActive = set([str(t['id']) for t in tickets])
+        # Get IDs of tickets affected by any of the changes
+        start = datetime.now()
+        affected = set()
+        for ticket, old_values in changes:
+            affected |= set(self._findAffected(ticket, old_values, links))
+        end = datetime.now()
+        profile.append(['finding affected tickets',
+                        len(affected),
+                        end - start])
 
-            # Find idle tickets
-            idleIDs = wasActive - nowActive
-            self.env.log.debug('%d tickets were idled' % len(idleIDs))
-            idle = [t for t in details if str(t['id']) in idleIDs]
+        with self.env.db_query as db:
+            cursor = db.cursor()
 
+            # Get IDs of active goals in the subgraph.  Goals outside
+            # of it don't require any affected ticket.
+            start = datetime.now()
+            activeGoals = [tid for tid in self._activeGoals(cursor)
+                           if tid in affected]
             end = datetime.now()
-            profile.append(['getting ticket details',
-                            len(details),
+            profile.append(['getting active goals',
+                            len(activeGoals),
                             end - start])
+
+            # Get IDs of affected tickets required for those goals
+            start = datetime.now()
+            if activeGoals:
+                nowActive = \
+                    self.pm.preQuery({'goal': '|'.join(activeGoals)},
+                                     links=links)
+            else:
+                nowActive = set()
+            end = datetime.now()
+            profile.append(['getting active tickets',
+                            len(nowActive),
+                            end - start])
+
+            # Get IDs of affected tickets that were active before
+            start = datetime.now()
+            cursor.execute('SELECT ticket FROM schedule')
+            wasActive = set(['%s' % row[0] for row in cursor]) & affected
+            end = datetime.now()
+            profile.append(['getting scheduled tickets',
+                            len(wasActive),
+                            end - start])
+
+        tickets, idle = self._queryActive(wasActive, nowActive, profile,
+                                          links)
+
+        # Make sure the graph reflects the changed relationships.
+        for ticket, old_values in changes:
+            self.spliceGraph(tickets, ticket, old_values)
+
+        self._reschedule(tickets, idle, profile)
+        self._recordProfile([ticket.id for ticket, old_values in changes],
+                            profile)
+
+    # Get IDs of active goals
+    #
+    # @param cursor database cursor to query with
+    #
+    # @return a list of ticket ID strings
+    def _activeGoals(self, cursor):
+        inClause = 'IN (%s)' % \
+            ','.join(('%s',) * len(self.pm.activeGoalStatuses))
+        cursor.execute('SELECT id FROM ticket' +
+                       ' WHERE type = %s' +
+                       ' AND status ' + inClause,
+                       [self.pm.goalTicketType] +
+                       self.pm.activeGoalStatuses)
+        return ['%s' % row[0] for row in cursor]
+
+    # Get details of the tickets to reschedule.
+    #
+    # @param wasActive set of ID strings of scheduled tickets
+    # @param nowActive set of ID strings of tickets now required for
+    # an active goal
+    # @param profile list of profile steps to append to
+    # @param links LinkCache to use, a new one if None
+    #
+    # @return a list of open, active tickets and a list of tickets
+    # which are no longer active
+    def _queryActive(self, wasActive, nowActive, profile, links=None):
+        start = datetime.now()
+
+        # Get ticket details of all tickets to process
+        if wasActive or nowActive:
+            details = self.queryTickets(wasActive | nowActive, links)
         else:
-            idle = []
-            tickets = []
+            details = []
+
+        # Get the active tickets
+        tickets = [t for t in details if str(t['id']) in nowActive]
+        self.env.log.debug('There are %d active tickets' % len(tickets))
+
+        # Prune to those that aren't closed
+        self._pruneClosed(tickets)
+        self.env.log.debug('There are %d active, open tickets' %
+                           len(tickets))
+
+        # Update nowActive based on pruning
+        nowActive = set([str(t['id']) for t in tickets])
+
+        # Find idle tickets
+        idleIDs = wasActive - nowActive
+        self.env.log.debug('%d tickets were idled' % len(idleIDs))
+        idle = [t for t in details if str(t['id']) in idleIDs]
+
+        end = datetime.now()
+        profile.append(['getting ticket details',
+                        len(details),
+                        end - start])
+
+        return tickets, idle
 
+    # Compute the schedule of tickets and store the changes.
+    #
+    # @param tickets list of open, active tickets
+    # @param idle list of tickets to remove from the schedule
+    # @param profile list of profile steps to append to
+    def _reschedule(self, tickets, idle, profile):
         # Reschedule only if there are active tickets
         if len(tickets) != 0:
             # Compute schedule with configured options
@@ -3055,10 +3381,94 @@ class TicketRescheduler(Component):
         # Update the database for any rescheduled or idled tickets
         self._updateScheduleDB(idle, tickets, profile)
 
+    # Log a rescheduling profile and keep it for display.
+    #
+    # @param ids IDs of the changed tickets
+    # @param profile list of profile steps
+    def _recordProfile(self, ids, profile):
         for step in profile:
             self.env.log.info('%s %s tickets took %s' %
                               (step[0], step[1], step[2]))
 
+        self.profiles.append({'time': datetime.now(localtz),
+                              'tickets': sorted(ids),
+                              'steps': profile})
+
+    # Queue a change for rescheduling.
+    #
+    # Changes to the same ticket are merged, keeping the oldest value
+    # of each field, and all changes queued within reschedule_delay
+    # seconds are rescheduled together by a background thread.  Other
+    # processes than long-lived web servers reschedule right away.
+    def _queueChange(self, ticket, old_values):
+        if self.reschedule_delay <= 0 or not self._longLived or \
+                self._exiting:
+            self.rescheduleChanges([[ticket, old_values]])
+            return
+
+        with self._lock:
+            if ticket.id in self._pending:
+                merged = dict(old_values)
+                merged.update(self._pending[ticket.id][1])
+                old_values = merged
+            self._pending[ticket.id] = [ticket, old_values]
+            self._startTimer()
+
+    # Start the background timer unless it is already waiting or
+    # rescheduling.  Must be called with _lock held.
+    def _startTimer(self):
+        if not self._atexit:
+            atexit.register(self._flushPending)
+            self._atexit = True
+        if self._timer is None and not self._running and not self._exiting:
+            self._timer = threading.Timer(self.reschedule_delay,
+                                          self._runPending)
+            self._timer.daemon = True
+            self._timer.start()
+
+    # Reschedule the queued changes.  Runs in the timer thread.
+    def _runPending(self):
+        with self._lock:
+            self._timer = None
+            changes = self._pending.values()
+            self._pending = {}
+            self._running = True
+        try:
+            self.rescheduleChanges(changes)
+        except Exception, e:
+            self.env.log.error('Rescheduling %s failed: %s',
+                               [ticket.id for ticket, old_values in changes],
+                               exception_to_unicode(e, traceback=True))
+        finally:
+            with self._lock:
+                self._running = False
+                self._idle.notify_all()
+                if self._pending:
+                    self._startTimer()
+
+    # Reschedule the queued changes before the process exits, as the
+    # daemon timer thread doesn't get to run then.
+    def _flushPending(self):
+        with self._lock:
+            self._exiting = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            while self._running:
+                self._idle.wait()
+            if not self._pending:
+                return
+        self._runPending()
+
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        self._longLived = not req.environ.get('wsgi.run_once', False)
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
     # ITicketChangeListener methods
     #
     # The change listener methods get called after all changes have
@@ -3066,14 +3476,14 @@ class TicketRescheduler(Component):
 
     def ticket_created(self, ticket):
         self.env.log.info('Ticket %s created.' % ticket.id)
-        self.rescheduleTickets(ticket, {})
+        self._queueChange(ticket, {})
 
     def ticket_changed(self, ticket, comment, author, old_values):
         if self._affectsSchedule(ticket, old_values):
             self.env.log.info('Changes to %s affect schedule.  Rescheduling.' %
                               ticket.id)
-            self.rescheduleTickets(ticket, old_values)
+            self._queueChange(ticket, old_values)
 
     def ticket_deleted(self, ticket):
         self.env.log.info('Ticket %s deleted.' % ticket.id)
-        self.rescheduleTickets(ticket, {})
+        self._queueChange(ticket, {})
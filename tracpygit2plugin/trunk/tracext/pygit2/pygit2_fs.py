@@ -6,11 +6,15 @@
 # This software is licensed as described in the file COPYING, which
 # you should have received as part of this distribution.
 
+import copy
 import os
 import posixpath
+import time
+from bisect import bisect_left, bisect_right
 from cStringIO import StringIO
 from datetime import datetime
-from threading import RLock
+from multiprocessing.pool import ThreadPool
+from threading import RLock, local
 
 try:
     import pygit2
@@ -134,6 +138,11 @@ class GitCachedRepository(CachedRepository):
 
     has_linear_changesets = False
 
+    def __init__(self, env, repos, log, sync_batch_size=100, sync_workers=2):
+        CachedRepository.__init__(self, env, repos, log)
+        self.sync_batch_size = max(1, sync_batch_size)
+        self.sync_workers = max(0, sync_workers)
+
     def short_rev(self, rev):
         return self.repos.short_rev(rev)
 
@@ -188,13 +197,8 @@ class GitCachedRepository(CachedRepository):
 
         IntegrityError = _db_exc(self.env).IntegrityError
         cursor = db.cursor()
-
-        def is_synced(rev):
-            cursor.execute("SELECT COUNT(repos) FROM revision "
-                           "WHERE repos=%s AND rev=%s",
-                           (self.id, rev))
-            row = cursor.fetchone()
-            return row[0] > 0
+        cursor.execute("SELECT rev FROM revision WHERE repos=%s", (self.id,))
+        synced = set(row[0] for row in cursor)
 
         def traverse(commit, seen):
             commits = []
@@ -204,7 +208,7 @@ class GitCachedRepository(CachedRepository):
                 if rev in seen:
                     break
                 seen.add(rev)
-                if is_synced(rev):
+                if rev in synced:
                     break
                 commits.append(commit)
                 parents = commit.parents
@@ -218,53 +222,123 @@ class GitCachedRepository(CachedRepository):
                     commits[idx:idx] = traverse(parent, seen)
             return commits
 
-        while True:
-            repos_youngest = repos.youngest_rev or ''
-            updated = [False]
-            seen = set()
-
-            for name in git_repos.listall_references():
-                ref = git_repos.lookup_reference(name)
-                git_object = ref.get_object()
-                type_ = git_object.type
-                if type_ == GIT_OBJ_TAG:
-                    git_object = git_object.get_object()
-                    type_ = git_object.type
-                if type_ != GIT_OBJ_COMMIT:
-                    continue
-
-                commits = traverse(git_object, seen)  # topology ordered
-                while commits:
-                    # sync revision from older revision to newer revision
-                    commit = commits.pop()
-                    rev = commit.hex
-                    self.log.info("Trying to sync revision [%s]", rev)
-                    cset = GitChangeset(repos, commit)
+        def insert(csets):
+            try:
+                @self.env.with_transaction()
+                def do_insert(db):
+                    for rev, cset in csets:
+                        self._insert_cset(db, rev, cset)
+            except IntegrityError, e:
+                # another process cached some of these revisions
+                self.log.info('Revisions %s..%s partly cached: %r',
+                              csets[0][0], csets[-1][0], e)
+                for rev, cset in csets:
                     @self.env.with_transaction()
                     def do_insert(db):
                         try:
                             self._insert_cset(db, rev, cset)
-                            updated[0] = True
                         except IntegrityError, e:
                             self.log.info('Revision %s already cached: %r',
                                           rev, e)
                             db.rollback()
-                    if feedback:
-                        feedback(rev)
+            synced.update(rev for rev, cset in csets)
 
-            if updated[0]:
-                continue  # sync again
+        pool = None
+        if self.sync_workers:
+            pool = ThreadPool(self.sync_workers)
+        try:
+            while True:
+                repos_youngest = repos.youngest_rev or ''
+                updated = False
+                seen = set()
 
-            if meta_youngest != repos_youngest:
-                @self.env.with_transaction()
-                def update_metadata(db):
-                    cursor = db.cursor()
-                    cursor.execute("""
-                        UPDATE repository SET value=%s WHERE id=%s AND name=%s
-                        """, (repos_youngest, self.id, CACHE_YOUNGEST_REV))
-                    del self.metadata
+                for name in git_repos.listall_references():
+                    ref = git_repos.lookup_reference(name)
+                    git_object = ref.get_object()
+                    type_ = git_object.type
+                    if type_ == GIT_OBJ_TAG:
+                        git_object = git_object.get_object()
+                        type_ = git_object.type
+                    if type_ != GIT_OBJ_COMMIT:
+                        continue
+
+                    commits = traverse(git_object, seen)  # topology ordered
+                    if not commits:
+                        continue
+                    # sync revision from older revision to newer revision
+                    commits.reverse()
+                    self.log.info("Trying to sync %d revisions from [%s] "
+                                  "to [%s]", len(commits), commits[0].hex,
+                                  commits[-1].hex)
+                    start = time.time()
+                    count = 0
+                    for csets in self._iter_sync_csets(pool, commits):
+                        insert(csets)
+                        updated = True
+                        count += len(csets)
+                        self.log.info("Synced %d/%d revisions in %.1f "
+                                      "seconds", count, len(commits),
+                                      time.time() - start)
+                        if feedback:
+                            for rev, cset in csets:
+                                feedback(rev)
+
+                if updated:
+                    continue  # sync again
+
+                repos._get_commit_graph()  # index the new commits
+
+                if meta_youngest != repos_youngest:
+                    @self.env.with_transaction()
+                    def update_metadata(db):
+                        cursor = db.cursor()
+                        cursor.execute("""
+                            UPDATE repository SET value=%s
+                            WHERE id=%s AND name=%s
+                            """, (repos_youngest, self.id, CACHE_YOUNGEST_REV))
+                        del self.metadata
+                return
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def _iter_sync_csets(self, pool, commits):
+        """Yield the changesets of `commits` as lists of `(rev, cset)`
+        of at most `sync_batch_size` items.
+
+        With a `pool`, the changesets of the next batch are built by
+        the workers, each using its own `pygit2.Repository`, while the
+        current batch is inserted.
+        """
+        size = self.sync_batch_size
+        batches = [commits[idx:idx + size]
+                   for idx in xrange(0, len(commits), size)]
+        if not pool:
+            for batch in batches:
+                yield [(commit.hex, _SyncChangeset(self.repos, commit))
+                       for commit in batch]
             return
 
+        repos = self.repos
+        workers = local()
+
+        def build(rev):
+            worker_repos = getattr(workers, 'repos', None)
+            if worker_repos is None:
+                worker_repos = workers.repos = repos._clone()
+            commit = worker_repos.git_repos[rev]
+            return rev, _SyncChangeset(worker_repos, commit)
+
+        pending = None
+        for batch in batches:
+            result = pool.map_async(build, [commit.hex for commit in batch])
+            if pending:
+                yield pending.get()
+            pending = result
+        if pending:
+            yield pending.get()
+
     if not hasattr(CachedRepository, 'remove_cache'):
         def remove_cache(self):
             self.log.info("Cleaning cache")
@@ -355,6 +429,21 @@ class GitCachedRepository(CachedRepository):
                     """, (self.id, srev, path, kind, action, bpath, brev))
 
 
+class _SyncChangeset(Changeset):
+    """A changeset with its changes read ahead, to be inserted in the
+    cache.
+    """
+
+    def __init__(self, repos, commit):
+        cset = GitChangeset(repos, commit)
+        Changeset.__init__(self, repos, cset.rev, cset.message, cset.author,
+                           cset.date)
+        self.changes = list(cset.get_changes())
+
+    def get_changes(self):
+        return iter(self.changes)
+
+
 class GitCachedChangeset(CachedChangeset):
     """Git-specific cached changeset."""
 
@@ -412,47 +501,189 @@ def _walk_tree(repos, tree, path=None):
             yield git_object, name
 
 
-class _CachedWalker(object):
+class _CommitGraph(object):
+    """Index of the commits on the branches of a repository, in the
+    style of the commit-graph file of git.
 
-    __slots__ = ('rev', 'walker', 'revs', 'commits', '_lock')
+    Commits are numbered in topological order. For each of them, the
+    index keeps the positions of its parents and children, its commit
+    time and its generation number: one more than the highest
+    generation of its parents. A commit can only be an ancestor of the
+    commits with a higher generation, which bounds the ancestry walks.
+    The commits sorted by time give the history between two dates.
 
-    def __init__(self, git_repos, rev, flags=_walk_flags):
-        self.rev = rev
-        self.walker = git_repos.walk(rev, flags)
-        self.revs = set()
-        self.commits = []
-        self._lock = RLock()
+    The index is shared by the `GitRepository` instances of the same
+    repository and updated incrementally when branches move forward.
+    A shared index is never modified: the updates are made on a copy,
+    which then replaces it.
+    """
+
+    def __init__(self):
+        self.tips = {}  # branch name -> rev
+        self.pos = {}
+        self.revs = []
+        self.times = []
+        self.gens = []
+        self.parents = []
+        self.children = []
+        self.by_time = []  # (commit time, position)
 
     def __contains__(self, rev):
-        self._lock.acquire()
-        try:
-            if rev in self.revs:
-                return True
-            add_rev = self.revs.add
-            add_commit = self.commits.append
-            for commit in self.walker:
-                old_rev = commit.hex
-                add_commit(commit)
-                add_rev(old_rev)
-                if old_rev == rev:
-                    return True
+        return rev in self.pos
+
+    def copy(self):
+        """Return a copy of the index that can be updated without
+        affecting this one.
+        """
+        graph = _CommitGraph()
+        graph.tips = dict(self.tips)
+        graph.pos = dict(self.pos)
+        graph.revs = list(self.revs)
+        graph.times = list(self.times)
+        graph.gens = list(self.gens)
+        graph.parents = list(self.parents)
+        # the lists of children are replaced by update(), not extended
+        graph.children = list(self.children)
+        graph.by_time = self.by_time
+        return graph
+
+    def update(self, git_repos, tips):
+        """Index the commits reachable from the `tips` branch heads.
+
+        Return `False` if some indexed commits may no longer be on a
+        branch, in which case the index must be rebuilt.
+        """
+        pos = self.pos
+        revs = self.revs
+        times = self.times
+        gens = self.gens
+        parents = self.parents
+        children = self.children
+        start = len(revs)
+
+        new_tips = [rev for rev in set(tips.itervalues()) if rev not in pos]
+        if new_tips:
+            walker = git_repos.walk(new_tips[0],
+                                    GIT_SORT_TOPOLOGICAL | GIT_SORT_REVERSE)
+            for rev in new_tips[1:]:
+                walker.push(rev)
+            for rev in set(self.tips.itervalues()):
+                if rev in git_repos:
+                    walker.hide(rev)
+            for commit in walker:
+                rev = commit.hex
+                if rev in pos:
+                    continue
+                idx = len(revs)
+                parent_idxs = tuple(pos[parent.hex]
+                                    for parent in commit.parents)
+                gen = 1
+                for parent_idx in parent_idxs:
+                    children[parent_idx] = children[parent_idx] + [idx]
+                    gen = max(gen, gens[parent_idx] + 1)
+                revs.append(rev)
+                times.append(commit.commit_time)
+                gens.append(gen)
+                parents.append(parent_idxs)
+                children.append([])
+                pos[rev] = idx
+
+        if len(revs) > start:
+            self.by_time = sorted(self.by_time +
+                                  [(times[idx], idx)
+                                   for idx in xrange(start, len(revs))])
+
+        old_tips = set(self.tips.itervalues())
+        self.tips = dict(tips)
+        tip_revs = set(tips.itervalues())
+        for rev in old_tips - tip_revs:
+            if not any(self.is_ancestor(rev, tip) for tip in tip_revs):
+                return False
+        return True
+
+    def _is_ancestor(self, idx1, idx2):
+        if idx1 == idx2:
+            return True
+        gens = self.gens
+        gen1 = gens[idx1]
+        if gen1 >= gens[idx2]:
             return False
-        finally:
-            self._lock.release()
+        parents = self.parents
+        seen = set([idx2])
+        stack = [idx2]
+        while stack:
+            for idx in parents[stack.pop()]:
+                if idx == idx1:
+                    return True
+                if idx not in seen and gens[idx] > gen1:
+                    seen.add(idx)
+                    stack.append(idx)
+        return False
+
+    def is_ancestor(self, rev1, rev2):
+        """Return whether `rev1` is `rev2` or one of its ancestors."""
+        pos = self.pos
+        return rev1 in pos and rev2 in pos and \
+               self._is_ancestor(pos[rev1], pos[rev2])
+
+    def branches(self, rev):
+        """Return the `(name, head)` of the branches containing `rev`."""
+        return [(name, tip) for name, tip in self.tips.iteritems()
+                if self.is_ancestor(rev, tip)]
+
+    def children_revs(self, rev, tip=None):
+        """Return the children of `rev`, on the branch of head `tip` if
+        given, from the oldest to the youngest.
+        """
+        pos = self.pos
+        if rev not in pos:
+            return []
+        times = self.times
+        idxs = self.children[pos[rev]]
+        if tip is not None:
+            tip_idx = pos[tip]
+            idxs = [idx for idx in idxs if self._is_ancestor(idx, tip_idx)]
+        revs = self.revs
+        return [revs[idx]
+                for idx in sorted(idxs, key=lambda idx: (times[idx], idx))]
+
+    def between(self, start, stop):
+        """Return the revs committed between the `start` and `stop`
+        timestamps, from the youngest to the oldest.
+        """
+        by_time = self.by_time
+        lo = bisect_left(by_time, (start, -1))
+        hi = bisect_right(by_time, (stop, len(self.revs)))
+        revs = self.revs
+        return [revs[idx] for ts, idx in reversed(by_time[lo:hi])]
 
-    def reverse(self, start_rev):
-        self._lock.acquire()
-        try:
-            if start_rev in self:
-                commits = self.commits
-                idx = len(commits) - 1
-                for idx in xrange(len(commits) - 1, -1, -1):
-                    commit = commits[idx]
-                    if commit.hex == start_rev:
-                        return reversed(commits[0:idx + 1])
-            return ()
-        finally:
-            self._lock.release()
+
+_commit_graphs = {}
+_commit_graphs_lock = RLock()
+
+
+def _get_commit_graph(path, git_repos, tips):
+    """Return the `_CommitGraph` of the repository at `path`, updated
+    for the `tips` branch heads.
+    """
+    graph = _commit_graphs.get(path)
+    if graph is not None and graph.tips == tips:
+        return graph
+    _commit_graphs_lock.acquire()
+    try:
+        graph = _commit_graphs.get(path)
+        if graph is None or graph.tips != tips:
+            if graph is not None:
+                graph = graph.copy()
+                if not graph.update(git_repos, tips):
+                    graph = None
+            if graph is None:
+                graph = _CommitGraph()
+                graph.update(git_repos, tips)
+            _commit_graphs[path] = graph
+        return graph
+    finally:
+        _commit_graphs_lock.release()
 
 
 class GitConnector(Component):
@@ -558,6 +789,15 @@ class GitConnector(Component):
         git_fs_encoding = Option('git', 'git_fs_encoding', 'utf-8',
             N_("Define charset encoding of paths within git repositories."))
 
+    sync_batch_size = IntOption('git', 'sync_batch_size', 100,
+        N_("Number of changesets inserted in a single transaction when the "
+           "cache of a repository is synchronized."))
+
+    sync_workers = IntOption('git', 'sync_workers', 2,
+        N_("Number of threads reading the changesets of a repository while "
+           "its cache is synchronized, `0` to read them in the synchronizing "
+           "thread."))
+
     # IRepositoryConnector methods
 
     def get_supported_types(self):
@@ -597,7 +837,9 @@ class GitConnector(Component):
         else:
             use_cached = self.cached_repository
         if use_cached:
-            repos = GitCachedRepository(self.env, repos, self.log)
+            repos = GitCachedRepository(self.env, repos, self.log,
+                                        sync_batch_size=self.sync_batch_size,
+                                        sync_workers=self.sync_workers)
             self.log.debug("enabled CachedRepository for '%s'", dir)
         else:
             self.log.debug("disabled CachedRepository for '%s'", dir)
@@ -747,9 +989,16 @@ class GitRepository(Repository):
         self.format_signature = format_signature or _format_signature
         self.use_committer_id = use_committer_id
         self.use_committer_time = use_committer_time
-        self._ref_walkers = {}
         Repository.__init__(self, 'git:' + path, self.params, log)
 
+    def _clone(self):
+        """Return a copy of the repository with its own
+        `pygit2.Repository`, to be used in another thread.
+        """
+        repos = copy.copy(self)
+        repos.git_repos = pygit2.Repository(self.path)
+        return repos
+
     def _from_fspath(self, name):
         return name.decode(self.git_fs_encoding)
 
@@ -808,26 +1057,17 @@ class GitRepository(Repository):
             return git_object
         return None
 
-    def _iter_ref_walkers(self, rev):
+    def _get_commit_graph(self):
         git_repos = self.git_repos
-        target = git_repos[rev]
-
-        walkers = self._ref_walkers
+        tips = {}
         for name in git_repos.listall_references():
             if not name.startswith('refs/heads/'):
                 continue
             ref = git_repos.lookup_reference(name)
             commit = self._get_commit(ref.target)
-            if not commit:
-                continue
-            if commit.commit_time < target.commit_time:
-                continue
-            walker = walkers.get(name)
-            if walker and walker.rev != commit.hex:
-                walker = None
-            if not walker:
-                walkers[name] = walker = _CachedWalker(git_repos, commit.hex)
-            yield self._from_fspath(name), ref, walker
+            if commit:
+                tips[name] = commit.hex
+        return _get_commit_graph(self.path, git_repos, tips)
 
     def _get_changes(self, parent_tree, commit_tree):
         diff = parent_tree.diff_to_tree(commit_tree)
@@ -843,9 +1083,9 @@ class GitRepository(Repository):
         return sorted(generator, key=lambda item: item[1])
 
     def _get_branches(self, rev):
-        return sorted((name[11:], ref.target.hex)
-                      for name, ref, walker in self._iter_ref_walkers(rev)
-                      if rev in walker)
+        _from_fspath = self._from_fspath
+        return sorted((_from_fspath(name[11:]), tip)
+                      for name, tip in self._get_commit_graph().branches(rev))
 
     def _get_branches_cset(self, rev):
         return [(name, r == rev) for name, r in self._get_branches(rev)]
@@ -901,7 +1141,6 @@ class GitRepository(Repository):
             raise NoSuchChangeset(rev)
 
     def close(self):
-        self._ref_walkers.clear()
         self.git_repos = None
 
     def get_youngest_rev(self):
@@ -975,29 +1214,10 @@ class GitRepository(Repository):
         return self.params.get('url')
 
     def get_changesets(self, start, stop):
-        seen_oids = set()
-
-        def iter_commits():
-            ts_start = to_timestamp(start)
-            ts_stop = to_timestamp(stop)
-            git_repos = self.git_repos
-            for name in git_repos.listall_references():
-                if not name.startswith('refs/heads/'):
-                    continue
-                ref = git_repos.lookup_reference(name)
-                for commit in git_repos.walk(ref.target, _walk_flags):
-                    ts = commit.commit_time
-                    if ts < ts_start:
-                        break
-                    if ts_start <= ts <= ts_stop:
-                        oid = commit.oid
-                        if oid not in seen_oids:
-                            seen_oids.add(oid)
-                            yield ts, commit
-
-        for ts, commit in sorted(iter_commits(), key=lambda v: v[0],
-                                 reverse=True):
-            yield GitChangeset(self, commit)
+        git_repos = self.git_repos
+        graph = self._get_commit_graph()
+        for rev in graph.between(to_timestamp(start), to_timestamp(stop)):
+            yield GitChangeset(self, git_repos[rev])
 
     def get_changeset(self, rev):
         return GitChangeset(self, self._resolve_rev(rev))
@@ -1049,12 +1269,17 @@ class GitRepository(Repository):
         rev = self.normalize_rev(rev)
         path = self._to_fspath(self.normalize_path(path))
 
-        for name, ref, walker in self._iter_ref_walkers(rev):
-            if rev not in walker:
-                continue
-            for commit in walker.reverse(rev):
-                if not any(p.hex == rev for p in commit.parents):
-                    continue
+        git_repos = self.git_repos
+        graph = self._get_commit_graph()
+        for name, tip in sorted(graph.branches(rev)):
+            child_rev = rev
+            while True:
+                # the oldest child on the branch
+                for child_rev in graph.children_revs(child_rev, tip):
+                    break
+                else:
+                    break
+                commit = git_repos[child_rev]
                 tree = commit.tree
                 entry = self._get_tree(tree, path)
                 if entry is None:
@@ -1067,31 +1292,23 @@ class GitRepository(Repository):
                     if entry is None or parent_entry is None or \
                             entry.oid != parent_entry.oid:
                         return commit.hex
-                rev = commit.hex
 
     def parent_revs(self, rev):
         commit = self._resolve_rev(rev)
         return [c.hex for c in commit.parents]
 
     def child_revs(self, rev):
-        def iter_children(rev):
-            seen = set()
-            for name, ref, walker in self._iter_ref_walkers(rev):
-                if rev not in walker:
-                    continue
-                for commit in walker.reverse(rev):
-                    if commit.oid in seen:
-                        break
-                    seen.add(commit.oid)
-                    if any(p.hex == rev for p in commit.parents):
-                        yield commit
-        return [c.hex for c in iter_children(self.normalize_rev(rev))]
+        rev = self.normalize_rev(rev)
+        return self._get_commit_graph().children_revs(rev)
 
     def rev_older_than(self, rev1, rev2):
         oid1 = self._resolve_rev(rev1).oid
         oid2 = self._resolve_rev(rev2).oid
         if oid1 == oid2:
             return False
+        graph = self._get_commit_graph()
+        if oid1.hex in graph and oid2.hex in graph:
+            return graph.is_ancestor(oid1.hex, oid2.hex)
         return any(oid1 == commit.oid
                    for commit in self.git_repos.walk(oid2, _walk_flags))
 
@@ -812,6 +812,88 @@ M 100644 :1 .gitignore
         finally:
             rmtree(repos_path)
 
+    def test_sync_in_batches(self):
+        if not self.cached_repository:
+            return
+
+        data = self._generate_data_many_merges(20)
+        self.env.config.set('git', 'sync_batch_size', '7')
+        for workers in (0, 3):
+            self.env.config.set('git', 'sync_workers', str(workers))
+            repos_path = tempfile.mkdtemp(prefix='trac-gitrepos-')
+            try:
+                create_repository(repos_path, data=data)
+                repos = setup_repository(self.env, repos_path,
+                                         'batches%d.git' % workers,
+                                         sync=False)
+                revs = []
+                repos.sync(feedback=revs.append)
+                self.assertEqual(42, len(revs))
+                self.assertEqual(42, len(set(revs)))
+
+                db = self.env.get_read_db()
+                cursor = db.cursor()
+                cursor.execute("SELECT rev FROM revision WHERE repos=%s",
+                               (repos.id,))
+                self.assertEqual(set(revs), set(row[0] for row in cursor))
+
+                # resume after the youngest revisions are lost
+                @self.env.with_transaction()
+                def fn(db):
+                    cursor = db.cursor()
+                    for table in ('revision', 'node_change'):
+                        cursor.execute("DELETE FROM %s WHERE repos=%%s "
+                                       "AND rev IN (%s)"
+                                       % (table, ','.join(['%s'] * 10)),
+                                       [repos.id] + revs[-10:])
+                del revs[:]
+                repos.sync(feedback=revs.append)
+                self.assertEqual(10, len(revs))
+                cursor.execute("SELECT COUNT(*) FROM revision "
+                               "WHERE repos=%s", (repos.id,))
+                self.assertEqual(42, cursor.fetchone()[0])
+                cursor.execute("SELECT COUNT(*) FROM node_change "
+                               "WHERE repos=%s", (repos.id,))
+                self.assertEqual(42, cursor.fetchone()[0])
+            finally:
+                rmtree(repos_path)
+
+    def test_commit_graph_updated(self):
+        data = self._generate_data_many_merges(3)
+        repos_path = tempfile.mkdtemp(prefix='trac-gitrepos-')
+        try:
+            create_repository(repos_path, data=data)
+            repos = setup_repository(self.env, repos_path, 'graph.git')
+            head = repos.normalize_rev('master')
+            dev = repos.normalize_rev('dev')
+            self.assertEqual([], repos.child_revs(head))
+            self.assertEqual([head], repos.child_revs(dev))
+            self.assertEqual(True, repos.rev_older_than(dev, head))
+            self.assertEqual(False, repos.rev_older_than(head, dev))
+
+            proc = spawn(git_bin, '--git-dir=' + repos_path, 'fast-import')
+            stdout, stderr = proc.communicate(input="""\
+commit refs/heads/master
+author Joe <joe@example.com> 1400000100 +0000
+committer Joe <joe@example.com> 1400000100 +0000
+data 4
+new
+from %s
+""" % head)
+            self.assertEqual(0, proc.returncode, stderr)
+            repos.sync()
+
+            new = repos.normalize_rev('master')
+            self.assertNotEqual(head, new)
+            self.assertEqual([new], repos.child_revs(head))
+            self.assertEqual(True, repos.rev_older_than(dev, new))
+            changesets = repos.get_changesets(
+                datetime(2014, 5, 13, 16, 54, tzinfo=utc),
+                datetime(2014, 5, 13, 16, 55, tzinfo=utc))
+            self.assertEqual([new], [cset.rev for cset in changesets])
+        finally:
+            rmtree(repos_path)
+
     def _generate_data_many_merges(self, n, timestamp=1400000000):
         init = """\
 blob
@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+License: BSD
+
+Compare buffered and streamed encoding of large RPC results.
+
+Usage: python contrib/benchmark.py [-n ITEMS] [-r REPEAT]
+
+The protocols are driven in-process with a request object that discards
+the body, so the figures measure the encoding only. For each protocol the
+result is encoded once as a list (the behaviour before streaming) and once
+as a generator, and the time to the first written byte, the total time and
+the peak of memory allocated while encoding are reported. Memory is only
+measured on Python 3, in a separate run as tracemalloc slows it down.
+"""
+
+from datetime import datetime, timedelta
+from time import time
+import optparse
+import sys
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from trac.test import EnvironmentStub
+from trac.util.datefmt import utc
+from trac.web.api import RequestDone
+
+from tracrpc.json_rpc import JsonRpcProtocol
+from tracrpc.xml_rpc import XmlRpcProtocol
+
+
+if sys.version_info[0] != 2:
+    xrange = range
+
+
+class BenchRequest(object):
+
+    def __init__(self, content_type):
+        self.rpc = {'method': 'ticket.queryFull', 'mimetype': content_type}
+        self.first_byte = None
+        self.size = 0
+
+    def send_response(self, code=200):
+        pass
+
+    def send_header(self, name, value):
+        pass
+
+    def end_headers(self):
+        pass
+
+    def write(self, data):
+        if self.first_byte is None:
+            self.first_byte = time()
+        self.size += len(data)
+
+
+def _items(n):
+    start = datetime(2020, 1, 1, tzinfo=utc)
+    for idx in xrange(n):
+        when = start + timedelta(minutes=idx)
+        yield (idx + 1, when, when, {
+            'summary': u'Ticket number %d' % idx,
+            'description': u'Lorem ipsum dolor sit amet. ' * 8,
+            'status': u'new', 'owner': u'somebody', 'reporter': u'admin',
+            'component': u'component1', 'priority': u'major',
+            '_ts': str(idx),
+        })
+
+
+def _run(protocol, content_type, n, streamed, trace=False):
+    req = BenchRequest(content_type)
+    if trace:
+        tracemalloc.start()
+    start = time()
+    result = _items(n)
+    if not streamed:
+        result = list(result)
+    try:
+        protocol.send_rpc_result(req, result)
+    except RequestDone:
+        pass
+    end = time()
+    peak = None
+    if trace:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return req.first_byte - start, end - start, peak, req.size
+
+
+def main(args):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--items', dest='items', type='int',
+                      default=50000, help='number of items in the result')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int',
+                      default=3, help='number of runs, the best is shown')
+    options, args = parser.parse_args(args)
+    env = EnvironmentStub()
+    protocols = [('json', JsonRpcProtocol(env), 'application/json'),
+                 ('xml', XmlRpcProtocol(env), 'application/xml')]
+    print('%-5s %-9s %10s %10s %12s %12s' %
+          ('proto', 'mode', 'ttfb (s)', 'total (s)', 'peak (KiB)',
+           'size (KiB)'))
+    for name, protocol, content_type in protocols:
+        for streamed in (False, True):
+            runs = [_run(protocol, content_type, options.items, streamed)
+                    for _ in xrange(options.repeat)]
+            ttfb = min(run[0] for run in runs)
+            total = min(run[1] for run in runs)
+            size = runs[-1][3]
+            peak = None
+            if tracemalloc:
+                peak = _run(protocol, content_type, options.items, streamed,
+                            trace=True)[2]
+            print('%-5s %-9s %10.3f %10.3f %12s %12d' %
+                  (name, 'streamed' if streamed else 'buffered', ttfb, total,
+                   '%d' % (peak // 1024) if peak is not None else 'n/a',
+                   size // 1024))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -8,6 +8,7 @@ License: BSD
 
 import inspect
 import re
+import types
 from datetime import datetime
 
 from trac.core import (Component, ExtensionPoint, Interface, TracError,
@@ -199,6 +200,22 @@ class AbstractRPCHandler(Component):
         return self._rpc_methods
 
 
+def _prefetch(generator):
+    """ Evaluate the first item of `generator` so that errors raised
+    early, e.g. by permission checks, propagate before any part of the
+    response has been sent. Returns a list if `generator` is empty. """
+    try:
+        first = next(generator)
+    except StopIteration:
+        return []
+
+    def items():
+        yield first
+        for item in generator:
+            yield item
+    return items()
+
+
 class Method(object):
     """ Represents an XML-RPC exposed method. """
     def __init__(self, provider, permission, signatures, callable, name = None):
@@ -214,7 +231,11 @@ class Method(object):
         self.namespace = provider.xmlrpc_namespace()
         self.namespace_description = inspect.getdoc(provider)
 
-    def __call__(self, req, args):
+    def __call__(self, req, args, stream=False):
+        """ Call the method. With `stream` enabled, a generator returned
+        by the method is kept lazy (only its first item is evaluated
+        up-front) so that the protocol can encode the items as they are
+        produced. """
         if self.permission:
             req.perm.assert_permission(self.permission)
         result = self.callable(req, *args)
@@ -223,6 +244,8 @@ class Method(object):
             result = 0
         elif isinstance(result, dict):
             pass
+        elif stream and isinstance(result, types.GeneratorType):
+            result = _prefetch(result)
         elif not isinstance(result, basestring):
             # Try and convert result to a list
             try:
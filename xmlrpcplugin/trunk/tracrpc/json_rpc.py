@@ -10,6 +10,7 @@ import datetime
 import json
 import re
 import sys
+import types
 
 try:
     import babel
@@ -25,7 +26,8 @@ from trac.util.text import empty, exception_to_unicode, to_unicode
 from trac.web.api import HTTPBadRequest, RequestDone
 
 from .api import IRPCProtocol, Binary, MethodNotFound, ProtocolException
-from .util import cleandoc_, gettext, iteritems, unicode, izip
+from .util import (cleandoc_, gettext, iteritems, unicode, izip,
+                   send_chunks)
 
 
 __all__ = ['JsonRpcProtocol']
@@ -228,6 +230,8 @@ class JsonRpcProtocol(Component):
         """Send JSON-RPC response back to the caller."""
         rpcreq = req.rpc
         r_id = rpcreq.get('id')
+        if isinstance(result, types.GeneratorType):
+            self._send_streamed(req, result, r_id)
         try:
             if rpcreq.get('method') == 'system.multicall':
                 # Custom multicall
@@ -276,6 +280,37 @@ class JsonRpcProtocol(Component):
         req.write(response)
         raise RequestDone()
 
+    def _send_streamed(self, req, result, r_id):
+        """ Encode the items of a generator `result` as they are produced
+        and write them to the response in chunks. An error raised while
+        streaming can no longer be reported to the caller, so it is logged
+        and the response is left truncated. """
+        rpcreq = req.rpc
+        if rpcreq.get('method') == 'system.multicall':
+            args = (rpcreq.get('params') or [[]])[0]
+            result = (self._json_result(isinstance(value, Exception) and \
+                                                    value or value[0], \
+                                        sig.get('id') or r_id) \
+                      for sig, value in izip(args, result))
+        self.log.debug("RPC(json) streaming result")
+        try:
+            send_chunks(req, self._iter_json_result(result, r_id),
+                        rpcreq['mimetype'])
+        except RequestDone:
+            raise
+        except Exception as e:
+            self.log.error("RPC(json) error while streaming result%s",
+                           exception_to_unicode(e, traceback=True))
+        raise RequestDone()
+
+    def _iter_json_result(self, items, r_id):
+        encoder = TracRpcJSONEncoder()
+        yield '{"result": ['
+        for idx, item in enumerate(items):
+            # encode() uses the C accelerated encoder, iterencode() doesn't
+            yield ', ' + encoder.encode(item) if idx else encoder.encode(item)
+        yield '], "error": null, "id": %s}\n' % encoder.encode(r_id)
+
     def _json_result(self, result, r_id=None):
         """ Create JSON-RPC response dictionary. """
         if not isinstance(result, Exception):
@@ -18,7 +18,8 @@ from trac.test import EnvironmentStub
 from trac.util.datefmt import FixedOffset, timezone, utc
 
 from ..util import to_b, unicode
-from ..json_rpc import TracRpcJSONDecoder, TracRpcJSONEncoder, json_load
+from ..json_rpc import (JsonRpcProtocol, TracRpcJSONDecoder,
+                        TracRpcJSONEncoder, json_load)
 from . import (MockRequest, Request, TracRpcTestCase, TracRpcTestSuite,
                b64encode, urlopen, makeSuite)
 
@@ -184,6 +185,26 @@ class JsonTestCase(TracRpcTestCase):
         self.assertEqual(None, result['error'])
         self.assertEqual(244, result['id'])
 
+    def test_call_streamed(self):
+        req = Request(self._testenv.url_anon, data=json_data(
+                      {'method': 'system.listMethods', 'params': [],
+                       'id': 245}),
+                      headers={'Content-Type': 'application/json'})
+        resp = urlopen(req)
+        self.assertEqual(None, resp.info().get('Content-Length'))
+        result = _raw_json_load(resp)
+        self.assertIn('system.methodHelp', result['result'])
+        self.assertEqual(None, result['error'])
+        self.assertEqual(245, result['id'])
+
+    def test_iter_json_result(self):
+        env = EnvironmentStub()
+        items = [1, u'\u2603', {'time': datetime(2023, 3, 1, tzinfo=utc)},
+                 [None, True]]
+        chunks = JsonRpcProtocol(env)._iter_json_result(iter(items), 42)
+        self.assertEqual({'result': items, 'error': None, 'id': 42},
+                         json.loads(''.join(chunks), cls=TracRpcJSONDecoder))
+
     def test_multicall(self):
         data = {'method': 'system.multicall', 'params': [
                 {'method': 'wiki.getAllPages', 'params': [], 'id': 1},
@@ -184,6 +184,83 @@ class TicketPolicy(Component):
             self.admin.ticket.delete(tid1)
             self.admin.ticket.delete(tid2)
 
+    def test_getChanges(self):
+        tid1 = self.admin.ticket.create("ticket_getChanges", "one", {})
+        time.sleep(1)
+        tid2 = self.admin.ticket.create("ticket_getChanges", "two", {})
+        tid3 = self.admin.ticket.create("ticket_getChanges", "three", {})
+        self.admin.ticket.update(tid2, "comment", {'priority': 'minor'})
+        try:
+            cursor = self.admin.ticket.get(tid2)[1]
+            items = []
+            while True:
+                feed = self.admin.ticket.getChanges(cursor, 1)
+                self.assertTrue(len(feed['changes']) <= 1)
+                items.extend(feed['changes'])
+                cursor = feed['cursor']
+                if not feed['more']:
+                    break
+            self.assertEqual([tid3, tid2], [item[0] for item in items])
+            self.assertEqual([], items[0][3])
+            self.assertEqual(['comment', 'priority'],
+                             sorted(change[2] for change in items[1][3]))
+            self.assertEqual({'changes': [], 'cursor': cursor,
+                              'more': False},
+                             self.admin.ticket.getChanges(cursor))
+            self.admin.ticket.update(tid1, "later", {})
+            feed = self.admin.ticket.getChanges(cursor)
+            self.assertEqual([tid1], [item[0] for item in feed['changes']])
+            self.assertEqual([('comment', 'later')],
+                             [(change[2], change[4])
+                              for change in feed['changes'][0][3]])
+            self.assertRaises(xmlrpclib.Fault, self.admin.ticket.getChanges,
+                              'invalid')
+        finally:
+            self.admin.ticket.delete(tid1)
+            self.admin.ticket.delete(tid2)
+            self.admin.ticket.delete(tid3)
+
+    def test_getMany(self):
+        tid1 = self.admin.ticket.create("getMany", "one", {'owner': 'A'})
+        tid2 = self.admin.ticket.create("getMany", "two", {'owner': 'B'})
+        try:
+            self.admin.ticket.update(tid2, "comment", {'priority': 'minor'})
+            tickets = self.admin.ticket.getMany([tid2, 9999, tid1, tid2])
+            self.assertEqual([tid2, tid1], [t[0] for t in tickets])
+            for t in tickets:
+                self.assertEqual(t, self.admin.ticket.get(t[0]))
+            tickets = self.admin.ticket.getMany([tid1, tid2],
+                                                ['summary', 'owner'])
+            self.assertEqual([{'summary': 'getMany', 'owner': 'A'},
+                              {'summary': 'getMany', 'owner': 'B'}],
+                             [dict((k, v) for k, v in t[3].items()
+                                   if k != '_ts') for t in tickets])
+            tickets = self.admin.ticket.getMany([tid2], ['status'], True)
+            self.assertEqual(self.admin.ticket.changeLog(tid2),
+                             tickets[0][3]['_changelog'])
+            self.assertEqual(['comment', 'priority'],
+                             sorted(c[2] for c in tickets[0][3]['_changelog']))
+        finally:
+            self.admin.ticket.delete(tid1)
+            self.admin.ticket.delete(tid2)
+
+    def test_queryFull(self):
+        t1 = self.admin.ticket.create("1", "", {'owner': 'A'})
+        t2 = self.admin.ticket.create("2", "", {'owner': 'B'})
+        t3 = self.admin.ticket.create("3", "", {'owner': 'A'})
+        try:
+            tickets = self.admin.ticket.queryFull("owner=A&order=id&desc=1",
+                                                  ['summary'])
+            self.assertEqual([t3, t1], [t[0] for t in tickets])
+            self.assertEqual(['3', '1'], [t[3]['summary'] for t in tickets])
+            self.assertEqual([[], []],
+                             [sorted(set(t[3]) - set(['summary', '_ts']))
+                              for t in tickets])
+        finally:
+            self.admin.ticket.delete(t1)
+            self.admin.ticket.delete(t2)
+            self.admin.ticket.delete(t3)
+
     def test_query_group_order_col(self):
         t1 = self.admin.ticket.create("1", "",
                         {'type': 'enhancement', 'owner': 'A'})
@@ -62,6 +62,41 @@ class RpcWikiTestCase(TracRpcTestCase):
         self.admin.wiki.deletePage('WikiOne')
         self.admin.wiki.deletePage('WikiTwo')
 
+    def test_getChanges(self):
+        self.admin.wiki.putPage('WikiOne', 'content one', {})
+        time.sleep(1)
+        self.admin.wiki.putPage('WikiTwo', 'content two', {})
+        self.admin.wiki.putPage('WikiThree', 'content three', {})
+        self.admin.wiki.putPage('WikiTwo', 'content two, again', {})
+        try:
+            since = self.admin.wiki.getPageInfoVersion('WikiTwo', 1)
+            cursor = since['lastModified']
+            items = []
+            while True:
+                feed = self.admin.wiki.getChanges(cursor, 2)
+                self.assertTrue(len(feed['changes']) <= 2)
+                items.extend((c['name'], c['version'])
+                             for c in feed['changes'])
+                cursor = feed['cursor']
+                if not feed['more']:
+                    break
+            self.assertEqual([('WikiThree', 1), ('WikiTwo', 1),
+                              ('WikiTwo', 2)], sorted(items))
+            self.assertEqual(('WikiTwo', 2), items[-1])
+            feed = self.admin.wiki.getChanges(cursor)
+            self.assertEqual({'changes': [], 'cursor': cursor,
+                              'more': False}, feed)
+            self.admin.wiki.putPage('WikiOne', 'content one, again', {})
+            feed = self.admin.wiki.getChanges(cursor)
+            self.assertEqual([('WikiOne', 2)], [(c['name'], c['version'])
+                                                for c in feed['changes']])
+            self.assertRaises(xmlrpclib.Fault, self.admin.wiki.getChanges,
+                              'invalid')
+        finally:
+            self.admin.wiki.deletePage('WikiOne')
+            self.admin.wiki.deletePage('WikiTwo')
+            self.admin.wiki.deletePage('WikiThree')
+
     def test_getPageHTMLWithImage(self):
         # Create the wiki page (absolute image reference)
         self.admin.wiki.putPage('ImageTest',
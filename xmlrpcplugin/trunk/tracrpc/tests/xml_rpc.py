@@ -9,11 +9,13 @@ import sys
 import unittest
 from datetime import datetime
 
+from trac.test import EnvironmentStub
 from trac.util.datefmt import to_datetime, utc
 
 from ..util import xmlrpclib
-from ..xml_rpc import (to_xmlrpc_datetime, from_xmlrpc_datetime,
-                       _illegal_unichrs, REPLACEMENT_CHAR)
+from ..xml_rpc import (XmlRpcProtocol, to_xmlrpc_datetime,
+                       from_xmlrpc_datetime, _illegal_unichrs,
+                       REPLACEMENT_CHAR)
 from . import (Request, TracRpcTestCase, TracRpcTestSuite, b64encode, urlopen,
                makeSuite)
 
@@ -90,6 +92,27 @@ class RpcXmlTestCase(TracRpcTestCase):
                       b'<value><int>-32700</int></value>\n'
                       b'</member>', response.read())
 
+    def test_call_streamed(self):
+        body = xmlrpclib.dumps((), 'system.listMethods').encode('utf-8')
+        request = Request(self._testenv.url_anon, data=body)
+        request.add_header('Content-Type', 'application/xml')
+        request.add_header('Content-Length', str(len(body)))
+        response = urlopen(request)
+        self.assertEqual(200, response.code)
+        self.assertEqual(None, response.info().get('Content-Length'))
+        result, method = xmlrpclib.loads(response.read())
+        self.assertIn('system.methodHelp', result[0])
+
+    def test_iter_xml_result(self):
+        env = EnvironmentStub()
+        items = [1, u'\u2603\x01', {'time': datetime(2023, 3, 1, tzinfo=utc)},
+                 [None, True]]
+        chunks = XmlRpcProtocol(env)._iter_xml_result(iter(items))
+        result, method = xmlrpclib.loads(u''.join(chunks).encode('utf-8'))
+        self.assertEqual([[1, u'\u2603' + REPLACEMENT_CHAR,
+                           {'time': xmlrpclib.DateTime('20230301T00:00:00')},
+                           ['', True]]], list(result))
+
     def test_to_and_from_datetime(self):
         now = to_datetime(None, utc)
         now_timetuple = now.timetuple()[:6]
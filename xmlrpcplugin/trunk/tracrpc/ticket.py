@@ -12,6 +12,7 @@ from datetime import datetime
 
 from trac.attachment import Attachment
 from trac.core import Component, TracError, implements
+from trac.perm import PermissionSystem
 from trac.resource import Resource, ResourceNotFound
 from trac.ticket import model, query
 from trac.ticket.api import TicketSystem
@@ -47,9 +48,16 @@ class TicketRPC(Component):
     def xmlrpc_methods(self):
         yield (None, ((list,), (list, str)), self.query)
         yield (None, ((list, datetime),), self.getRecentChanges)
+        yield (None, ((dict,), (dict, str), (dict, str, int),
+                      (dict, datetime), (dict, datetime, int)),
+                      self.getChanges)
         yield (None, ((list, int),), self.getAvailableActions)
         yield (None, ((list, int),), self.getActions)
         yield (None, ((list, int),), self.get)
+        yield (None, ((list, list), (list, list, list),
+                      (list, list, list, bool)), self.getMany)
+        yield (None, ((list,), (list, str), (list, str, list),
+                      (list, str, list, bool)), self.queryFull)
         yield ('TICKET_CREATE', ((int, str, str),
                                  (int, str, str, dict),
                                  (int, str, str, dict, bool),
@@ -82,13 +90,9 @@ class TicketRPC(Component):
         `max=0` will turn off paging and return all results.
         """
         q = query.Query.from_string(self.env, qstr)
-        ticket_realm = Resource('ticket')
-        out = []
-        for t in q.execute(req):
-            tid = t['id']
-            if 'TICKET_VIEW' in req.perm(ticket_realm(id=tid)):
-                out.append(tid)
-        return out
+        tids = [t['id'] for t in q.execute(req)]
+        viewable = self._viewable(req, tids)
+        return [tid for tid in tids if tid in viewable]
 
     def getRecentChanges(self, req, since):
         """Returns a list of IDs of tickets that have changed since timestamp."""
@@ -145,6 +149,72 @@ class TicketRPC(Component):
         t['_ts'] = str(to_utimestamp(changetime))
         return (t.id, t['time'], changetime, t.values)
 
+    def getMany(self, req, ids, fields=[], changelog=False):
+        """ Fetch several tickets at once. Returns a list of
+        [id, time_created, time_changed, attributes] like `get()`, with
+        a `_changelog` attribute in the form of `changeLog()` added when
+        `changelog` is true. Only the `fields` listed are returned in the
+        attributes (all fields if empty). Tickets that do not exist or
+        may not be viewed are left out of the result. """
+        return self._get_many(req, ids, fields, changelog)
+
+    def queryFull(self, req, qstr='status!=closed', fields=[],
+                  changelog=False):
+        """ Perform a ticket query like `query()`, returning the tickets
+        in the form of `getMany()` instead of a list of ticket ID's. """
+        # query() only returns the tickets that may be viewed
+        return self._get_many(req, self.query(req, qstr), fields, changelog,
+                              check_perm=False)
+
+    def getChanges(self, req, cursor='', limit=100):
+        """ Returns a feed of ticket changes as a dict with the keys
+        `changes`, a list of [id, time_created, time_changed, changelog] in
+        order of change time, `cursor`, a token to pass to the next call to
+        continue after the last returned ticket, and `more`, which is true
+        if more changes are pending. `changelog` lists the changes made
+        since `cursor` in the form of `changeLog()`. The `cursor` argument
+        is either a token returned by a previous call, a timestamp to start
+        from, or empty to start from the first ticket. At most `limit`
+        tickets, and no more than 500, are fetched per call; tickets that
+        may not be viewed are skipped, so fewer may be returned while
+        `more` is true. """
+        since, last_id = self._parse_cursor(cursor)
+        limit = int(limit)
+        if limit < 1:
+            raise TracError("RPC ticket.getChanges: limit must be positive.")
+        # the ids of the fetched tickets are passed as query parameters
+        limit = min(limit, self._get_many_chunk)
+        if last_id is None:
+            where, args = 'changetime>=%s', [since]
+        else:
+            where = 'changetime>%s OR (changetime=%s AND id>%s)'
+            args = [since, since, last_id]
+        rows = list(self._db_query("""
+                SELECT id,time,changetime FROM ticket WHERE %s
+                ORDER BY changetime,id LIMIT %d
+                """ % (where, limit + 1), args))
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if rows:
+            next_cursor = '%d:%d' % (rows[-1][2], rows[-1][0])
+        elif last_id is None:
+            next_cursor = '%d:0' % since
+        else:
+            next_cursor = '%d:%d' % (since, last_id)
+        viewable = self._viewable(req, [row[0] for row in rows])
+        rows = [row for row in rows if row[0] in viewable]
+        changes = {}
+        if rows:
+            chunk = [row[0] for row in rows]
+            holders = ','.join(['%s'] * len(chunk))
+            changes = self._get_many_changelog(
+                chunk, holders, self._field_converter(model.Ticket(self.env)),
+                since)
+        return {'changes': [(tid, from_utimestamp(time_created),
+                             from_utimestamp(changetime), changes.get(tid, []))
+                            for tid, time_created, changetime in rows],
+                'cursor': next_cursor, 'more': more}
+
     def create(self, req, summary, description, attributes={}, notify=False, when=None):
         """ Create a new ticket, returning the ticket ID.
         Overriding 'when' requires admin permission. """
@@ -317,6 +387,152 @@ class TicketRPC(Component):
 
     # Internal methods
 
+    _get_many_chunk = 500
+
+    # Permission policies which decide TICKET_VIEW for the ticket realm
+    # as a whole, whatever the ticket.
+    _realm_policies = frozenset(['DefaultPermissionPolicy',
+                                 'DefaultTicketPolicy',
+                                 'DefaultWikiPolicy',
+                                 'LegacyAttachmentPolicy',
+                                 'ReadonlyWikiPolicy'])
+
+    def _viewable(self, req, ids):
+        """Return the set of the distinct `ids` of tickets which may be
+        viewed.  The permission is checked once for the ticket realm
+        unless a policy may decide per ticket."""
+        ids = set(ids)
+        policies = PermissionSystem(self.env).policies
+        if all(p.__class__.__name__ in self._realm_policies
+               for p in policies):
+            return ids if 'TICKET_VIEW' in req.perm('ticket') else set()
+        ticket_realm = Resource('ticket')
+        return set(tid for tid in ids
+                   if 'TICKET_VIEW' in req.perm(ticket_realm(id=tid)))
+
+    def _get_many(self, req, ids, fields, changelog, check_perm=True):
+        t = model.Ticket(self.env)
+        wanted = set(fields or ())
+        std_fields = [name for name in t.std_fields
+                      if not wanted or name in wanted]
+        custom_fields = [f for f in t.fields if f.get('custom') and
+                         (not wanted or f['name'] in wanted)]
+        custom_names = set(f['name'] for f in custom_fields)
+        time_fields = set(t.time_fields)
+        custom_default = getattr(t, '_custom_field_default',
+                                 lambda field: field.get('value'))
+        convert = self._field_converter(t)
+        seen = set()
+        tids = []
+        for tid in ids:
+            tid = int(tid)
+            if tid not in seen:
+                seen.add(tid)
+                tids.append(tid)
+        if check_perm:
+            viewable = self._viewable(req, tids)
+            tids = [tid for tid in tids if tid in viewable]
+        for start in range(0, len(tids), self._get_many_chunk):
+            chunk = tids[start:start + self._get_many_chunk]
+            if not chunk:
+                continue
+            holders = ','.join(['%s'] * len(chunk))
+            tickets = {}
+            for row in self._db_query("""
+                    SELECT id,time,changetime%s FROM ticket WHERE id IN (%s)
+                    """ % (''.join(',' + name for name in std_fields),
+                           holders), chunk):
+                values = {}
+                for name, value in zip(std_fields, row[3:]):
+                    if name in time_fields:
+                        values[name] = from_utimestamp(value)
+                    else:
+                        values[name] = '' if value is None else value
+                tickets[row[0]] = (from_utimestamp(row[1]),
+                                   from_utimestamp(row[2]), values)
+            if not tickets:
+                continue
+            if custom_fields:
+                for tid, name, value in self._db_query("""
+                        SELECT ticket,name,value FROM ticket_custom
+                        WHERE ticket IN (%s)""" % holders, chunk):
+                    if tid in tickets and name in custom_names:
+                        tickets[tid][2][name] = convert(name, value)
+                for time_created, changetime, values in tickets.values():
+                    for field in custom_fields:
+                        if field['name'] not in values:
+                            values[field['name']] = \
+                                custom_default(field) or ''
+            if changelog:
+                changes = self._get_many_changelog(chunk, holders, convert)
+            for tid in chunk:
+                if tid not in tickets:
+                    continue
+                time_created, changetime, values = tickets[tid]
+                values['_ts'] = str(to_utimestamp(changetime))
+                if changelog:
+                    values['_changelog'] = changes.get(tid, [])
+                yield (tid, time_created, changetime, values)
+
+    def _get_many_changelog(self, chunk, holders, convert, since=None):
+        changes = {}
+        time_filter = '' if since is None else ' AND time>=%s'
+        time_args = [] if since is None else [since]
+        for tid, t, author, field, oldvalue, newvalue in self._db_query("""
+                SELECT ticket,time,author,field,oldvalue,newvalue
+                FROM ticket_change WHERE ticket IN (%s)%s
+                """ % (holders, time_filter), chunk + time_args):
+            changes.setdefault(tid, []).append(
+                (t, 1, author, field, convert(field, oldvalue),
+                 convert(field, newvalue)))
+        for tid, t, author, filename, description in self._db_query("""
+                SELECT id,time,author,filename,description FROM attachment
+                WHERE type='ticket' AND id IN (%s)%s
+                """ % (holders, time_filter),
+                [str(tid) for tid in chunk] + time_args):
+            entries = changes.setdefault(int(tid), [])
+            entries.append((t, 0, author, 'attachment', '', filename))
+            entries.append((t, 0, author, 'comment', '', description or ''))
+        result = {}
+        for tid, entries in iteritems(changes):
+            entries.sort(key=lambda entry: entry[:4])
+            result[tid] = [(from_utimestamp(t), author, field, old, new,
+                            permanent)
+                           for t, permanent, author, field, old, new
+                           in entries]
+        return result
+
+    def _field_converter(self, ticket):
+        time_fields = set(ticket.time_fields)
+        str_to_datetime = getattr(model, '_db_str_to_datetime', None)
+
+        def convert(name, value):
+            if name in time_fields and str_to_datetime:
+                return str_to_datetime(value) or ''
+            return '' if value is None else value
+        return convert
+
+    def _parse_cursor(self, cursor):
+        """ Returns `(time, id)` for a `getChanges()` cursor, where `id` is
+        `None` when starting at `time` rather than after `(time, id)`. """
+        if isinstance(cursor, datetime):
+            return to_utimestamp(cursor), None
+        if not cursor:
+            return 0, None
+        try:
+            ts, tid = cursor.split(':', 1)
+            return int(ts), int(tid)
+        except ValueError:
+            raise TracError("RPC ticket.getChanges: Wrong cursor (%r)."
+                            % cursor)
+
+    def _db_query(self, query, args):
+        if hasattr(self.env, 'db_query'):
+            return self.env.db_query(query, args)
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute(query, args)
+        return cursor.fetchall()
+
     def _extract_action_controls(self, widgets):
 
         def unescape(value):
@@ -84,3 +84,25 @@ def to_b(value):
     if isinstance(value, bytes):
         return value
     raise TypeError(str(type(value)))
+
+
+def send_chunks(req, chunks, content_type, chunk_size=8192):
+    """Send a response with the body produced by the `chunks` iterable.
+    No `Content-Length` header is sent, so the server uses chunked
+    transfer encoding (or closes the connection). Small chunks are
+    joined into writes of about `chunk_size` bytes."""
+    req.send_response(200)
+    req.send_header('Content-Type', content_type)
+    req.end_headers()
+    buf = []
+    size = 0
+    for chunk in chunks:
+        chunk = to_b(chunk)
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= chunk_size:
+            req.write(b''.join(buf))
+            buf = []
+            size = 0
+    if buf:
+        req.write(b''.join(buf))
@@ -7,7 +7,6 @@ License: BSD
 """
 
 import pkg_resources
-import types
 
 from trac.core import Component, ExtensionPoint, TracError, implements
 from trac.env import IEnvironmentSetupParticipant
@@ -186,9 +185,8 @@ class RPCWeb(Component):
             self.log.debug("RPC(%s) call by '%s' %s", proto_id,
                            req.authname, method_name)
             try:
-                result = (XMLRPCSystem(self.env).get_method(method_name)(req, args))[0]
-                if isinstance(result, types.GeneratorType):
-                    result = list(result)
+                method = XMLRPCSystem(self.env).get_method(method_name)
+                result = method(req, args, stream=True)[0]
             except (TracError, PermissionError, ResourceNotFound):
                 raise
             except Exception as e:
@@ -50,6 +50,9 @@ class WikiRPC(Component):
 
     def xmlrpc_methods(self):
         yield (None, ((dict, datetime),), self.getRecentChanges)
+        yield (None, ((dict,), (dict, str), (dict, str, int),
+                      (dict, datetime), (dict, datetime, int)),
+                      self.getChanges)
         yield ('WIKI_VIEW', ((int,),), self.getRPCVersionSupported)
         yield (None, ((str, str), (str, str, int),), self.getPage)
         yield (None, ((str, str, int),), self.getPage, 'getPageVersion')
@@ -82,6 +85,23 @@ class WikiRPC(Component):
                 msg += ' at version %s' % version
             raise ResourceNotFound(msg)
 
+    _get_changes_chunk = 500
+
+    def _parse_cursor(self, cursor):
+        """ Returns `(time, (version, name))` for a `getChanges()` cursor,
+        or `(time, None)` when starting at `time` rather than after the
+        given version. """
+        if isinstance(cursor, datetime):
+            return to_utimestamp(cursor), None
+        if not cursor:
+            return 0, None
+        try:
+            ts, version, name = cursor.split(':', 2)
+            return int(ts), (int(version), name)
+        except ValueError:
+            raise TracError("RPC wiki.getChanges: Wrong cursor (%r)."
+                            % cursor)
+
     def _page_info(self, name, when, author, version, comment):
         return dict(name=name, lastModified=when,
                     author=author, version=int(version), comment=comment)
@@ -112,6 +132,56 @@ class WikiRPC(Component):
                                     author, version, comment))
         return result
 
+    def getChanges(self, req, cursor='', limit=100):
+        """ Returns a feed of wiki page versions as a dict with the keys
+        `changes`, a list of page info structs (as returned by
+        `getPageInfo()`) in order of modification time, `cursor`, a token to
+        pass to the next call to continue after the last returned version,
+        and `more`, which is true if more versions are pending. The
+        `cursor` argument is either a token returned by a previous call, a
+        timestamp to start from, or empty to start from the first version.
+        At most `limit` versions, and no more than 500, are fetched per
+        call; versions that may not be viewed are skipped, so fewer may be
+        returned while `more` is true. """
+        since, last = self._parse_cursor(cursor)
+        limit = int(limit)
+        if limit < 1:
+            raise TracError("RPC wiki.getChanges: limit must be positive.")
+        limit = min(limit, self._get_changes_chunk)
+        if last is None:
+            where, args = 'time>=%s', [since]
+        else:
+            where = 'time>%s OR (time=%s AND (name>%s OR ' \
+                    '(name=%s AND version>%s)))'
+            args = [since, since, last[1], last[1], last[0]]
+        query = 'SELECT name, time, author, version, comment FROM wiki ' \
+                'WHERE %s ORDER BY time, name, version LIMIT %d' \
+                % (where, limit + 1)
+        if hasattr(self.env, 'db_query'):
+            rows = self.env.db_query(query, args)
+        else:
+            db = self.env.get_db_cnx()
+            cursor = db.cursor()
+            cursor.execute(query, args)
+            rows = cursor.fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if rows:
+            name, when, author, version, comment = rows[-1]
+            next_cursor = '%d:%d:%s' % (when, version, name)
+        elif last is None:
+            next_cursor = '%d:0:' % since
+        else:
+            next_cursor = '%d:%d:%s' % (since, last[0], last[1])
+        wiki_realm = Resource('wiki')
+        changes = []
+        for name, when, author, version, comment in rows:
+            if 'WIKI_VIEW' in req.perm(wiki_realm(id=name, version=version)):
+                changes.append(
+                    self._page_info(name, from_utimestamp(when),
+                                    author, version, comment))
+        return {'changes': changes, 'cursor': next_cursor, 'more': more}
+
     def getRPCVersionSupported(self, req):
         """ Returns 2 with this version of the Trac API. """
         return 2
@@ -10,6 +10,7 @@ import datetime
 import re
 import sys
 import time
+import types
 
 try:
     import babel
@@ -26,7 +27,8 @@ from trac.web.api import RequestDone
 
 from .api import (IRPCProtocol, Binary, MethodNotFound, ProtocolException,
                   ServiceException)
-from .util import basestring, cleandoc_, gettext, unichr, xmlrpclib
+from .util import (basestring, cleandoc_, gettext, send_chunks, unichr,
+                   xmlrpclib)
 
 __all__ = ['XmlRpcProtocol']
 
@@ -133,6 +135,8 @@ class XmlRpcProtocol(Component):
         """Send the result of the XML-RPC call back to the client."""
         rpcreq = req.rpc
         method = rpcreq.get('method')
+        if isinstance(result, types.GeneratorType):
+            self._send_streamed(req, result)
         self.log.debug("RPC(xml) '%s' result: %s", method, repr(result))
         result = tuple(self._normalize_xml_output([result]))
         self._send_response(req,
@@ -178,6 +182,39 @@ class XmlRpcProtocol(Component):
         req.write(response)
         raise RequestDone
 
+    def _send_streamed(self, req, result):
+        """ Marshal the items of a generator `result` as they are produced
+        and write them to the response in chunks. An error raised while
+        streaming can no longer be reported to the caller, so it is logged
+        and the response is left truncated. """
+        rpcreq = req.rpc
+        self.log.debug("RPC(xml) '%s' streaming result", rpcreq.get('method'))
+        try:
+            send_chunks(req, self._iter_xml_result(result),
+                        rpcreq['mimetype'])
+        except RequestDone:
+            raise
+        except Exception as e:
+            self.log.error("RPC(xml) error while streaming result%s",
+                           exception_to_unicode(e, traceback=True))
+        raise RequestDone
+
+    def _iter_xml_result(self, items):
+        marshaller = xmlrpclib.Marshaller('utf-8')
+        # Each item is marshalled as the single parameter of a response,
+        # whose enclosing <params><param> tags are stripped to get its
+        # <value> element.
+        head = len("<params>\n<param>\n")
+        tail = len("</param>\n</params>\n")
+        yield "<?xml version='1.0'?>\n<methodResponse>\n<params>\n" \
+              "<param>\n<value><array><data>\n"
+        for item in items:
+            out = marshaller.dumps(self._normalize_xml_output([item]))
+            yield _illegal_xml_chars_RE.sub(REPLACEMENT_CHAR,
+                                            to_unicode(out[head:-tail]))
+        yield "</data></array></value>\n</param>\n</params>\n" \
+              "</methodResponse>\n"
+
     def _normalize_xml_input(self, args):
         """ Normalizes arguments (at any level - traversing dicts and lists):
         1. xmlrpc.DateTime is converted to Python datetime